@@ -1,53 +1,40 @@
 
 import os
 import sys
-import math
 import json
-import copy
 import platform
-import time
 import threading
 import traceback
-import queue
 import itertools
-from typing import List, Dict, Optional, Tuple, Any
-from dataclasses import dataclass, field, asdict
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+from dataclasses import asdict
+
+if __name__ == "__main__":
+    # 書き出しワーカーとして起動された場合は、GUIのライブラリを読み込む前にここで処理して終わる
+    multiprocessing.freeze_support()
+    if sys.argv[1:2] in (["export"], ["batch"]):
+        # コマンドラインからの書き出し（Tk/customtkinter を使わないのでディスプレイのないサーバーでも動く）
+        from hbs_cli import main
+        sys.exit(main(sys.argv[1:]))
+
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, colorchooser, Canvas
 
-from PIL import Image, ImageTk, ImageOps, ImageDraw, ImageFont
+from PIL import Image, ImageTk
 import customtkinter as ctk
 
+from hbs_engine import (
+    CONFIG_FILE, PAPER_SIZES, PAPER_KEYS, FolderScanner, load_config, measure_text, TextSpriteCache, TEXT_SPRITES,
+    PhotoItem, TextItem, Page, Project, LayoutManager, ProjectHistory, load_project_file,
+    decode_proxy, get_proxy_store, clear_proxy_cache, crop_key, page_signature, get_page_margins, ImageLoadQueue, resolve_worker_count,
+    EXPORT_FORMATS, ExportOptions, ExportTelemetry, open_page_cache,
+    export_page_count, export_project,
+)
+
 # --- Constants & Defaults ---
-CONFIG_FILE = "config.json"
-DEFAULT_CONFIG = {
-    "auto_save_enabled": False,
-    "auto_save_interval": 5, # minutes
-    "startup_cover_mode": False,
-    "startup_export_fmt": "PDF",
-    "snap_enabled": True,
-    "zoom_sensitivity": 1.1,
-    "export_dpi": 300,
-    "export_bleed_mm": 0.0,
-    "export_quality": 95,
-    "export_crop_marks": False,
-    "preview_quality": "medium",
-    "default_image_folder": "",
-    "default_margin_top": 15.0,
-    "default_margin_bottom": 15.0,
-    "default_margin_inner": 15.0,
-    "default_margin_outer": 15.0
-}
-
-MM_TO_INCH = 1 / 25.4
-
-PAPER_SIZES = {
-    "A0": (841, 1189), "A1": (594, 841), "A2": (420, 594), "A3": (297, 420),
-    "A4": (210, 297), "A5": (148, 210), "A6": (105, 148), "B4": (257, 364),
-    "B5": (182, 257), "Hagaki": (100, 148), "L-Size": (89, 127), "2L-Size": (127, 178)
-}
-PAPER_KEYS = sorted(PAPER_SIZES.keys())
-IMG_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
 
 # Colors
 COLOR_BG_MAIN = "#121212"
@@ -64,6 +51,13 @@ COLOR_RED_HOVER = "#FF7D82"
 COLOR_HIGHLIGHT = "#E68A2E"
 COLOR_MENU_BG = "#000000"
 
+PREFETCH_DELAY_MS = 300 # 最後の描画からこの時間操作がなければ前後の見開きを先読みする
+VIEWER_CACHE_MB = 256 # ビューアーが保持する PhotoImage の上限（超えたら古いものから捨てる）
+PREVIEW_CACHE_MB = 256 # スタジオのプレビューが保持する PhotoImage の上限（先読みした見開きの分も含む）
+MINI_THUMB_STEP = 8 # ミニサムネイルはこの単位に切り上げたサイズでデコードしてキャッシュする（枠の大きさが少し変わっても再デコードしない）
+MINI_CACHE_ITEMS = 2000 # ミニサムネイルのキャッシュ枚数の上限
+FOLDER_POLL_MS = 5000 # 写真フォルダの変更（追加・削除）を確認する間隔
+
 # --- Font Helpers ---
 def get_system_fonts():
     if platform.system() == "Windows":
@@ -73,52 +67,167 @@ def get_system_fonts():
     else:
         return ["Noto Sans", "DejaVu Sans", "FreeSans"]
 
-def load_font(family, size):
-    try: return ImageFont.truetype(family, size)
-    except: return ImageFont.load_default()
-
-# --- Data Models ---
-@dataclass
-class CropInfo:
-    left: float = 0.0; top: float = 0.0; right: float = 1.0; bottom: float = 1.0
-
-@dataclass
-class PhotoItem:
-    path: str; slot_index: int = 0; rotation: int = 0; crop: CropInfo = field(default_factory=CropInfo)
-
-@dataclass
-class TextItem:
-    text: str; x_rel: float = 0.5; y_rel: float = 0.5; font_size: int = 40
-    color: str = "#000000"; font_family: str = "Arial"; rotation: int = 0; uuid: str = ""
-    def __post_init__(self):
-        if not self.uuid: import uuid; self.uuid = str(uuid.uuid4())
-
-@dataclass
-class Page:
-    layout_name: str = "1枚 (全面)"; spacing_mm: float = 0.0; background_color: str = "#FFFFFF"
-    photos: List[PhotoItem] = field(default_factory=list); texts: List[TextItem] = field(default_factory=list)
-    custom_margins: Optional[Dict[str, float]] = None 
-
-@dataclass
-class Project:
-    paper_size: str = "A4"; orientation: str = "Portrait"
-    margin_top: float = 15.0; margin_bottom: float = 15.0; margin_inner: float = 15.0; margin_outer: float = 15.0
-    pages: List[Page] = field(default_factory=list); current_spread_index: int = 0
-
-class LayoutManager:
-    LAYOUTS = {
-        "1枚 (全面)": [(0.0, 0.0, 1.0, 1.0)], "1枚 (中央)": [(0.1, 0.1, 0.8, 0.8)],
-        "2枚 (縦並び)": [(0.0, 0.0, 1.0, 0.5), (0.0, 0.5, 1.0, 0.5)], "2枚 (横並び)": [(0.0, 0.0, 0.5, 1.0), (0.5, 0.0, 0.5, 1.0)],
-        "3枚 (分割)": [(0.0, 0.0, 1.0, 0.5), (0.0, 0.5, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)],
-        "4枚 (グリッド)": [(0.0, 0.0, 0.5, 0.5), (0.5, 0.0, 0.5, 0.5), (0.0, 0.5, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)],
-        "6枚 (グリッド)": [(0.0, 0.0, 0.5, 0.333), (0.5, 0.0, 0.5, 0.333), (0.0, 0.333, 0.5, 0.333), (0.5, 0.333, 0.5, 0.333), (0.0, 0.666, 0.5, 0.333), (0.5, 0.666, 0.5, 0.333)],
-    }
+# --- Thumbnail View (Virtualized) ---
+class ThumbnailView(ctk.CTkFrame):
+    """見開きサムネイルを並べる帯（horizontal）または一覧（vertical, columns 列）。
+    枠（Frame+Canvas+Label）は見えている範囲と前後 overscan 行の分しか作らず、スクロールに合わせて別の見開きに使い回す。
+    スクロール範囲は項目数から計算するので、ページ数が増えてもウィジェットの数は変わらない。
+    draw_item(canvas, index) で描画し、signature(index) を渡した場合は値が変わった枠だけ描き直す。label_of が None なら見出しは付けない。
+    範囲から外れた枠は release_item(canvas) で中身（PhotoImage の参照など）を手放す"""
+    def __init__(self, master, draw_item, on_click, label_of, signature=None, release_item=None, orientation="horizontal", columns=1,
+                 thumb_size=(120, 80), item_size=(132, 110), overscan=3, normal_style=None, current_style=None,
+                 slot_color="transparent", thumb_bg="#222", label_font=("Arial", 10), label_color=COLOR_FG_DIM, slot_pad=0,
+                 bg=COLOR_BG_TER, **kwargs):
+        super().__init__(master, fg_color=bg, corner_radius=0, **kwargs)
+        self.draw_item = draw_item; self.on_click = on_click; self.label_of = label_of
+        self.signature = signature or (lambda index: None)
+        self.release_item = release_item or self._release_canvas
+        self.vertical = orientation == "vertical"; self.columns = max(1, columns) if self.vertical else 1
+        self.thumb_w, self.thumb_h = thumb_size
+        self.item_w, self.item_h = item_size
+        self.step = self.item_h if self.vertical else self.item_w   # スクロール方向の1行の長さ
+        self.overscan = overscan; self.slot_pad = slot_pad
+        self.normal_style = normal_style or {"border_color": bg, "border_width": 2}
+        self.current_style = current_style or {"border_color": COLOR_HIGHLIGHT, "border_width": 2}
+        self.slot_color = slot_color; self.thumb_bg = thumb_bg; self.label_font = label_font; self.label_color = label_color
+        self.count = 0; self.current = -1
+        self.slots = []   # {"frame", "canvas", "label", "window", "index", "sig", "current"}
+
+        if self.vertical:
+            self.canvas = tk.Canvas(self, bg=bg, highlightthickness=0, yscrollincrement=self.step)
+            self.scrollbar = ctk.CTkScrollbar(self, orientation="vertical", command=self._on_scrollbar)
+            self.scrollbar.pack(fill="y", side="right")
+            self.canvas.pack(fill="both", expand=True, side="left")
+            self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        else:
+            self.canvas = tk.Canvas(self, height=self.item_h, bg=bg, highlightthickness=0, xscrollincrement=self.step)
+            self.canvas.pack(fill="x", side="top")
+            self.scrollbar = ctk.CTkScrollbar(self, orientation="horizontal", command=self._on_scrollbar)
+            self.scrollbar.pack(fill="x", side="bottom")
+            self.canvas.configure(xscrollcommand=self.scrollbar.set)
+        self.canvas.bind("<Configure>", lambda e: self._layout())
+        self._bind_wheel(self.canvas)
+
+    def set_count(self, count, redraw=False):
+        """項目数を設定する。redraw なら表示中の枠をすべて描き直す"""
+        self.count = count
+        if redraw:
+            for slot in self.slots: slot["index"] = None
+        lines = -(-count // self.columns)
+        if self.vertical: region = (0, 0, self.columns * self.item_w, max(1, lines * self.step))
+        else: region = (0, 0, max(1, lines * self.step), self.item_h)
+        self.canvas.configure(scrollregion=region)
+        self._layout()
+
+    def refresh(self, indices=None):
+        """表示中の枠のうち indices（None なら全部）を描き直す"""
+        for slot in self.slots:
+            if indices is None or slot["index"] in indices: slot["index"] = None
+        self._layout()
+
+    def set_current(self, index, scroll=True):
+        """index を強調表示し、scroll なら表示範囲の中央に来るようにスクロールする"""
+        self.current = index
+        if scroll and 0 <= index < self.count:
+            try:
+                view = self.canvas.winfo_height() if self.vertical else self.canvas.winfo_width()
+                total = -(-self.count // self.columns) * self.step
+                start = (index // self.columns + 0.5) * self.step - view / 2
+                frac = max(0.0, min(1.0, start / total))
+                if self.vertical: self.canvas.yview_moveto(frac)
+                else: self.canvas.xview_moveto(frac)
+            except: pass
+        self._layout()
+
+    def visible_items(self):
+        """枠に描かれている (index, canvas) の一覧"""
+        return [(s["index"], s["canvas"]) for s in self.slots if s["index"] is not None]
+
+    def visible_range(self):
+        """枠を割り当てる項目の範囲 [first, last)"""
+        try:
+            if self.vertical: start = self.canvas.canvasy(0); view = self.canvas.winfo_height()
+            else: start = self.canvas.canvasx(0); view = self.canvas.winfo_width()
+            view = max(view, self.step)
+        except: start, view = 0, self.step * 8
+        first = max(0, int(start // self.step) - self.overscan)
+        last = int((start + view) // self.step) + 1 + self.overscan
+        return first * self.columns, max(first * self.columns, min(self.count, last * self.columns))
+
+    def _layout(self):
+        first, last = self.visible_range()
+        wanted = range(first, last)
+        # 範囲から外れた枠を空きにし、足りなければ作る
+        free = [s for s in self.slots if s["index"] is None or s["index"] not in wanted]
+        shown = {s["index"]: s for s in self.slots if s not in free}
+        while len(self.slots) < len(wanted):
+            slot = self._create_slot(); self.slots.append(slot); free.append(slot)
+        
+        for index in wanted:
+            sig = self.signature(index)
+            slot = shown.get(index)
+            if slot is None:
+                slot = free.pop()
+                slot["index"] = index; dirty = True
+                line, col = divmod(index, self.columns)
+                x, y = (col * self.item_w, line * self.step) if self.vertical else (line * self.step, 0)
+                self.canvas.coords(slot["window"], x + self.slot_pad, y + self.slot_pad)
+                self.canvas.itemconfigure(slot["window"], state="normal")
+            else:
+                dirty = slot["sig"] != sig
+            if dirty:
+                slot["sig"] = sig
+                if slot["label"] is not None: slot["label"].configure(text=self.label_of(index))
+                self.draw_item(slot["canvas"], index)
+            is_current = index == self.current
+            if slot["current"] != is_current:
+                slot["current"] = is_current
+                slot["frame"].configure(**(self.current_style if is_current else self.normal_style))
+        for slot in free:
+            if slot["index"] is not None or slot["sig"] is not None:
+                slot["index"] = None; slot["sig"] = None
+                self.release_item(slot["canvas"])
+            self.canvas.itemconfigure(slot["window"], state="hidden")
+
+    def _create_slot(self):
+        frame = ctk.CTkFrame(self.canvas, fg_color=self.slot_color, **self.normal_style)
+        cv = tk.Canvas(frame, width=self.thumb_w, height=self.thumb_h, bg=self.thumb_bg, highlightthickness=0)
+        cv.pack(padx=2 + self.slot_pad // 3, pady=2 + self.slot_pad // 3)
+        lbl = None
+        if self.label_of is not None:
+            lbl = ctk.CTkLabel(frame, text="", font=self.label_font, text_color=self.label_color)
+            lbl.pack(pady=self.slot_pad // 3)
+        slot = {"frame": frame, "canvas": cv, "label": lbl, "index": None, "sig": None, "current": False}
+        slot["window"] = self.canvas.create_window(0, 0, window=frame, anchor="nw", width=self.item_w - 4 - 2 * self.slot_pad)
+        for w in filter(None, (frame, cv, lbl)):
+            w.bind("<Button-1>", lambda e, s=slot: s["index"] is not None and self.on_click(s["index"]))
+            self._bind_wheel(w)
+        return slot
+
     @staticmethod
-    def get_layout_rects(name): return LayoutManager.LAYOUTS.get(name, [(0,0,1,1)])
+    def _release_canvas(canvas):
+        # 描画と PhotoImage の参照を手放し、load_token を消して待っている読み込み要求も無効にする
+        canvas.delete("all"); canvas.keep_refs = []; canvas.load_token = None
+
+    def _bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", lambda e: self._scroll(-1 if e.delta > 0 else 1))
+        widget.bind("<Shift-MouseWheel>", lambda e: self._scroll(-1 if e.delta > 0 else 1))
+        widget.bind("<Button-4>", lambda e: self._scroll(-1))
+        widget.bind("<Button-5>", lambda e: self._scroll(1))
+
+    def _scroll(self, units):
+        if self.vertical: self.canvas.yview_scroll(units, "units")
+        else: self.canvas.xview_scroll(units, "units")
+        self._layout()
+
+    def _on_scrollbar(self, *args):
+        if self.vertical: self.canvas.yview(*args)
+        else: self.canvas.xview(*args)
+        self._layout()
 
 # --- HBS Viewer Class (Integrated) ---
 class HBSViewer(ctk.CTkToplevel):
-    def __init__(self, parent=None, project_data=None):
+    def __init__(self, parent=None, project_data=None, decode_workers=0, use_processes=False, use_proxies=True):
         super().__init__(parent)
         self.title("HomeBook Viewer v5.0")
         self.geometry("1400x950")
@@ -159,15 +268,23 @@ class HBSViewer(ctk.CTkToplevel):
         self.is_running = True
 
         # Cache & Async Loader
-        # cache stores ImageTk.PhotoImage directly
-        self.image_cache = {}
-        self.load_queue = queue.PriorityQueue()
+        # cache stores ImageTk.PhotoImage directly (LRU, VIEWER_CACHE_MB まで)
+        # 要求の表示先は (canvas, token, item_id, ページ番号, サムネイルか)。キャンバスを描き直すと token が変わり、古い要求は捨てられる
+        self.image_cache = collections.OrderedDict(); self.image_cache_bytes = 0
+        self.load_queue = ImageLoadQueue()
         self.task_counter = itertools.count() 
 
-        self.mini_thumb_frames = {} 
+        # ミニビューアー・一覧に並べる見開き（ページ番号のリスト）。枠は見えている分だけ ThumbnailView が作って使い回す
+        self.mini_spreads = []
 
-        self.loader_thread = threading.Thread(target=self._image_loader_worker, daemon=True)
-        self.loader_thread.start()
+        # 読み込みスレッドを複数立てて、同じ待ち行列から優先度順に取り出させる。
+        # use_processes のときはデコード自体をプロセスプールで行い、スレッドは結果を待って受け渡すだけにする
+        n_loaders = resolve_worker_count(decode_workers, os.cpu_count() or 1)
+        # スタジオの読み込みスレッドと Tk が動いている中で起動するので、ロックを抱えたまま fork しないよう spawn にする
+        self.decode_pool = ProcessPoolExecutor(max_workers=n_loaders, mp_context=multiprocessing.get_context("spawn")) if use_processes else None
+        self.use_proxies = use_proxies # 写真はディスクのプロキシキャッシュ経由で読む
+        self.loader_threads = [threading.Thread(target=self._image_loader_worker, daemon=True) for _ in range(n_loaders)]
+        for t in self.loader_threads: t.start()
 
         self._build_ui()
         self._bind_events()
@@ -184,6 +301,7 @@ class HBSViewer(ctk.CTkToplevel):
 
     def destroy(self):
         self.is_running = False
+        if self.decode_pool is not None: self.decode_pool.shutdown(wait=False, cancel_futures=True)
         super().destroy()
 
     def update_project_data(self, project_obj):
@@ -238,56 +356,67 @@ class HBSViewer(ctk.CTkToplevel):
 
     def _image_loader_worker(self):
         """
-        画像を別スレッドでロードし、PILオブジェクトを作成する。
+        画像を別スレッドでロードし、PILオブジェクトを作成する（このスレッドは複数動く）。
         ImageTkへの変換はメインスレッドで行うことで、表示バグを防ぐ。
         """
         while self.is_running:
             try:
-                priority, _, req = self.load_queue.get(timeout=0.1)
-                
-                canvas, tag_id, path, w, h, rotation = req
-                cache_key = (path, w, h, rotation)
-                
-                # キャッシュにあれば即座に適用（通常ここには来ないが念のため）
-                if cache_key in self.image_cache:
-                    tk_img = self.image_cache[cache_key]
-                    self.after(0, lambda c=canvas, t=tag_id, img=tk_img: self._set_image_on_canvas(c, t, img))
-                    self.load_queue.task_done()
-                    continue
+                job = self.load_queue.get(timeout=0.1, is_live=self._is_load_target_live)
+                if job is None: continue
+                cache_key, (path, w, h, rotation, crop) = job
 
                 pil_img = None
                 if os.path.exists(path):
                     try:
-                        pil = Image.open(path)
-                        if rotation: pil = pil.rotate(-rotation, expand=True)
                         # Mini Viewerなどでサイズが極端に小さい場合のエラー回避
                         w = max(1, int(w))
                         h = max(1, int(h))
-                        pil.thumbnail((w, h), Image.LANCZOS)
-                        pil_img = pil
+                        if self.decode_pool is not None:
+                            pil_img = self.decode_pool.submit(decode_proxy, path, (w, h), rotation, resample=Image.LANCZOS, crop=crop,
+                                                              use_cache=self.use_proxies).result()
+                        else:
+                            pil_img = decode_proxy(path, (w, h), rotation, resample=Image.LANCZOS, crop=crop, use_cache=self.use_proxies)
                     except: pass
                 
-                # メインスレッドで ImageTk に変換して描画
+                # メインスレッドで ImageTk に変換して描画（デコード中に合流した表示先にもまとめて渡す）
+                targets = self.load_queue.done(cache_key)
                 if pil_img:
-                    self.after(0, lambda c=canvas, t=tag_id, p=pil_img, k=cache_key: self._update_canvas_image(c, t, p, k))
-                
-                self.load_queue.task_done()
-            except queue.Empty:
-                continue
+                    self.after(0, lambda ts=targets, p=pil_img, k=cache_key: self._update_canvas_image(ts, p, k))
             except Exception as e:
                 # print(f"Loader error: {e}")
                 pass
 
-    def _update_canvas_image(self, canvas, tag_id, pil_img, cache_key):
-        """メインスレッドで実行: PIL画像をImageTkに変換してキャッシュし、Canvasにセット"""
+    @staticmethod
+    def _is_load_target_live(target):
+        # ローダースレッドから呼ばれるので Tk には触れず、キャンバスの token だけを見る
+        canvas, token = target[0], target[1]
+        return getattr(canvas, "load_token", None) == token
+
+    def _load_priority(self, target):
+        """表示中の見開きが最優先。サムネイルは表示中のページに近いものから"""
+        p_idx, is_thumbnail = target[3], target[4]
+        if not is_thumbnail: return 0
+        return 1 + abs(p_idx - self.current_page_idx) // 2
+
+    def _update_canvas_image(self, targets, pil_img, cache_key):
+        """メインスレッドで実行: PIL画像をImageTkに変換してキャッシュし、まだ有効な表示先のCanvasにセット"""
         try:
             tk_img = ImageTk.PhotoImage(pil_img)
-            self.image_cache[cache_key] = tk_img
-            self._set_image_on_canvas(canvas, tag_id, tk_img)
+            self._cache_image(cache_key, tk_img, pil_img.width * pil_img.height * 4)
+            for target in targets:
+                if self._is_load_target_live(target): self._set_image_on_canvas(target[0], target[2], tk_img)
         except Exception as e:
             # ウィンドウが閉じられた場合などに発生するエラーを無視
             pass
 
+    def _cache_image(self, cache_key, tk_img, nbytes):
+        old = self.image_cache.pop(cache_key, None)
+        if old is not None: self.image_cache_bytes -= old[1]
+        self.image_cache[cache_key] = (tk_img, nbytes); self.image_cache_bytes += nbytes
+        # 表示中のキャンバスは keep_refs で参照を持っているので、ここで捨てても消えるのは画面にない画像だけ
+        while self.image_cache_bytes > VIEWER_CACHE_MB * 1024 * 1024 and len(self.image_cache) > 1:
+            self.image_cache_bytes -= self.image_cache.popitem(last=False)[1][1]
+
     def _set_image_on_canvas(self, canvas, tag_id, tk_img):
         """実際にCanvasアイテムを更新する"""
         try:
@@ -377,7 +506,13 @@ class HBSViewer(ctk.CTkToplevel):
         self.canvas.pack(fill="both", expand=True)
         self.canvas.bind("<Configure>", lambda e: self._delayed_redraw())
 
-        self.grid_view_frame = ctk.CTkScrollableFrame(self.center_container, orientation="vertical", fg_color=COLOR_BG_SEC)
+        # 一覧は見えている行（と前後2行）の分だけ枠を作り、スクロールに合わせて使い回す
+        self.grid_view_frame = ThumbnailView(self.center_container, self._draw_grid_item, lambda s: self._jump_to_page(self.mini_spreads[s][0]),
+                                             self._grid_label, signature=self._mini_signature,
+                                             orientation="vertical", columns=3,
+                                             thumb_size=(320, 200), item_size=(370, 285), overscan=2, slot_pad=15,
+                                             normal_style={"border_color": "#444", "border_width": 1}, current_style={"border_color": "#444", "border_width": 1},
+                                             slot_color=COLOR_BG_TER, thumb_bg="#333", label_font=self.ui_font_bold, label_color=COLOR_FG_TEXT, bg=COLOR_BG_SEC)
 
         # --- FOOTER ---
         self.footer_area = ctk.CTkFrame(self, fg_color=COLOR_BG_MAIN, corner_radius=0)
@@ -408,8 +543,11 @@ class HBSViewer(ctk.CTkToplevel):
         self.btn_next.pack(side="left", padx=5)
 
         # Mini Viewer Area
-        self.mini_viewer_frame = ctk.CTkScrollableFrame(self.footer_area, orientation="horizontal", height=110, fg_color=COLOR_BG_TER)
-        self.mini_viewer_frame.pack(fill="x", padx=0, pady=0)
+        self.mini_strip = ThumbnailView(self.footer_area, self._draw_mini_item, lambda s: self._jump_to_page(self.mini_spreads[s][0]),
+                                        self._mini_label, signature=self._mini_signature,
+                                        normal_style={"border_color": COLOR_BG_TER, "border_width": 2},
+                                        current_style={"border_color": COLOR_ORANGE_MAIN, "border_width": 2})
+        self.mini_strip.pack(fill="x", padx=0, pady=0)
         
         self.redraw_timer = None
 
@@ -477,31 +615,11 @@ class HBSViewer(ctk.CTkToplevel):
         if not path: return
         
         try:
-            self.image_cache.clear()
-            try:
-                while not self.load_queue.empty():
-                    self.load_queue.get_nowait()
-                    self.load_queue.task_done() 
-            except: pass
+            self.image_cache.clear(); self.image_cache_bytes = 0
+            self.load_queue.clear()
 
-            with open(path, "r", encoding="utf-8") as f: data = json.load(f)
-            
-            # Use safe get with defaults corresponding to HBS.py structure
-            self.project = Project(
-                paper_size=data.get("paper_size", "A4"), orientation=data.get("orientation", "Portrait"),
-                margin_top=data.get("margin_top", 15.0), margin_bottom=data.get("margin_bottom", 15.0),
-                margin_inner=data.get("margin_inner", 20.0), margin_outer=data.get("margin_outer", 15.0),
-                pages=[]
-            )
-            for p in data.get("pages", []):
-                pg = Page(layout_name=p.get("layout_name", "1枚 (全面)"), spacing_mm=p.get("spacing_mm", 0.0), 
-                          background_color=p.get("background_color", "#FFFFFF"), custom_margins=p.get("custom_margins"))
-                for ph in p.get("photos", []):
-                    pg.photos.append(PhotoItem(path=ph["path"], slot_index=ph.get("slot_index", 0), rotation=ph.get("rotation", 0)))
-                for txt in p.get("texts", []):
-                    pg.texts.append(TextItem(text=txt["text"], x_rel=txt["x_rel"], y_rel=txt["y_rel"], font_size=txt.get("font_size", 40), 
-                                           color=txt.get("color", "black"), rotation=txt.get("rotation", 0)))
-                self.project.pages.append(pg)
+            # スタジオ・書き出しと同じ読み込み（クロップやフォントも含めて読む）
+            self.project = load_project_file(path)
 
             self.lbl_filename.configure(text=os.path.basename(path), text_color=COLOR_FG_TEXT)
             self.btn_grid.configure(state="normal")
@@ -528,11 +646,17 @@ class HBSViewer(ctk.CTkToplevel):
         w = self.canvas.winfo_width()
         h = self.canvas.winfo_height()
         if w < 10: return
-        self._draw_pages_on_canvas(self.canvas, self.current_page_idx, w, h, is_thumbnail=False, priority=0)
+        self._draw_pages_on_canvas(self.canvas, self.current_page_idx, w, h, is_thumbnail=False)
+        # 表示ページが変わったら、待っているサムネイルを新しい表示位置に近い順に並べ直す
+        self.load_queue.reprioritize(self._load_priority)
 
-    def _draw_pages_on_canvas(self, target_canvas: Canvas, start_idx: int, w: int, h: int, is_thumbnail: bool, priority: int):
+    def _draw_pages_on_canvas(self, target_canvas: Canvas, start_idx: int, w: int, h: int, is_thumbnail: bool):
         target_canvas.delete("all")
         target_canvas.keep_refs = [] 
+        # 描き直すたびに token を更新し、前回の描画で出した読み込み要求を無効にする
+        if not hasattr(target_canvas, "load_token"):
+            target_canvas.bind("<Destroy>", lambda e, c=target_canvas: setattr(c, "load_token", None), add="+")
+        target_canvas.load_token = token = next(self.task_counter)
         
         size_key = self.project.paper_size if self.project.paper_size in PAPER_SIZES else "A4"
         pw_mm, ph_mm = PAPER_SIZES[size_key]
@@ -646,13 +770,15 @@ class HBSViewer(ctk.CTkToplevel):
                     
                     photo = next((p for p in page.photos if p.slot_index == r_idx), None)
                     if photo:
-                        cache_key = (photo.path, slot_w, slot_h, photo.rotation)
+                        cache_key = (photo.path, slot_w, slot_h, photo.rotation, crop_key(photo.crop))
                         if cache_key in self.image_cache:
-                            img = self.image_cache[cache_key]
+                            self.image_cache.move_to_end(cache_key)
+                            img = self.image_cache[cache_key][0]
                             target_canvas.itemconfig(placeholder_id, image=img)
                             target_canvas.keep_refs.append(img)
                         elif os.path.exists(photo.path):
-                            self.load_queue.put((priority, next(self.task_counter), (target_canvas, placeholder_id, photo.path, slot_w, slot_h, photo.rotation)))
+                            target = (target_canvas, token, placeholder_id, p_idx, is_thumbnail)
+                            self.load_queue.put(cache_key, (photo.path, slot_w, slot_h, photo.rotation, photo.crop), target, self._load_priority(target))
                         else:
                             target_canvas.create_text(sx+slot_w/2, sy+slot_h/2, text="!", fill="red")
 
@@ -699,53 +825,33 @@ class HBSViewer(ctk.CTkToplevel):
         else:
             self.btn_grid.configure(text="田 一覧", fg_color="transparent", text_color=COLOR_FG_TEXT)
             self.grid_view_frame.pack_forget()
+            # 一覧を閉じたら枠の中身を手放す（次に開いたときに見えている行だけ描き直す）
+            self.grid_view_frame.set_count(0)
             self.single_view_frame.pack(fill="both", expand=True)
             self._draw_main_view()
 
     def _fill_grid(self):
-        for w in self.grid_view_frame.winfo_children(): w.destroy()
-        
-        total_pages = len(self.project.pages)
-        spreads = []
-        
-        if self.is_cover_mode:
-            spreads.append([0])
-            for i in range(1, total_pages, 2):
-                if i+1 < total_pages: spreads.append([i, i+1])
-                else: spreads.append([i])
-        else:
-            for i in range(0, total_pages, 2):
-                if i+1 < total_pages: spreads.append([i, i+1])
-                else: spreads.append([i])
+        # 見開きの並びはミニビューアーと共通。描くのは見えている行だけで、内容が変わった枠は署名で検出して描き直す
+        self.grid_view_frame.set_count(len(self.mini_spreads))
 
-        cols = 3
-        
-        for s_idx, pages in enumerate(spreads):
-            row, col = s_idx // cols, s_idx % cols
-            frame = ctk.CTkFrame(self.grid_view_frame, fg_color=COLOR_BG_TER, border_width=1, border_color="#444")
-            frame.grid(row=row, column=col, padx=15, pady=15, sticky="nsew")
-            
-            cv = Canvas(frame, width=320, height=200, bg="#333", highlightthickness=0)
-            cv.pack(padx=5, pady=5)
-            
-            p_start = pages[0]
-            self._draw_pages_on_canvas(cv, p_start, 320, 200, is_thumbnail=True, priority=1)
-            
-            cv.bind("<Button-1>", lambda e, idx=p_start: self._jump_to_page(idx))
-            
-            lbl_txt = f"Page {pages[0]+1}"
-            if len(pages) > 1: lbl_txt += f" - {pages[1]+1}"
-            
-            ctk.CTkLabel(frame, text=lbl_txt, font=self.ui_font_bold, text_color=COLOR_FG_TEXT).pack(pady=5)
+    def _grid_label(self, s_idx):
+        pages = self.mini_spreads[s_idx]
+        return f"Page {pages[0]+1}" + (f" - {pages[1]+1}" if len(pages) > 1 else "")
+
+    def _draw_grid_item(self, canvas, s_idx):
+        self._draw_pages_on_canvas(canvas, self.mini_spreads[s_idx][0], 320, 200, is_thumbnail=True)
 
     def _init_grid_view(self):
         pass
 
     # --- Mini Viewer & Sync Logic ---
     def _init_mini_viewer(self):
-        for w in self.mini_viewer_frame.winfo_children(): w.destroy()
-        self.mini_thumb_frames = {} 
-        if not self.project: return
+        """ミニビューアーを現在のプロジェクトに合わせる。
+        表示中の枠のうち、表示内容（ページ番号・用紙・各ページの署名）が変わった見開きだけ描き直す"""
+        if not self.project:
+            self.mini_spreads = []
+            self.mini_strip.set_count(0)
+            return
         
         total_pages = len(self.project.pages)
         spreads = []
@@ -756,25 +862,20 @@ class HBSViewer(ctk.CTkToplevel):
         else:
             for i in range(0, total_pages, 2):
                 spreads.append([i] if i+1 >= total_pages else [i, i+1])
-        
-        for s_idx, pages in enumerate(spreads):
-            frame = ctk.CTkFrame(self.mini_viewer_frame, fg_color="transparent", border_width=2, border_color=COLOR_BG_TER)
-            frame.pack(side="left", padx=2, pady=5)
-            
-            self.mini_thumb_frames[tuple(pages)] = frame 
-            
-            cv = Canvas(frame, width=120, height=80, bg="#222", highlightthickness=0)
-            cv.pack(padx=2, pady=2)
-            
-            p_start = pages[0]
-            self._draw_pages_on_canvas(cv, p_start, 120, 80, is_thumbnail=True, priority=1)
-            
-            cv.bind("<Button-1>", lambda e, idx=p_start: self._jump_to_page(idx))
-            frame.bind("<Button-1>", lambda e, idx=p_start: self._jump_to_page(idx))
-            
-            lbl_txt = f"{pages[0]+1}"
-            if len(pages) > 1: lbl_txt += f"-{pages[1]+1}"
-            ctk.CTkLabel(frame, text=lbl_txt, font=("Arial", 10), text_color=COLOR_FG_DIM).pack()
+        self.mini_spreads = spreads
+        self.mini_strip.set_count(len(spreads))
+
+    def _mini_signature(self, s_idx):
+        pr = self.project; pages = self.mini_spreads[s_idx]
+        layout = (pr.paper_size, pr.orientation, pr.margin_top, pr.margin_bottom, pr.margin_inner, pr.margin_outer, self.is_single_view)
+        return (layout, tuple(pages), tuple(page_signature(pr.pages[p]) for p in pages))
+
+    def _mini_label(self, s_idx):
+        pages = self.mini_spreads[s_idx]
+        return f"{pages[0]+1}" + (f"-{pages[1]+1}" if len(pages) > 1 else "")
+
+    def _draw_mini_item(self, canvas, s_idx):
+        self._draw_pages_on_canvas(canvas, self.mini_spreads[s_idx][0], 120, 80, is_thumbnail=True)
 
     # --- Feature: Page Jump (Inline) ---
     def _on_page_entry_submit(self, event=None):
@@ -876,30 +977,8 @@ class HBSViewer(ctk.CTkToplevel):
         self.lbl_page_total.configure(text=f"/ {total}")
 
         # Mini Viewer Sync
-        total_items = len(self.mini_thumb_frames)
-        current_item_index = 0
-        
-        for i, (pages, frame) in enumerate(self.mini_thumb_frames.items()):
-            if idx in pages:
-                frame.configure(border_color=COLOR_ORANGE_MAIN)
-                current_item_index = i
-            else:
-                frame.configure(border_color=COLOR_BG_TER)
-        
-        if total_items > 1:
-            try:
-                canvas = self.mini_viewer_frame._parent_canvas
-                visible_width = canvas.winfo_width()
-                scroll_region = canvas.bbox("all")
-                if scroll_region:
-                    content_width = scroll_region[2]
-                    item_center_ratio = (current_item_index + 0.5) / total_items
-                    target_center_px = item_center_ratio * content_width
-                    desired_left_px = target_center_px - (visible_width / 2)
-                    fraction = desired_left_px / content_width
-                    fraction = max(0.0, min(1.0, fraction))
-                    canvas.xview_moveto(fraction)
-            except: pass
+        current_item_index = next((i for i, pages in enumerate(self.mini_spreads) if idx in pages), -1)
+        self.mini_strip.set_current(current_item_index, scroll=len(self.mini_spreads) > 1)
 
     # --- Slideshow ---
     def _toggle_slideshow(self):
@@ -944,11 +1023,10 @@ class HomeBookStudio(ctk.CTk):
         self.geometry("1600x1000")
         
         # Load Config
-        self.config_data = DEFAULT_CONFIG.copy()
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, "r") as f: self.config_data.update(json.load(f))
-            except: pass
+        self.config_data = load_config()
+        # 写真の表示はディスクのプロキシキャッシュ経由（設定で切ったときは毎回元画像から読む）
+        self.use_proxies = self.config_data.get("proxy_cache", True)
+        if self.use_proxies: get_proxy_store(self.config_data.get("proxy_cache_mb", 2048))
             
         ctk.set_appearance_mode("Dark")
         ctk.set_default_color_theme("dark-blue")
@@ -969,10 +1047,26 @@ class HomeBookStudio(ctk.CTk):
         )
         self.project.pages = [Page(), Page()] 
 
-        self.history_stack = []; self.redo_stack = []
-        self.image_library = []; self.thumbnails_cache = {}; self.thumb_btns = {}
-        self.preview_image_cache = {}; self.mini_img_cache = {}; self.mini_canvas_refs = {}
-        self.last_highlighted_mini_index = -1 
+        self.history = ProjectHistory(self.project) # 元に戻す/やり直し（変わったページだけを記録する）
+        self.image_library = []
+        self.library_index = {}; self.library_counts = {} # パス -> 一覧での位置 / 使用枚数（バッジを描いた値）
+        # 写真フォルダは別スレッドで走査して見つかった分から一覧に加え、終わったら変更を定期的に確認する。
+        # フォルダを選び直すと token が変わり、前の走査・確認の結果は捨てられる
+        self.library_scanner = None; self.library_scan_token = 0; self.library_poll_timer = None
+        # プレビューの写真: (path, 幅, 高さ, 回転, クロップ) -> (PhotoImage, バイト数) の LRU。表示中の画像は _draw_refs でも参照する
+        self.preview_image_cache = collections.OrderedDict(); self.preview_image_cache_bytes = 0
+        # ミニサムネイルは別スレッド（複数）でデコードし、届いたものから枠に入れる。
+        # キャッシュは (path, rotation, crop, 切り上げた幅, 高さ) -> PIL 画像 の LRU（写真一覧は ("library", path)）。要求の表示先は (canvas, token, 仮枠, 画像アイテム, 幅, 高さ)
+        self.mini_img_cache = collections.OrderedDict()
+        self.mini_queue = ImageLoadQueue(); self.mini_task_counter = itertools.count()
+        for _ in range(resolve_worker_count(0, 4)): threading.Thread(target=self._mini_loader_worker, daemon=True).start()
+        self.preview_text_cache = collections.OrderedDict() # TextSpriteCache.key -> PhotoImage (LRU)
+        # プレビュー写真の非同期デコード。表示中の見開き・キャンバスサイズが変わると世代を進め、古い要求は捨てる
+        # 要求の表示先は ("view", 世代) か ("prefetch", 先読みトークン)。表示中のスロットを先読みより優先する
+        self.preview_view = None; self.preview_generation = 0; self.preview_pending = set()
+        self.preview_queue = ImageLoadQueue()
+        self.preview_nav_dir = 1; self.prefetch_token = 0; self.prefetch_timer = None
+        threading.Thread(target=self._preview_loader_worker, daemon=True).start()
         self.drag_data = {"path": None, "item": None, "start_x": 0, "start_y": 0}
         self.selected_item = None; self.selected_item_page_idx = -1
         self.is_text_mode = False; self.ignore_ui_callbacks = False
@@ -982,7 +1076,8 @@ class HomeBookStudio(ctk.CTk):
 
         self.is_cover_mode = self.config_data.get("startup_cover_mode", False)
         
-        self.mini_thumb_frames = {} 
+        self.mini_spreads = [] # ミニビューアーに並べる見開き（ページ番号のリスト）
+        self.nav_btns = []; self.nav_btns_key = None; self.nav_current = -1 # 見開きリストのボタン（作り直しを避けるため保持）
         self.current_project_path = None
         self.auto_save_timer = None
         
@@ -1042,28 +1137,24 @@ class HomeBookStudio(ctk.CTk):
         if interval_ms > 0:
             self.auto_save_timer = self.after(interval_ms, self._auto_save_loop)
 
-    def _save_history(self):
-        self.history_stack.append(copy.deepcopy(self.project))
-        self.redo_stack.clear()
-        if len(self.history_stack) > 30: self.history_stack.pop(0)
+    def _save_history(self, group=None):
+        """編集の直前に呼ぶ。group が同じ呼び出しが続く間（スライダーやドラッグ）は1つの履歴になる"""
+        self.history.checkpoint(group)
 
     def _undo(self):
-        if not self.history_stack: return
-        self.redo_stack.append(copy.deepcopy(self.project))
-        self.project = self.history_stack.pop()
-        self.selected_item = None
-        self.preview_image_cache.clear()
-        self._refresh_ui_from_project(rebuild_mode="full")
-        self._refresh_thumbnails() # Undo時にも枚数カウント更新
+        if self.history.undo(): self._after_history_change()
 
     def _redo(self):
-        if not self.redo_stack: return
-        self.history_stack.append(copy.deepcopy(self.project))
-        self.project = self.redo_stack.pop()
+        if self.history.redo(): self._after_history_change()
+
+    def _after_history_change(self):
         self.selected_item = None
-        self.preview_image_cache.clear()
+        max_spread = (len(self.project.pages) // 2) + (1 if self.is_cover_mode else 0)
+        if self.project.current_spread_index >= max_spread:
+            self.project.current_spread_index = max(0, max_spread - 1)
+        # プレビューの画像キャッシュは写真・大きさ・回転・クロップがキーなので消さなくてよい
         self._refresh_ui_from_project(rebuild_mode="full")
-        self._refresh_thumbnails() # Redo時にも枚数カウント更新
+        self._refresh_thumbnails() # Undo/Redo時にも枚数カウント更新
 
     # --- UI Construction ---
     def _build_menu_bar(self):
@@ -1176,9 +1267,12 @@ class HomeBookStudio(ctk.CTk):
         self.tab_settings = self.sidebar_tabs.add("設定")
 
         ctk.CTkButton(self.tab_imgs, text="フォルダ選択", font=self.ui_font, command=self._select_folder, height=28, fg_color=COLOR_ORANGE_MAIN, hover_color=COLOR_ORANGE_HOVER, text_color=COLOR_FG_TEXT).pack(fill="x", padx=5, pady=5)
-        self.scroll_thumbs = ctk.CTkScrollableFrame(self.tab_imgs, fg_color="transparent")
-        self.scroll_thumbs.pack(fill="both", expand=True, padx=0, pady=2)
-        self.scroll_thumbs.grid_columnconfigure(0, weight=1); self.scroll_thumbs.grid_columnconfigure(1, weight=1); self.scroll_thumbs.grid_columnconfigure(2, weight=1)
+        # 写真一覧は見えている行の分だけ枠を作る（サムネイルはミニビューアーと同じ読み込みスレッドで作る）
+        self.library_view = ThumbnailView(self.tab_imgs, self._draw_library_item, lambda i: self._on_thumb_click(self.image_library[i]), None,
+                                          orientation="vertical", columns=3, thumb_size=(80, 80), item_size=(88, 88), overscan=2,
+                                          normal_style={"border_color": COLOR_FG_TEXT, "border_width": 0},
+                                          current_style={"border_color": COLOR_FG_TEXT, "border_width": 2}, thumb_bg=COLOR_BG_SEC, bg=COLOR_BG_SEC)
+        self.library_view.pack(fill="both", expand=True, padx=0, pady=2)
 
         self._build_layout_tab()
         self._build_settings_tab()
@@ -1234,8 +1328,10 @@ class HomeBookStudio(ctk.CTk):
         # Mini Viewer
         self.mini_viewer_container = ctk.CTkFrame(self, height=140, fg_color=COLOR_BG_TER, corner_radius=0)
         self.mini_viewer_container.grid(row=3, column=0, sticky="ew")
-        self.mini_viewer_scroll = ctk.CTkScrollableFrame(self.mini_viewer_container, orientation="horizontal", height=120, fg_color="transparent")
-        self.mini_viewer_scroll.pack(fill="both", expand=True, padx=5, pady=5)
+        self.mini_strip = ThumbnailView(self.mini_viewer_container, self._draw_mini_item, self._jump_spread, self._mini_label,
+                                        signature=self._mini_signature, item_size=(132, 112), normal_style={"border_color": "#1a1a1a", "border_width": 2},
+                                        current_style={"border_color": COLOR_HIGHLIGHT, "border_width": 3})
+        self.mini_strip.pack(fill="both", expand=True, padx=5, pady=5)
 
         # Footer
         footer = ctk.CTkFrame(self, height=40, fg_color=COLOR_BG_MAIN, corner_radius=0)
@@ -1244,7 +1340,7 @@ class HomeBookStudio(ctk.CTk):
         opt_frame = ctk.CTkFrame(footer, fg_color="transparent")
         opt_frame.pack(side="left", padx=10)
         opt_style = {"width": 80, "height": 24, "font": self.ui_font_sm, "fg_color": COLOR_BTN_NORM, "button_color": COLOR_BTN_HOVER, "button_hover_color": COLOR_ORANGE_MAIN, "text_color": COLOR_FG_TEXT}
-        ctk.CTkOptionMenu(opt_frame, values=["PDF", "JPG"], variable=self.var_output_fmt, **opt_style).pack(side="left", padx=2)
+        ctk.CTkOptionMenu(opt_frame, values=EXPORT_FORMATS, variable=self.var_output_fmt, **opt_style).pack(side="left", padx=2)
         chk_style = {"font": self.ui_font_sm, "text_color": COLOR_FG_DIM, "hover_color": COLOR_ORANGE_MAIN, "fg_color": COLOR_FG_TEXT, "checkmark_color": COLOR_BG_MAIN}
         ctk.CTkCheckBox(opt_frame, text="逆順", variable=self.var_rev_back, **chk_style, width=50).pack(side="left", padx=10)
         ctk.CTkCheckBox(opt_frame, text="180°", variable=self.var_rot_back, **chk_style, width=50).pack(side="left", padx=5)
@@ -1350,19 +1446,20 @@ class HomeBookStudio(ctk.CTk):
                 margin_outer=self.config_data.get("default_margin_outer", 15.0)
             )
             self.project.pages = [Page(layout_name="1枚 (全面)"), Page(layout_name="1枚 (全面)")]
-            self.history_stack.clear(); self.redo_stack.clear()
-            self.image_library = []; self.thumbnails_cache = {}; self.preview_image_cache.clear()
-            for w in self.scroll_thumbs.winfo_children(): w.destroy()
+            self.history.reset(self.project)
+            self._stop_library_scan()
+            self.image_library = []; self.library_index = {}; self.library_counts = {}; self._clear_preview_cache()
+            self.library_view.set_count(0)
             self._refresh_ui_from_project("full")
 
     def _open_preferences(self):
         top = ctk.CTkToplevel(self)
         top.title("環境設定")
-        top.geometry("500x500") 
+        top.geometry("500x640") 
         
         self.update_idletasks()
         x = self.winfo_x() + (self.winfo_width() // 2) - 250
-        y = self.winfo_y() + (self.winfo_height() // 2) - 250
+        y = self.winfo_y() + (self.winfo_height() // 2) - 320
         top.geometry(f"+{x}+{y}")
         top.attributes("-topmost", True)
         top.focus_force()
@@ -1381,7 +1478,7 @@ class HomeBookStudio(ctk.CTk):
         ctk.CTkLabel(t_gen, text="初期書き出し形式").pack(anchor="w", padx=20, pady=(10,2))
         fmt_var = ctk.StringVar(value=self.config_data.get("startup_export_fmt", "PDF"))
         def update_startup_fmt(val): self.config_data["startup_export_fmt"] = val; self._save_config()
-        ctk.CTkOptionMenu(t_gen, values=["PDF", "JPG"], variable=fmt_var, command=update_startup_fmt).pack(anchor="w", padx=20)
+        ctk.CTkOptionMenu(t_gen, values=EXPORT_FORMATS, variable=fmt_var, command=update_startup_fmt).pack(anchor="w", padx=20)
         
         ctk.CTkLabel(t_gen, text="自動保存 (分)").pack(anchor="w", padx=10, pady=(20,5))
         as_var = ctk.StringVar(value=str(self.config_data["auto_save_interval"]))
@@ -1437,13 +1534,52 @@ class HomeBookStudio(ctk.CTk):
         q_sl.set(self.config_data["export_quality"])
         q_sl.pack(padx=10); q_sl.bind("<ButtonRelease-1>", lambda e: [self.config_data.update({"export_quality": int(q_sl.get())}), self._save_config()])
 
+        prog_var = ctk.BooleanVar(value=self.config_data.get("export_jpeg_progressive", False))
+        ctk.CTkSwitch(t_exp, text="プログレッシブJPEG (JPG出力のみ)", variable=prog_var,
+                      command=lambda: [self.config_data.update({"export_jpeg_progressive": bool(prog_var.get())}), self._save_config()]).pack(anchor="w", padx=10, pady=(10,0))
+        opt_var = ctk.BooleanVar(value=self.config_data.get("export_jpeg_optimize", False))
+        ctk.CTkSwitch(t_exp, text="JPEGのハフマン表を最適化する（小さく・少し遅く）", variable=opt_var,
+                      command=lambda: [self.config_data.update({"export_jpeg_optimize": bool(opt_var.get())}), self._save_config()]).pack(anchor="w", padx=10, pady=(5,0))
+
+        ctk.CTkLabel(t_exp, text="PNG圧縮レベル (0=速い 〜 9=小さい)").pack(anchor="w", padx=10, pady=5)
+        png_var = ctk.StringVar(value=str(self.config_data.get("export_png_level", 6)))
+        ctk.CTkOptionMenu(t_exp, values=[str(i) for i in range(10)], variable=png_var, command=lambda v: [self.config_data.update({"export_png_level": int(v)}), self._save_config()]).pack(padx=10)
+
+        direct_var = ctk.BooleanVar(value=self.config_data.get("export_pdf_direct", False))
+        ctk.CTkSwitch(t_exp, text="PDFに写真・文字を直接埋め込む", variable=direct_var,
+                      command=lambda: [self.config_data.update({"export_pdf_direct": bool(direct_var.get())}), self._save_config()]).pack(anchor="w", padx=10, pady=10)
+
         # Performance
         ctk.CTkLabel(t_perf, text="プレビュー画質").pack(anchor="w", padx=10, pady=5)
         qual_var = ctk.StringVar(value=self.config_data["preview_quality"])
         ctk.CTkOptionMenu(t_perf, values=["low", "medium", "high"], variable=qual_var, command=lambda v: [self.config_data.update({"preview_quality": v}), self._save_config()]).pack(padx=10)
+
+        ctk.CTkLabel(t_perf, text="書き出し並列数 (0=自動)").pack(anchor="w", padx=10, pady=5)
+        workers_var = ctk.StringVar(value=str(self.config_data.get("export_workers", 0)))
+        ctk.CTkOptionMenu(t_perf, values=["0","1","2","4","8","16"], variable=workers_var, command=lambda v: [self.config_data.update({"export_workers": int(v)}), self._save_config()]).pack(padx=10)
+
+        ctk.CTkLabel(t_perf, text="先読みする前後の見開き数 (0=しない)").pack(anchor="w", padx=10, pady=5)
+        pf_var = ctk.StringVar(value=str(self.config_data.get("preview_prefetch_spreads", 2)))
+        ctk.CTkOptionMenu(t_perf, values=["0","1","2","3","4"], variable=pf_var, command=lambda v: [self.config_data.update({"preview_prefetch_spreads": int(v)}), self._save_config()]).pack(padx=10)
+
+        ctk.CTkLabel(t_perf, text="ビューアーの読み込み並列数 (0=自動)").pack(anchor="w", padx=10, pady=5)
+        vw_var = ctk.StringVar(value=str(self.config_data.get("viewer_decode_workers", 0)))
+        ctk.CTkOptionMenu(t_perf, values=["0","1","2","4","8","16"], variable=vw_var, command=lambda v: [self.config_data.update({"viewer_decode_workers": int(v)}), self._save_config()]).pack(padx=10)
+        vp_var = ctk.BooleanVar(value=self.config_data.get("viewer_decode_processes", False))
+        ctk.CTkSwitch(t_perf, text="ビューアーの読み込みにプロセスを使う", variable=vp_var,
+                      command=lambda: [self.config_data.update({"viewer_decode_processes": bool(vp_var.get())}), self._save_config()]).pack(anchor="w", padx=10, pady=(10,0))
+
+        proxy_var = ctk.BooleanVar(value=self.config_data.get("proxy_cache", True))
+        ctk.CTkSwitch(t_perf, text="表示用の縮小画像をディスクに保存する（次回から）", variable=proxy_var,
+                      command=lambda: [self.config_data.update({"proxy_cache": bool(proxy_var.get())}), self._save_config()]).pack(anchor="w", padx=10, pady=(10,0))
+
+        page_cache_var = ctk.BooleanVar(value=self.config_data.get("export_page_cache", True))
+        ctk.CTkSwitch(t_perf, text="変更のないページの描画を再利用する", variable=page_cache_var,
+                      command=lambda: [self.config_data.update({"export_page_cache": bool(page_cache_var.get())}), self._save_config()]).pack(anchor="w", padx=10, pady=10)
         
         ctk.CTkButton(t_perf, text="キャッシュをクリア", fg_color=COLOR_RED_LIGHT, hover_color=COLOR_RED_HOVER,
-                      command=lambda: [self.preview_image_cache.clear(), self.mini_img_cache.clear(), messagebox.showinfo("完了", "キャッシュを削除しました")]).pack(pady=20)
+                      command=lambda: [self._clear_preview_cache(), self.mini_img_cache.clear(), self.preview_text_cache.clear(), TEXT_SPRITES.clear(),
+                                       open_page_cache().clear(), clear_proxy_cache(), messagebox.showinfo("完了", "キャッシュを削除しました")]).pack(pady=20)
 
     def _show_about(self): messagebox.showinfo("バージョン情報", "HomeBook Studio 1.0 ver1.8\n\nHomeBookStudio © 2025-2026 HomeBookStudio1.0")
     
@@ -1488,7 +1624,9 @@ class HomeBookStudio(ctk.CTk):
         return pages_to_update
 
     def _get_current_spread_pages(self) -> List[int]:
-        idx = self.project.current_spread_index
+        return self._get_spread_pages(self.project.current_spread_index)
+
+    def _get_spread_pages(self, idx) -> List[int]:
         if self.is_cover_mode:
             if idx == 0: return [0]
             start = 1 + (idx - 1) * 2
@@ -1500,50 +1638,108 @@ class HomeBookStudio(ctk.CTk):
     def _select_folder(self):
         folder = filedialog.askdirectory()
         if not folder: return
-        self.image_library = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(IMG_EXTS)]
-        self._refresh_thumbnails()
+        self._stop_library_scan()
+        self.image_library = []; self.library_index = {}
+        self.library_counts = self._get_image_usage_counts()
+        self.library_view.set_current(-1, scroll=False)
+        self.library_view.set_count(0, redraw=True)
+        self.library_scanner = scanner = FolderScanner(folder)
+        token = self.library_scan_token
+        threading.Thread(target=self._scan_library, args=(scanner, token), daemon=True).start()
+
+    def _stop_library_scan(self):
+        self.library_scan_token += 1
+        if self.library_poll_timer: self.after_cancel(self.library_poll_timer); self.library_poll_timer = None
+
+    def _scan_library(self, scanner, token):
+        """別スレッド: フォルダをサブフォルダまで走査し、見つけた写真を少しずつ一覧に加える。終わったら変更の確認を始める"""
+        try:
+            for batch in scanner.scan(lambda: token != self.library_scan_token):
+                self.after(0, lambda b=batch: self._add_library_files(b, token))
+            self.after(0, lambda: self._schedule_library_poll(token))
+        except: pass  # ウィンドウが閉じられた
+
+    def _add_library_files(self, paths, token):
+        if token != self.library_scan_token: return
+        for p in paths:
+            self.library_index[p] = len(self.image_library)
+            self.image_library.append(p)
+        # 一覧の末尾に足すだけなので、表示中の枠は描き直さない
+        self.library_view.set_count(len(self.image_library))
+        cur = self.library_index.get(self.drag_data.get("path"), -1)
+        if cur != self.library_view.current: self.library_view.set_current(cur, scroll=False)
+
+    def _schedule_library_poll(self, token):
+        if token != self.library_scan_token: return
+        self.library_poll_timer = self.after(FOLDER_POLL_MS, lambda: threading.Thread(
+            target=self._poll_library, args=(self.library_scanner, token), daemon=True).start())
+
+    def _poll_library(self, scanner, token):
+        """別スレッド: 更新日時の変わったフォルダだけを読み直す"""
+        try:
+            added, removed = scanner.poll()
+            self.after(0, lambda: self._apply_library_changes(added, removed, token))
+        except: pass
+
+    def _apply_library_changes(self, added, removed, token):
+        if token != self.library_scan_token: return
+        if added or removed:
+            gone = set(removed)
+            self.image_library = sorted([p for p in self.image_library if p not in gone] + added, key=FolderScanner.order_key)
+            self.library_index = {p: i for i, p in enumerate(self.image_library)}
+            self.library_view.set_current(self.library_index.get(self.drag_data.get("path"), -1), scroll=False)
+            self.library_view.set_count(len(self.image_library), redraw=True)
+        self._schedule_library_poll(token)
 
     def _refresh_thumbnails(self):
-        for w in self.scroll_thumbs.winfo_children(): w.destroy()
-        self.thumb_btns.clear()
+        """使用枚数のバッジを更新する。枚数が変わった写真のうち、表示中の枠のバッジだけを描き直す"""
         counts = self._get_image_usage_counts()
-        for idx, path in enumerate(self.image_library):
-            try:
-                if path not in self.thumbnails_cache:
-                    img = Image.open(path)
-                    img.thumbnail((80, 80))
-                    self.thumbnails_cache[path] = img
-                thumb_img = self.thumbnails_cache[path].copy()
-                count = counts.get(path, 0)
-                if count > 0:
-                    draw = ImageDraw.Draw(thumb_img)
-                    r = 10; x, y = 12, 12
-                    draw.ellipse((x-r, y-r, x+r, y+r), fill=COLOR_ORANGE_MAIN, outline="white", width=1)
-                    draw.text((x, y), str(count), fill="white", anchor="mm", font_size=12)
-                ctk_img = ctk.CTkImage(light_image=thumb_img, dark_image=thumb_img, size=thumb_img.size)
-                btn = ctk.CTkButton(self.scroll_thumbs, image=ctk_img, text="", width=84, height=84,
-                                    fg_color="transparent", border_width=0, corner_radius=0,
-                                    command=lambda p=path: self._on_thumb_click(p))
-                btn.grid(row=idx//3, column=idx%3, padx=2, pady=2)
-                self.thumb_btns[path] = btn
-            except: pass
+        old, self.library_counts = self.library_counts, counts
+        changed = {p for p in old.keys() | counts.keys() if old.get(p, 0) != counts.get(p, 0)}
+        if not changed: return
+        for index, canvas in self.library_view.visible_items():
+            if self.image_library[index] in changed: self._draw_library_badge(canvas, self.image_library[index])
+
+    def _draw_library_item(self, canvas, index):
+        path = self.image_library[index]
+        canvas.delete("all")
+        canvas.keep_refs = []
+        canvas.load_token = token = next(self.mini_task_counter)
+        img_key = ("library", path)
+        pil = self.mini_img_cache.get(img_key)
+        if pil is not None:
+            self.mini_img_cache.move_to_end(img_key)
+            tk_thumb = ImageTk.PhotoImage(pil)
+            canvas.create_image(40, 40, image=tk_thumb)
+            canvas.keep_refs.append(tk_thumb)
+        else:
+            ph = canvas.create_rectangle(4, 4, 76, 76, fill="#333", outline="")
+            item = canvas.create_image(40, 40, image="")
+            self.mini_queue.put(img_key, (path, 80, 80, 0, None, False), (canvas, token, ph, item, 80, 80), 0)
+        self._draw_library_badge(canvas, path)
+
+    def _draw_library_badge(self, canvas, path):
+        canvas.delete("badge")
+        count = self.library_counts.get(path, 0)
+        if count > 0:
+            r = 10; x, y = 12, 12
+            canvas.create_oval(x-r, y-r, x+r, y+r, fill=COLOR_ORANGE_MAIN, outline="white", width=1, tags="badge")
+            canvas.create_text(x, y, text=str(count), fill="white", font=("Arial", 9, "bold"), tags="badge")
 
     def _on_thumb_click(self, path):
         self.drag_data["path"] = path 
-        for p, btn in self.thumb_btns.items():
-            if p == path: btn.configure(border_width=2, border_color=COLOR_FG_TEXT) 
-            else: btn.configure(border_width=0)
+        self.library_view.set_current(self.library_index.get(path, -1), scroll=False)
 
     def _set_current_page_layout(self, layout_name):
         self._save_history()
         for idx in self._get_target_pages_indices():
             if idx < len(self.project.pages): self.project.pages[idx].layout_name = layout_name
-        self.preview_image_cache.clear() 
+        # プレビューの画像キャッシュは枠の大きさもキーに含むので、レイアウトを変えても消さなくてよい（先読み済みの画像も残る）
         self._refresh_ui_from_project(rebuild_mode="full")
 
     def _apply_layout_spacing(self):
         if self.ignore_ui_callbacks: return
-        self._save_history()
+        self._save_history(group="spacing")
         spacing = self.var_spacing.get()
         for i in self._get_target_pages_indices():
             if i < len(self.project.pages): self.project.pages[i].spacing_mm = spacing
@@ -1607,7 +1803,6 @@ class HomeBookStudio(ctk.CTk):
         if self.project.current_spread_index >= max_spread:
              self.project.current_spread_index = max(0, max_spread - 1)
 
-        self.preview_image_cache.clear()
         self._refresh_ui_from_project(rebuild_mode="full")
         self._refresh_thumbnails()
     
@@ -1646,7 +1841,7 @@ class HomeBookStudio(ctk.CTk):
         target_indices = self._get_target_pages_for_margin()
         if not target_indices: return
 
-        self._save_history()
+        self._save_history(group="margin")
 
         if is_custom:
             vals = {
@@ -1738,7 +1933,7 @@ class HomeBookStudio(ctk.CTk):
         self.project.paper_size = self.var_paper_size.get()
         self.project.orientation = self.var_orientation.get()
         self.draw_preview()
-        self._init_mini_viewer(force_rebuild=True)
+        self._init_mini_viewer()
 
     def _update_margin_entries_from_vars(self):
         mapping = {"top": self.var_m_top, "bottom": self.var_m_bot, "inner": self.var_m_in, "outer": self.var_m_out}
@@ -1774,7 +1969,10 @@ class HomeBookStudio(ctk.CTk):
 
     def _open_viewer(self):
         if self.viewer_window is None or not self.viewer_window.winfo_exists():
-            self.viewer_window = HBSViewer(parent=self, project_data=self.project)
+            self.viewer_window = HBSViewer(parent=self, project_data=self.project,
+                                           decode_workers=self.config_data.get("viewer_decode_workers", 0),
+                                           use_processes=self.config_data.get("viewer_decode_processes", False),
+                                           use_proxies=self.use_proxies)
         else:
             self.viewer_window.lift()
             self.viewer_window.focus_force()
@@ -1853,7 +2051,8 @@ class HomeBookStudio(ctk.CTk):
         self._refresh_nav_list()
         
         if rebuild_mode == "full":
-            self._init_mini_viewer(force_rebuild=True)
+            # 変わったページの見開きだけが描き直される（_mini_signature）
+            self._init_mini_viewer()
         else:
             self._sync_mini_viewer_scroll()
         
@@ -1865,11 +2064,18 @@ class HomeBookStudio(ctk.CTk):
         self._sync_viewer()
 
     def _refresh_nav_list(self):
-        for w in self.nav_scroll.winfo_children(): w.destroy()
         total = len(self.project.pages)
         count = 1 + (total-1+1)//2 if self.is_cover_mode else (total+1)//2
+        # ボタンは見開きの数か表紙モードが変わったときだけ作り直し、それ以外は現在位置の強調を付け替えるだけにする
+        cur = self.project.current_spread_index
+        if self.nav_btns_key == (count, self.is_cover_mode):
+            for s in {self.nav_current, cur}:
+                if 0 <= s < count: self.nav_btns[s].configure(**self._nav_btn_style(s == cur))
+            self.nav_current = cur
+            return
+        for w in self.nav_scroll.winfo_children(): w.destroy()
+        self.nav_btns = []; self.nav_btns_key = (count, self.is_cover_mode); self.nav_current = cur
         for s in range(count):
-            is_cur = (s == self.project.current_spread_index)
             txt = ""
             if self.is_cover_mode:
                 if s == 0: txt = "P1"
@@ -1880,15 +2086,17 @@ class HomeBookStudio(ctk.CTk):
                 st = s*2 + 1
                 txt = f"P{st}-{st+1}"
             
-            fg = COLOR_ORANGE_MAIN if is_cur else "transparent"
-            hover = COLOR_ORANGE_HOVER if is_cur else COLOR_BTN_HOVER
-            text_c = "#ffffff" if is_cur else COLOR_FG_TEXT
-
-            btn = ctk.CTkButton(self.nav_scroll, text=txt,
-                                fg_color=fg, hover_color=hover, text_color=text_c,
+            btn = ctk.CTkButton(self.nav_scroll, text=txt, **self._nav_btn_style(s == cur),
                                 font=self.ui_font_sm, height=24, anchor="w",
                                 command=lambda x=s: self._jump_spread(x))
             btn.pack(fill="x", pady=1, padx=2)
+            self.nav_btns.append(btn)
+
+    @staticmethod
+    def _nav_btn_style(is_cur):
+        return {"fg_color": COLOR_ORANGE_MAIN if is_cur else "transparent",
+                "hover_color": COLOR_ORANGE_HOVER if is_cur else COLOR_BTN_HOVER,
+                "text_color": "#ffffff" if is_cur else COLOR_FG_TEXT}
 
     # --- High Performance Mini Viewer ---
     def _init_mini_viewer(self, force_rebuild=False):
@@ -1900,34 +2108,34 @@ class HomeBookStudio(ctk.CTk):
         else:
             for i in range(0, total_pages, 2): spreads.append([i] if i+1 >= total_pages else [i, i+1])
         
-        if force_rebuild or len(self.mini_thumb_frames) != len(spreads):
-            for w in self.mini_viewer_scroll.winfo_children(): w.destroy()
-            self.mini_thumb_frames = {}
-            self.mini_canvas_refs = {}
-            self.last_highlighted_mini_index = -1
-            
-            for s_idx, pages in enumerate(spreads):
-                frame = ctk.CTkFrame(self.mini_viewer_scroll, fg_color="transparent", border_width=2, border_color="#1a1a1a")
-                frame.pack(side="left", padx=2, pady=2)
-                self.mini_thumb_frames[s_idx] = frame
-                
-                cv = tk.Canvas(frame, width=120, height=80, bg="#222", highlightthickness=0)
-                cv.pack(padx=2, pady=2)
-                
-                cv.bind("<Button-1>", lambda e, idx=s_idx: self._jump_spread(idx))
-                frame.bind("<Button-1>", lambda e, idx=s_idx: self._jump_spread(idx))
-                
-                self._draw_mini_thumb(cv, pages, s_idx == 0 and self.is_cover_mode, s_idx)
-                
-                lbl = f"P{pages[0]+1}"
-                if len(pages)>1: lbl+=f"-{pages[1]+1}"
-                ctk.CTkLabel(frame, text=lbl, font=("Arial", 10), text_color=COLOR_FG_DIM).pack()
+        # 枠は見えている範囲の分だけ ThumbnailView が作って使い回す。
+        # 表示中の枠は見開きごとの署名（用紙・余白・各ページの内容）を前回と比べ、変わったものだけ描き直す
+        self.mini_spreads = spreads
+        self.mini_strip.set_count(len(spreads), redraw=force_rebuild)
         
         self._sync_mini_viewer_scroll()
 
-    def _draw_mini_thumb(self, canvas, pages, is_cover, s_idx):
+    def _mini_signature(self, s_idx):
+        pr = self.project; pages = self.mini_spreads[s_idx]
+        layout = (pr.paper_size, pr.orientation, pr.margin_top, pr.margin_bottom, pr.margin_inner, pr.margin_outer)
+        return (layout, s_idx == 0 and self.is_cover_mode, tuple(pages),
+                tuple(page_signature(pr.pages[p]) for p in pages if p < len(pr.pages)))
+
+    def _mini_label(self, s_idx):
+        pages = self.mini_spreads[s_idx]
+        return f"P{pages[0]+1}" + (f"-{pages[1]+1}" if len(pages) > 1 else "")
+
+    def _draw_mini_item(self, canvas, s_idx):
+        self._draw_mini_thumb(canvas, self.mini_spreads[s_idx], s_idx == 0 and self.is_cover_mode, s_idx)
+
+    def _draw_mini_thumb(self, canvas, pages, is_cover, s_idx=0):
+        """見開きのミニサムネイル。写真はキャッシュにあればその場で、なければ仮枠を描いて読み込みを待つ"""
         w, h = 120, 80
         canvas.delete("all")
+        canvas.keep_refs = []
+        # 描き直すたびに token を更新し、前回の描画で出した読み込み要求を無効にする
+        canvas.load_token = token = next(self.mini_task_counter)
+        priority = abs(s_idx - self.project.current_spread_index)
         
         size_key = self.project.paper_size if self.project.paper_size in PAPER_SIZES else "A4"
         pw_mm, ph_mm = PAPER_SIZES[size_key]
@@ -1949,8 +2157,6 @@ class HomeBookStudio(ctk.CTk):
         else:
             for i, p_idx in enumerate(pages): pages_to_draw.append((i, p_idx))
 
-        self.mini_canvas_refs[s_idx] = []
-
         for offset, p_idx in pages_to_draw:
             if p_idx >= len(self.project.pages): continue
             page = self.project.pages[p_idx]
@@ -1972,53 +2178,76 @@ class HomeBookStudio(ctk.CTk):
                 photo = next((p for p in page.photos if p.slot_index == r_idx), None)
                 
                 if photo:
-                    img_key = f"{photo.path}_mini_{int(bw)}x{int(bh)}"
-                    tk_thumb = None
+                    img_key = self._mini_thumb_key(photo, bw, bh)
+                    pil = self.mini_img_cache.get(img_key)
                     
-                    if img_key in self.mini_img_cache:
-                        tk_thumb = self.mini_img_cache[img_key]
-                    else:
-                        try:
-                            if os.path.exists(photo.path):
-                                pil = Image.open(photo.path)
-                                fitted = ImageOps.fit(pil, (int(bw), int(bh)), method=Image.NEAREST)
-                                tk_thumb = ImageTk.PhotoImage(fitted)
-                                self.mini_img_cache[img_key] = tk_thumb
-                        except: pass
-                    
-                    if tk_thumb:
+                    if pil is not None:
+                        self.mini_img_cache.move_to_end(img_key)
+                        tk_thumb = self._fit_mini_thumb(pil, bw, bh)
                         canvas.create_image(bx + bw/2, by + bh/2, image=tk_thumb)
-                        self.mini_canvas_refs[s_idx].append(tk_thumb)
+                        canvas.keep_refs.append(tk_thumb)
                     else:
-                        canvas.create_rectangle(bx, by, bx+bw, by+bh, fill=COLOR_ORANGE_MAIN, outline="#666")
+                        ph = canvas.create_rectangle(bx, by, bx+bw, by+bh, fill="#333", outline="")
+                        item = canvas.create_image(bx + bw/2, by + bh/2, image="")
+                        self.mini_queue.put(img_key, (photo.path, img_key[3], img_key[4], photo.rotation, photo.crop, True),
+                                            (canvas, token, ph, item, bw, bh), priority)
                     
                     canvas.create_rectangle(bx, by, bx+bw, by+bh, outline="#666", width=1)
                 else:
                     canvas.create_rectangle(bx, by, bx+bw, by+bh, outline="#444")
 
-    def _sync_mini_viewer_scroll(self):
-        idx = self.project.current_spread_index
-        total = len(self.mini_thumb_frames)
-        
-        if self.last_highlighted_mini_index != -1 and self.last_highlighted_mini_index in self.mini_thumb_frames:
-             self.mini_thumb_frames[self.last_highlighted_mini_index].configure(border_color="#1a1a1a", border_width=2)
-        
-        if idx in self.mini_thumb_frames:
-             self.mini_thumb_frames[idx].configure(border_color=COLOR_HIGHLIGHT, border_width=3)
-             self.last_highlighted_mini_index = idx
+    @staticmethod
+    def _mini_thumb_key(photo: PhotoItem, bw, bh):
+        step = MINI_THUMB_STEP
+        return (photo.path, photo.rotation, crop_key(photo.crop), -(-max(1, int(bw)) // step) * step, -(-max(1, int(bh)) // step) * step)
+
+    @staticmethod
+    def _fit_mini_thumb(pil, bw, bh):
+        """切り上げたサイズでデコードした画像を、枠の大きさに中央で切り抜いて PhotoImage にする"""
+        w, h = min(pil.width, max(1, int(bw))), min(pil.height, max(1, int(bh)))
+        if pil.size != (w, h):
+            left, top = (pil.width - w) // 2, (pil.height - h) // 2
+            pil = pil.crop((left, top, left + w, top + h))
+        return ImageTk.PhotoImage(pil)
 
-        if total > 1:
+    @staticmethod
+    def _is_mini_target_live(target):
+        # ローダースレッドから呼ばれるので Tk には触れず、キャンバスの token だけを見る
+        return getattr(target[0], "load_token", None) == target[1]
+
+    def _mini_loader_worker(self):
+        """ミニサムネイル用の写真を別スレッドでデコードする。枠が描き直された・表示範囲から外れた要求は読まずに捨てる"""
+        while True:
+            img_key, (path, w, h, rotation, crop, cover) = self.mini_queue.get(is_live=self._is_mini_target_live)
+            pil = None
+            if os.path.exists(path):
+                try: pil = decode_proxy(path, (w, h), rotation, resample=Image.NEAREST if cover else Image.BICUBIC, crop=crop, cover=cover,
+                                        use_cache=self.use_proxies)
+                except: pass
+            targets = self.mini_queue.done(img_key)
+            try: self.after(0, lambda k=img_key, p=pil, ts=targets: self._on_mini_thumb_loaded(k, p, ts))
+            except: return  # ウィンドウが閉じられた
+
+    def _on_mini_thumb_loaded(self, img_key, pil, targets):
+        """メインスレッドで実行: 届いた画像をキャッシュし、まだ有効な枠の仮枠と差し替える（読めなければ仮枠を警告色にする）"""
+        if pil is not None:
+            self.mini_img_cache[img_key] = pil
+            if len(self.mini_img_cache) > MINI_CACHE_ITEMS: self.mini_img_cache.popitem(last=False)
+        for canvas, token, ph, item, bw, bh in targets:
+            if not self._is_mini_target_live((canvas, token)): continue
             try:
-                cv = self.mini_viewer_scroll._parent_canvas
-                vw = cv.winfo_width(); sr = cv.bbox("all")
-                if sr:
-                    cw = sr[2]
-                    ctr = (idx + 0.5) / total * cw
-                    left = ctr - (vw / 2)
-                    frac = max(0.0, min(1.0, left / cw))
-                    cv.xview_moveto(frac)
+                if pil is None:
+                    canvas.itemconfig(ph, fill=COLOR_ORANGE_MAIN)
+                    continue
+                tk_thumb = self._fit_mini_thumb(pil, bw, bh)
+                canvas.keep_refs.append(tk_thumb)
+                canvas.itemconfig(item, image=tk_thumb)
+                canvas.delete(ph)
             except: pass
 
+    def _sync_mini_viewer_scroll(self):
+        self.mini_strip.set_current(self.project.current_spread_index, scroll=len(self.mini_spreads) > 1)
+
     # --- Navigation ---
     def _jump_spread(self, idx):
         if self.project.current_spread_index == idx: return
@@ -2068,7 +2297,7 @@ class HomeBookStudio(ctk.CTk):
 
     def _on_item_rotate(self, val):
         if self.selected_item and not self.ignore_ui_callbacks:
-            self._save_history() 
+            self._save_history(group=("rotate", id(self.selected_item)))
             self.selected_item.rotation = int(val)
             self.draw_preview()
 
@@ -2112,9 +2341,7 @@ class HomeBookStudio(ctk.CTk):
         return x0, y0, draw_w, draw_h, pw_mm
 
     def _get_page_margins(self, page: Page):
-        if page.custom_margins:
-            return page.custom_margins["top"], page.custom_margins["bottom"], page.custom_margins["inner"], page.custom_margins["outer"]
-        return self.project.margin_top, self.project.margin_bottom, self.project.margin_inner, self.project.margin_outer
+        return get_page_margins(self.project, page)
 
     def _hit_test(self, cx, cy) -> Tuple[int, int]:
         metrics = self._get_draw_metrics()
@@ -2179,7 +2406,9 @@ class HomeBookStudio(ctk.CTk):
             for txt in page.texts:
                 tx = px_start + txt.x_rel * p_w
                 ty = y0 + txt.y_rel * dh
-                if abs(cx - tx) < txt.font_size and abs(cy - ty) < txt.font_size: return p_idx, txt
+                # 当たり判定は実際の文字の大きさで（小さい文字でもつかめるように最低 font_size は確保する）
+                l, t, r, b = measure_text(txt.text, txt.font_family, int(txt.font_size))
+                if abs(cx - tx) < max(txt.font_size, (r - l) / 2) and abs(cy - ty) < max(txt.font_size, (b - t) / 2): return p_idx, txt
         return -1, None
 
     def draw_preview(self):
@@ -2187,14 +2416,14 @@ class HomeBookStudio(ctk.CTk):
         metrics = self._get_draw_metrics()
         if not metrics: return
         x0, y0, dw, dh, pw_mm = metrics
-        p_w = dw / 2; scale = p_w / pw_mm 
-        
-        pages_to_draw = []
-        current_pages = self._get_current_spread_pages()
-        if self.is_cover_mode and self.project.current_spread_index == 0:
-            if current_pages: pages_to_draw.append((1, current_pages[0]))
-        else:
-            for i, pid in enumerate(current_pages): pages_to_draw.append((i, pid))
+        p_w = dw / 2
+
+        view = (self.project.current_spread_index, self.is_cover_mode, tuple(int(v) for v in metrics[:4]))
+        if view != self.preview_view:
+            # 見開きを移動した向きを覚えておき、先読みはその先を優先する
+            if self.preview_view and view[1:] == self.preview_view[1:]:
+                self.preview_nav_dir = 1 if view[0] > self.preview_view[0] else -1
+            self.preview_view = view; self.preview_generation += 1; self.preview_pending.clear()
 
         # Spine
         spine_x = x0 + p_w
@@ -2202,58 +2431,39 @@ class HomeBookStudio(ctk.CTk):
         
         self._draw_refs = [] 
 
-        for offset, p_idx in pages_to_draw:
+        for offset, p_idx in self._get_spread_draw_pages(self.project.current_spread_index):
             if p_idx >= len(self.project.pages): continue
             page = self.project.pages[p_idx]
-            px = x0 + (offset * p_w)
+            px, safe, slots = self._get_preview_page_layout(page, offset, metrics)
             
             self.canvas.create_rectangle(px, y0, px+p_w, y0+dh, fill=page.background_color, outline="#333")
-            mt, mb, mi, mo = self._get_page_margins(page)
-            
-            if offset == 0: safe = (px + mo*scale, y0 + mt*scale, px + p_w - mi*scale, y0 + dh - mb*scale)
-            else: safe = (px + mi*scale, y0 + mt*scale, px + p_w - mo*scale, y0 + dh - mb*scale)
-            
             self.canvas.create_rectangle(*safe, outline="#ddd", dash=(2,4))
             
-            rects = LayoutManager.get_layout_rects(page.layout_name)
-            sp_px = page.spacing_mm * scale
-            for r_idx, (rx, ry, rw, rh) in enumerate(rects):
-                sx = safe[0] + rx * (safe[2]-safe[0]) + sp_px/2
-                sy = safe[1] + ry * (safe[3]-safe[1]) + sp_px/2
-                w = rw * (safe[2]-safe[0]) - sp_px
-                h = rh * (safe[3]-safe[1]) - sp_px
-                if w > 0 and h > 0:
-                    outline_col = "#eee"
-                    if isinstance(self.selected_item, PhotoItem) and self.selected_item in page.photos and self.selected_item.slot_index == r_idx:
-                        outline_col = COLOR_HIGHLIGHT
-                    self.canvas.create_rectangle(sx, sy, sx+w, sy+h, outline=outline_col, width=2 if outline_col==COLOR_HIGHLIGHT else 1)
-                    
-                    photo = next((p for p in page.photos if p.slot_index == r_idx), None)
-                    if photo:
-                        cache_key = (photo.path, int(w), int(h), photo.rotation)
-                        if cache_key in self.preview_image_cache:
-                            tk_img = self.preview_image_cache[cache_key]
-                            self.canvas.create_image(sx + w/2, sy + h/2, image=tk_img)
-                        else:
-                            if os.path.exists(photo.path):
-                                try:
-                                    pil = Image.open(photo.path)
-                                    if photo.rotation: pil = pil.rotate(-photo.rotation, expand=True)
-                                    pil.thumbnail((int(w), int(h)))
-                                    tk_img = ImageTk.PhotoImage(pil)
-                                    self.preview_image_cache[cache_key] = tk_img
-                                    self.canvas.create_image(sx + w/2, sy + h/2, image=tk_img)
-                                except: pass
+            for r_idx, sx, sy, w, h in slots:
+                outline_col = "#eee"
+                if isinstance(self.selected_item, PhotoItem) and self.selected_item in page.photos and self.selected_item.slot_index == r_idx:
+                    outline_col = COLOR_HIGHLIGHT
+                self.canvas.create_rectangle(sx, sy, sx+w, sy+h, outline=outline_col, width=2 if outline_col==COLOR_HIGHLIGHT else 1)
+                
+                photo = next((p for p in page.photos if p.slot_index == r_idx), None)
+                if photo:
+                    cache_key = (photo.path, int(w), int(h), photo.rotation, crop_key(photo.crop))
+                    if cache_key in self.preview_image_cache:
+                        self.preview_image_cache.move_to_end(cache_key)
+                        tk_img = self.preview_image_cache[cache_key][0]
+                        self._draw_refs.append(tk_img)
+                        self.canvas.create_image(sx + w/2, sy + h/2, image=tk_img)
+                    else:
+                        # 読み込み中はプレースホルダーを出しておき、届いた画像で差し替える
+                        tag = self._preview_tag(cache_key)
+                        self.canvas.create_rectangle(sx+1, sy+1, sx+w-1, sy+h-1, fill="#d8d8d8", outline="", tags=(tag + "_ph",))
+                        self.canvas.create_image(sx + w/2, sy + h/2, tags=(tag,))
+                        if cache_key not in self.preview_pending:
+                            self.preview_pending.add(cache_key)
+                            self.preview_queue.put(cache_key, (photo.path, int(w), int(h), photo.rotation, photo.crop), ("view", self.preview_generation), 0)
                                 
             for txt in page.texts:
-                fnt = load_font(txt.font_family, int(txt.font_size))
-                dummy = ImageDraw.Draw(Image.new("RGBA", (1,1)))
-                bbox = dummy.textbbox((0,0), txt.text, font=fnt)
-                txt_img = Image.new("RGBA", (bbox[2]-bbox[0]+20, bbox[3]-bbox[1]+20), (0,0,0,0))
-                d = ImageDraw.Draw(txt_img)
-                d.text((10,10), txt.text, font=fnt, fill=txt.color)
-                if txt.rotation != 0: txt_img = txt_img.rotate(txt.rotation, expand=True, resample=Image.BICUBIC)
-                tk_txt = ImageTk.PhotoImage(txt_img)
+                tk_txt = self._get_text_image(txt)
                 self._draw_refs.append(tk_txt) 
                 
                 pos_x = px + txt.x_rel * p_w
@@ -2263,6 +2473,121 @@ class HomeBookStudio(ctk.CTk):
                     self.canvas.create_rectangle(pos_x-10, pos_y-10, pos_x+10, pos_y+10, outline=COLOR_HIGHLIGHT, width=2)
             self.canvas.create_text(px + p_w/2, y0 + dh + 15, text=f"P{p_idx+1}", fill="white")
 
+        self._schedule_prefetch()
+
+    def _get_spread_draw_pages(self, spread_idx):
+        """見開きに描くページの (左右位置 0/1, ページ番号)。表紙モードの表紙は右側だけ"""
+        pages = self._get_spread_pages(spread_idx)
+        if self.is_cover_mode and spread_idx == 0: return [(1, pages[0])]
+        return list(enumerate(pages))
+
+    def _get_preview_page_layout(self, page: Page, offset, metrics):
+        """プレビュー上のページ左端、安全領域、スロットの [(スロット番号, x, y, w, h)] を返す"""
+        x0, y0, dw, dh, pw_mm = metrics
+        p_w = dw / 2; scale = p_w / pw_mm
+        px = x0 + (offset * p_w)
+        mt, mb, mi, mo = self._get_page_margins(page)
+        if offset == 0: safe = (px + mo*scale, y0 + mt*scale, px + p_w - mi*scale, y0 + dh - mb*scale)
+        else: safe = (px + mi*scale, y0 + mt*scale, px + p_w - mo*scale, y0 + dh - mb*scale)
+
+        slots = []
+        sp_px = page.spacing_mm * scale
+        for r_idx, (rx, ry, rw, rh) in enumerate(LayoutManager.get_layout_rects(page.layout_name)):
+            sx = safe[0] + rx * (safe[2]-safe[0]) + sp_px/2
+            sy = safe[1] + ry * (safe[3]-safe[1]) + sp_px/2
+            w = rw * (safe[2]-safe[0]) - sp_px
+            h = rh * (safe[3]-safe[1]) - sp_px
+            if w > 0 and h > 0: slots.append((r_idx, sx, sy, w, h))
+        return px, safe, slots
+
+    # --- Preview Prefetch ---
+    def _schedule_prefetch(self):
+        """描画のたびに先読みを止め、操作が落ち着いてから前後の見開きの先読みをやり直す"""
+        self.prefetch_token += 1
+        if self.prefetch_timer: self.after_cancel(self.prefetch_timer)
+        self.prefetch_timer = self.after(PREFETCH_DELAY_MS, self._prefetch_neighbours)
+
+    def _prefetch_neighbours(self):
+        """前後 N 見開きのプレビュー画像を低い優先度で読み込む。移動してきた向きの先を先に読む"""
+        self.prefetch_timer = None
+        n = self.config_data.get("preview_prefetch_spreads", 2)
+        metrics = self._get_draw_metrics()
+        if n <= 0 or not metrics: return
+        cur = self.project.current_spread_index
+        target = ("prefetch", self.prefetch_token)
+        for d in range(1, n + 1):
+            for sign, priority in ((self.preview_nav_dir, 2*d - 1), (-self.preview_nav_dir, 2*d)):
+                spread_idx = cur + sign * d
+                if spread_idx < 0: continue
+                for offset, p_idx in self._get_spread_draw_pages(spread_idx):
+                    if p_idx >= len(self.project.pages): continue
+                    page = self.project.pages[p_idx]
+                    for r_idx, sx, sy, w, h in self._get_preview_page_layout(page, offset, metrics)[2]:
+                        photo = next((p for p in page.photos if p.slot_index == r_idx), None)
+                        if not photo: continue
+                        cache_key = (photo.path, int(w), int(h), photo.rotation, crop_key(photo.crop))
+                        if cache_key in self.preview_image_cache: continue
+                        self.preview_queue.put(cache_key, (photo.path, int(w), int(h), photo.rotation, photo.crop), target, priority)
+
+    @staticmethod
+    def _preview_tag(cache_key):
+        return "pv%x" % (hash(cache_key) & 0xffffffffffff)
+
+    def _is_preview_target_live(self, target):
+        # ローダースレッドから呼ばれる。見開きやサイズが変わった表示要求と、操作で打ち切られた先読みは無効
+        kind, token = target
+        return token == (self.preview_generation if kind == "view" else self.prefetch_token)
+
+    def _preview_loader_worker(self):
+        """プレビュー用の写真を別スレッドでデコードする。無効になった要求は読まずに捨てる"""
+        while True:
+            cache_key, (path, w, h, rotation, crop) = self.preview_queue.get(is_live=self._is_preview_target_live)
+            pil = None
+            if os.path.exists(path):
+                try: pil = decode_proxy(path, (max(1, w), max(1, h)), rotation, crop=crop, use_cache=self.use_proxies)
+                except: pass
+            self.preview_queue.done(cache_key)
+            try: self.after(0, lambda k=cache_key, p=pil: self._on_preview_image_loaded(k, p))
+            except: return  # ウィンドウが閉じられた
+
+    def _on_preview_image_loaded(self, cache_key, pil):
+        """メインスレッドで実行: 届いた画像をキャッシュし、表示中のスロットが待っていればプレースホルダーと差し替える"""
+        tag = self._preview_tag(cache_key)  # タグは今の描画にしか無いので、古い要求や先読みの結果でも安全に差し替えられる
+        if pil is None:
+            # 読めない写真は同じ表示のあいだは再要求しない（preview_pending に残す）
+            self.canvas.delete(tag + "_ph")
+            return
+        try: tk_img = ImageTk.PhotoImage(pil)
+        except: return
+        self._cache_preview_image(cache_key, tk_img, pil.width * pil.height * 4)
+        self.preview_pending.discard(cache_key)
+        if self.canvas.find_withtag(tag): self._draw_refs.append(tk_img)
+        self.canvas.delete(tag + "_ph")
+        self.canvas.itemconfig(tag, image=tk_img)
+
+    def _cache_preview_image(self, cache_key, tk_img, nbytes):
+        old = self.preview_image_cache.pop(cache_key, None)
+        if old is not None: self.preview_image_cache_bytes -= old[1]
+        self.preview_image_cache[cache_key] = (tk_img, nbytes); self.preview_image_cache_bytes += nbytes
+        # 表示中の画像は _draw_refs が参照を持っているので、ここで捨てても消えるのは画面にない画像だけ
+        while self.preview_image_cache_bytes > PREVIEW_CACHE_MB * 1024 * 1024 and len(self.preview_image_cache) > 1:
+            self.preview_image_cache_bytes -= self.preview_image_cache.popitem(last=False)[1][1]
+
+    def _clear_preview_cache(self):
+        self.preview_image_cache.clear(); self.preview_image_cache_bytes = 0
+
+    def _get_text_image(self, txt: TextItem):
+        """テキストのPhotoImage。内容・フォント・サイズ・色・回転が同じなら前回の画像を使い回す"""
+        key = TextSpriteCache.key(txt, int(txt.font_size), 10)
+        tk_txt = self.preview_text_cache.get(key)
+        if tk_txt is not None:
+            self.preview_text_cache.move_to_end(key)
+            return tk_txt
+        tk_txt = ImageTk.PhotoImage(TEXT_SPRITES.get(txt, int(txt.font_size), pad=10))
+        self.preview_text_cache[key] = tk_txt
+        if len(self.preview_text_cache) > 256: self.preview_text_cache.popitem(last=False)
+        return tk_txt
+
     # --- Interaction ---
     def _on_canvas_drop(self, event):
         if not self.drag_data.get("path"): return
@@ -2343,6 +2668,7 @@ class HomeBookStudio(ctk.CTk):
     def _on_canvas_drag(self, event):
         item = self.drag_data.get("item")
         if item and isinstance(item, TextItem):
+            self._save_history(group=("move", id(item)))
             metrics = self._get_draw_metrics()
             x0, y0, dw, dh, _ = metrics
             page_w = dw/2
@@ -2360,7 +2686,7 @@ class HomeBookStudio(ctk.CTk):
             self.draw_preview()
 
     def _on_canvas_release(self, event):
-        if self.drag_data.get("item"): self._save_history()
+        if self.drag_data.get("item"): self.history.commit() # ドラッグで動かした分を1つの履歴にする
         self.drag_data["item"] = None
 
     def _on_canvas_right_click(self, event):
@@ -2390,19 +2716,10 @@ class HomeBookStudio(ctk.CTk):
         path = filedialog.askopenfilename(filetypes=[("HBS Project", "*.hbs")])
         if not path: return
         try:
-            with open(path, "r") as f: data = json.load(f)
-            self.project = Project(**data)
+            self.project = load_project_file(path)
+            self.history.reset(self.project)
             self.current_project_path = path 
-            raw_pages = data.get("pages", [])
-            self.project.pages = []
-            for p in raw_pages:
-                pg = Page(layout_name=p.get("layout_name", "1枚 (全面)"), spacing_mm=p.get("spacing_mm", 0.0), custom_margins=p.get("custom_margins"), background_color=p.get("background_color", "#FFFFFF"))
-                for ph in p.get("photos", []):
-                    pg.photos.append(PhotoItem(path=ph["path"], slot_index=ph.get("slot_index",0), rotation=ph.get("rotation",0)))
-                for txt in p.get("texts", []):
-                    pg.texts.append(TextItem(text=txt["text"], x_rel=txt["x_rel"], y_rel=txt["y_rel"], font_size=txt.get("font_size",40), color=txt.get("color","black"), rotation=txt.get("rotation",0)))
-                self.project.pages.append(pg)
-            self.preview_image_cache.clear()
+            self._clear_preview_cache()
             self._refresh_ui_from_project(rebuild_mode="full")
             self._refresh_thumbnails()
         except Exception as e:
@@ -2425,14 +2742,21 @@ class HomeBookStudio(ctk.CTk):
 
     def _export_worker(self, out_dir):
         try:
-            total = len(self.project.pages)
-            if total % 2 == 1: total += 1
-            def update_prog(val): self.header_progress.set(val)
-            if self.var_keep_orig.get(): self._export_original(out_dir, total, update_prog)
-            else: self._export_canvas(out_dir, total, update_prog)
+            opts = self._export_options()
+            telemetry = ExportTelemetry(export_page_count(self.project), opts)
+            def update_prog(val):
+                self.header_progress.set(val)
+                # 処理速度と残り時間をヘッダーに表示する（キャンセル中の表示は上書きしない）。ラベルの更新はメインスレッドで行う
+                text = telemetry.status_text()
+                self.after(0, lambda: None if self.is_export_cancelled else self.header_status_label.configure(text=text))
+            stats = export_project(self.project, out_dir, opts, update_prog, lambda: self.is_export_cancelled, telemetry)
             
             if not self.is_export_cancelled:
-                self.after(0, lambda: [messagebox.showinfo("完了", "出力完了"), self._hide_export_status()])
+                summary = f"出力完了 ({telemetry.elapsed:.1f}秒, {telemetry.pages_per_sec:.1f}ページ/秒)"
+                if stats:
+                    summary += f"\n画像キャッシュ: ヒット {stats['cache_hits']} / ミス {stats['cache_misses']}"
+                    summary += f"\nページ: 描画 {stats['pages_rendered']} / 再利用 {stats['pages_reused']}"
+                self.after(0, lambda: [messagebox.showinfo("完了", summary), self._hide_export_status()])
             else:
                  self.after(0, lambda: [messagebox.showinfo("キャンセル", "書き出しをキャンセルしました"), self._hide_export_status()])
         except Exception as e:
@@ -2444,104 +2768,10 @@ class HomeBookStudio(ctk.CTk):
         self.header_progress.pack_forget()
         self.header_cancel_btn.pack_forget()
 
-    def _export_original(self, out_dir, total, progress_cb):
-        imgs = []
-        for i in range(total):
-            if self.is_export_cancelled: return
-            progress_cb(i / total)
-            if i < len(self.project.pages) and self.project.pages[i].photos:
-                p_item = self.project.pages[i].photos[0]
-                try:
-                    im = Image.open(p_item.path)
-                    if p_item.rotation: im = im.rotate(-p_item.rotation, expand=True)
-                    imgs.append(im)
-                except: imgs.append(Image.new("RGB", (100,100), "white"))
-            else: imgs.append(Image.new("RGB", (100,100), "white"))
-        
-        if not self.is_export_cancelled:
-            self._save_images(out_dir, imgs)
-
-    def _export_canvas(self, out_dir, total, progress_cb):
-        dpi = self.config_data["export_dpi"]
-        size_key = self.project.paper_size if self.project.paper_size in PAPER_SIZES else "A4"
-        pw_mm, ph_mm = PAPER_SIZES[size_key]
-        if self.project.orientation == "Landscape": pw_mm, ph_mm = ph_mm, pw_mm
-        px_w = int(math.ceil(pw_mm * MM_TO_INCH * dpi))
-        px_h = int(math.ceil(ph_mm * MM_TO_INCH * dpi))
-        scale = dpi / 25.4
-        imgs = []
-        for i in range(total):
-            if self.is_export_cancelled: return
-            progress_cb(i / total)
-            if i < len(self.project.pages): page = self.project.pages[i]
-            else: page = Page()
-            canvas = Image.new("RGB", (px_w, px_h), page.background_color)
-            draw = ImageDraw.Draw(canvas)
-            mt, mb, mi, mo = self._get_page_margins(page)
-            
-            is_left_page = (i % 2 == 0)
-
-            if self.is_cover_mode:
-                is_left_page = (i % 2 != 0)
-
-            if is_left_page:
-                ml, mr = mo, mi
-            else:
-                ml, mr = mi, mo
-            
-            safe_x_px = ml * scale; safe_y_px = mt * scale
-            safe_w_px = px_w - (ml+mr) * scale; safe_h_px = px_h - (mt+mb) * scale
-            
-            rects = LayoutManager.get_layout_rects(page.layout_name)
-            sp_px = page.spacing_mm * scale
-            for r_idx, (rx, ry, rw, rh) in enumerate(rects):
-                slot_x = safe_x_px + rx * safe_w_px + sp_px/2
-                slot_y = safe_y_px + ry * safe_h_px + sp_px/2
-                slot_w = rw * safe_w_px - sp_px
-                slot_h = rh * safe_h_px - sp_px 
-                photo = next((p for p in page.photos if p.slot_index == r_idx), None)
-                if photo and slot_w > 0 and slot_h > 0:
-                    try:
-                        im = Image.open(photo.path).convert("RGB")
-                        if photo.rotation: im = im.rotate(-photo.rotation, expand=True)
-                        
-                        im.thumbnail((int(slot_w), int(slot_h)), Image.LANCZOS)
-                        
-                        iw, ih = im.size
-                        paste_x = int(slot_x + (slot_w - iw) / 2)
-                        paste_y = int(slot_y + (slot_h - ih) / 2)
-                        
-                        canvas.paste(im, (paste_x, paste_y))
-                    except: pass
-            
-            for txt in page.texts:
-                fnt_size_px = int(txt.font_size * (dpi / 72)) 
-                fnt = load_font(txt.font_family, fnt_size_px)
-                dummy = ImageDraw.Draw(Image.new("RGBA", (1,1)))
-                bbox = dummy.textbbox((0,0), txt.text, font=fnt)
-                txt_img = Image.new("RGBA", (bbox[2]-bbox[0]+100, bbox[3]-bbox[1]+100), (0,0,0,0))
-                d = ImageDraw.Draw(txt_img)
-                d.text((50,50), txt.text, font=fnt, fill=txt.color)
-                if txt.rotation: txt_img = txt_img.rotate(txt.rotation, expand=True, resample=Image.BICUBIC)
-                paste_x = int(txt.x_rel * px_w) - txt_img.width // 2
-                paste_y = int(txt.y_rel * px_h) - txt_img.height // 2
-                canvas.paste(txt_img, (paste_x, paste_y), txt_img)
-            imgs.append(canvas)
-        
-        if not self.is_export_cancelled:
-            self._save_images(out_dir, imgs)
-
-    def _save_images(self, out_dir, all_images):
-        front = all_images[0::2]; back = all_images[1::2]
-        if self.var_rev_back.get(): back.reverse()
-        if self.var_rot_back.get(): back = [im.rotate(180, expand=True) for im in back]
-        
-        if self.var_output_fmt.get() == "PDF":
-            if front: front[0].save(os.path.join(out_dir, "export_front.pdf"), save_all=True, append_images=front[1:])
-            if back: back[0].save(os.path.join(out_dir, "export_back.pdf"), save_all=True, append_images=back[1:])
-        else:
-            for i, im in enumerate(front): im.save(os.path.join(out_dir, f"front_{i+1:02d}.jpg"), quality=95)
-            for i, im in enumerate(back): im.save(os.path.join(out_dir, f"back_{i+1:02d}.jpg"), quality=95)
+    def _export_options(self):
+        return ExportOptions.from_config(self.config_data, fmt=self.var_output_fmt.get(), reverse_back=self.var_rev_back.get(),
+                                         rotate_back=self.var_rot_back.get(), keep_original=self.var_keep_orig.get(),
+                                         cover_mode=self.is_cover_mode)
 
 if __name__ == "__main__":
     app = HomeBookStudio()
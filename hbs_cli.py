@@ -0,0 +1,240 @@
+"""
+コマンドラインからの書き出し。
+  python HBS.py export project.hbs --out DIR --format pdf|jpg|png|tiff --dpi N ...
+  python HBS.py batch  DIR|manifest.txt --out DIR --jobs N ...
+Tk/customtkinter を読み込まないので、ディスプレイのないサーバーや cron からでも実行できる。
+ただし並列書き出しのワーカー（spawn）は起動したスクリプトを読み込み直すので、HBS.py から起動すると
+ワーカーは tkinter を import する。Tk の入っていない環境では python hbs_cli.py export ... として直接起動する。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from hbs_engine import (CONFIG_FILE, REPORT_FILE, EXPORT_FORMATS, ExportOptions, ExportTelemetry, load_config, load_project_file,
+                        export_page_count, export_project)
+
+def add_export_options(parser):
+    parser.add_argument("--out", required=True, help="出力先フォルダ（なければ作成）")
+    parser.add_argument("--format", choices=[f.lower() for f in EXPORT_FORMATS], help="出力形式（既定: 設定ファイルの startup_export_fmt）")
+    parser.add_argument("--dpi", type=int, help="書き出し解像度（既定: 設定ファイルの export_dpi）")
+    parser.add_argument("--quality", type=int, help="JPEG品質 1-100（既定: 設定ファイルの export_quality）")
+    parser.add_argument("--progressive", action="store_true", help="プログレッシブJPEGにする（JPG出力のみ）")
+    parser.add_argument("--optimize", action="store_true", help="JPEGのハフマン表を最適化する")
+    parser.add_argument("--png-level", type=int, choices=range(10), metavar="0-9", help="PNG圧縮レベル（既定: 設定ファイルの export_png_level）")
+    parser.add_argument("--reverse-back", action="store_true", help="裏面を逆順にする")
+    parser.add_argument("--rotate-back", action="store_true", help="裏面を180°回転する")
+    parser.add_argument("--original", action="store_true", help="レイアウトせず各ページの写真を元の解像度で書き出す")
+    parser.add_argument("--cover", action="store_true", help="表紙モード（左右ページを入れ替える）")
+    parser.add_argument("--direct", action="store_true", help="PDFに写真・文字を直接埋め込む")
+    parser.add_argument("--workers", type=int, help="ページ描画の並列数 (0=自動)")
+    parser.add_argument("--no-page-cache", action="store_true", help="前回の描画結果を再利用しない")
+    parser.add_argument("--config", default=CONFIG_FILE, help=f"設定ファイル（既定: {CONFIG_FILE}）")
+    parser.add_argument("-q", "--quiet", action="store_true", help="進捗を表示しない")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="HBS.py", description="HomeBook Studio のプロジェクトを書き出します")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", help="1つのプロジェクトを書き出す")
+    p_export.add_argument("project", help=".hbs プロジェクトファイル")
+    add_export_options(p_export)
+    p_batch = sub.add_parser("batch", help="複数のプロジェクトをまとめて書き出す")
+    p_batch.add_argument("source", help=".hbs を含むフォルダ（サブフォルダも探す）、または1行に1ファイルを書いたリスト")
+    p_batch.add_argument("--jobs", type=int, default=0, help="同時に書き出すプロジェクト数 (0=CPUコア数)")
+    add_export_options(p_batch)
+    return parser
+
+
+def options_from_args(args, config):
+    overrides = {}
+    if args.format: overrides["fmt"] = args.format.upper()
+    if args.dpi: overrides["dpi"] = args.dpi
+    if args.quality: overrides["quality"] = max(1, min(100, args.quality))
+    if args.progressive: overrides["progressive"] = True
+    if args.optimize: overrides["optimize"] = True
+    if args.png_level is not None: overrides["png_level"] = args.png_level
+    if args.workers is not None: overrides["workers"] = args.workers
+    if args.reverse_back: overrides["reverse_back"] = True
+    if args.rotate_back: overrides["rotate_back"] = True
+    if args.original: overrides["keep_original"] = True
+    if args.cover: overrides["cover_mode"] = True
+    if args.direct: overrides["direct_pdf"] = True
+    if args.no_page_cache: overrides["page_cache"] = False
+    return ExportOptions.from_config(config, **overrides)
+
+
+def format_stats(stats):
+    return [f"画像キャッシュ: ヒット {stats['cache_hits']} / ミス {stats['cache_misses']}",
+            f"ページ: 描画 {stats['pages_rendered']} / 再利用 {stats['pages_reused']}"]
+
+
+def run_export(args, opts):
+    try:
+        project = load_project_file(args.project)
+    except Exception as e:
+        print(f"読込失敗: {args.project}: {e}", file=sys.stderr)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    telemetry = ExportTelemetry(export_page_count(project), opts)
+    def progress(val):
+        if args.quiet: return
+        print(f"\r{telemetry.status_text()}   ", end="", file=sys.stderr, flush=True)
+
+    try:
+        stats = export_project(project, args.out, opts, progress, telemetry=telemetry)
+    except KeyboardInterrupt:
+        print("\n書き出しを中断しました", file=sys.stderr)
+        return 130
+    except Exception as e:
+        print(f"\n書き出し失敗: {e}", file=sys.stderr)
+        return 1
+    if not args.quiet:
+        print(f"\r出力完了 ({telemetry.elapsed:.1f}秒, {telemetry.pages_per_sec:.1f}ページ/秒)" + " " * 24, file=sys.stderr)
+        if stats:
+            for line in format_stats(stats): print(line, file=sys.stderr)
+        print(f"計測レポート: {os.path.join(args.out, REPORT_FILE)}", file=sys.stderr)
+    return 0
+
+# --- Batch ---
+def find_projects(source):
+    """フォルダなら配下の .hbs を、ファイルならリスト（空行と # で始まる行は無視）に書かれたパスを返す"""
+    if os.path.isdir(source):
+        found = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            found += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith(".hbs")]
+        return found
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "r", encoding="utf-8") as f:
+        lines = [ln.strip() for ln in f]
+    return [os.path.join(base, ln) for ln in lines if ln and not ln.startswith("#")]
+
+
+def assign_job_dirs(paths, out_root):
+    """プロジェクトごとの出力フォルダ名（同名のプロジェクトは連番で区別する）"""
+    used = collections.Counter()
+    jobs = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        used[name] += 1
+        if used[name] > 1: name = f"{name}_{used[name]}"
+        jobs.append((path, os.path.join(out_root, name)))
+    return jobs
+
+
+def run_batch_job(path, out_dir, opts):
+    """1プロジェクト分の書き出し（ワーカープロセスで実行）。失敗しても例外は投げずに結果を返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    result = {"project": path, "out": out_dir, "status": "ok", "pages": 0, "duration": 0.0, "error": None}
+    start = time.time()
+    with open(os.path.join(out_dir, "export.log"), "w", encoding="utf-8") as log:
+        def write(msg): log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}\n"); log.flush()
+        write(f"開始: {path}")
+        write(f"設定: {opts}")
+        try:
+            project = load_project_file(path)
+            result["pages"] = export_page_count(project)
+            stats = export_project(project, out_dir, opts)
+            if stats:
+                for line in format_stats(stats): write(line)
+            write("出力完了")
+        except Exception as e:
+            result["status"] = "failed"; result["error"] = f"{type(e).__name__}: {e}"
+            write("失敗\n" + traceback.format_exc())
+        result["duration"] = round(time.time() - start, 3)
+        write(f"所要時間: {result['duration']:.1f}s")
+    return result
+
+
+def run_batch(args, opts):
+    try:
+        paths = find_projects(args.source)
+    except OSError as e:
+        print(f"読込失敗: {args.source}: {e}", file=sys.stderr)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    jobs = assign_job_dirs(paths, args.out)
+    n_jobs = max(1, min(args.jobs if args.jobs > 0 else (os.cpu_count() or 1), len(jobs) or 1))
+    # 複数のプロジェクトを並べて書き出すときは、各プロジェクトのページ描画は並列化しない
+    if n_jobs > 1: opts.workers = 1
+
+    results = {}
+    def report(result):
+        results[result["out"]] = result
+        if not args.quiet:
+            print(f"[{len(results)}/{len(jobs)}] {result['status']:6} {result['pages']:4}p {result['duration']:7.1f}s  {result['project']}"
+                  + (f"  ({result['error']})" if result["error"] else ""), file=sys.stderr)
+
+    start = time.time()
+    try:
+        if n_jobs == 1:
+            for path, out_dir in jobs: report(run_batch_job(path, out_dir, opts))
+        else:
+            _run_batch_pool(jobs, opts, n_jobs, report)
+    except KeyboardInterrupt:
+        print("\n書き出しを中断しました", file=sys.stderr)
+
+    summary = []
+    for path, out_dir in jobs:
+        summary.append(results.get(out_dir) or {"project": path, "out": out_dir, "status": "cancelled", "pages": 0, "duration": 0.0, "error": None})
+    n_ok = sum(1 for r in summary if r["status"] == "ok")
+    with open(os.path.join(args.out, "batch_summary.json"), "w", encoding="utf-8") as f:
+        json.dump({"total": len(summary), "ok": n_ok, "failed": len(summary) - n_ok, "duration": round(time.time() - start, 3),
+                   "jobs": summary}, f, indent=2, ensure_ascii=False)
+    if not args.quiet:
+        print(f"完了: 成功 {n_ok} / 失敗 {len(summary) - n_ok} ({time.time() - start:.1f}s)", file=sys.stderr)
+    return 0 if n_ok == len(summary) else 1
+
+
+def _run_batch_pool(jobs, opts, n_jobs, report):
+    """プロジェクトをプロセスプールで並列に書き出す。投入は同時実行数の2倍までに抑える"""
+    queue = collections.deque(jobs)
+    while queue:
+        suspects = []
+        pool = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn"))
+        running = {}
+        try:
+            while (queue or running) and not suspects:
+                while queue and len(running) < n_jobs * 2:
+                    path, out_dir = queue.popleft()
+                    try: running[pool.submit(run_batch_job, path, out_dir, opts)] = (path, out_dir)
+                    except BrokenProcessPool:
+                        queue.appendleft((path, out_dir))
+                        break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try: report(future.result())
+                    except BrokenProcessPool: suspects.append(job)
+            # ワーカーが異常終了するとプール全体が壊れるので、そのとき実行中だったジョブを1つずつやり直して原因を切り分ける
+            suspects += running.values()
+        finally:
+            pool.shutdown(wait=not suspects, cancel_futures=True)
+        for path, out_dir in suspects: report(_run_isolated(path, out_dir, opts))
+
+
+def _run_isolated(path, out_dir, opts):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        try: return pool.submit(run_batch_job, path, out_dir, opts).result()
+        except BrokenProcessPool:
+            return {"project": path, "out": out_dir, "status": "failed", "pages": 0, "duration": 0.0,
+                    "error": "ワーカープロセスが異常終了しました"}
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    opts = options_from_args(args, load_config(args.config))
+    if args.command == "batch": return run_batch(args, opts)
+    return run_export(args, opts)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
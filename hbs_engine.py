@@ -0,0 +1,1929 @@
+
+import os
+import sys
+import io
+import json
+import time
+import contextlib
+import hashlib
+import math
+import mmap
+import zlib
+import struct
+import copy
+import itertools
+import collections
+import tempfile
+import threading
+import functools
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from typing import List, Dict, Optional, Tuple, Any
+from dataclasses import dataclass, field, asdict, replace
+
+from PIL import Image, ImageDraw, ImageFont, ImageColor, TiffImagePlugin
+
+# --- Constants ---
+MM_TO_INCH = 1 / 25.4
+
+PAPER_SIZES = {
+    "A0": (841, 1189), "A1": (594, 841), "A2": (420, 594), "A3": (297, 420),
+    "A4": (210, 297), "A5": (148, 210), "A6": (105, 148), "B4": (257, 364),
+    "B5": (182, 257), "Hagaki": (100, 148), "L-Size": (89, 127), "2L-Size": (127, 178)
+}
+PAPER_KEYS = sorted(PAPER_SIZES.keys())
+IMG_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+APP_NAME = "HomeBookStudio"
+
+CONFIG_FILE = "config.json"
+DEFAULT_CONFIG = {
+    "auto_save_enabled": False,
+    "auto_save_interval": 5, # minutes
+    "startup_cover_mode": False,
+    "startup_export_fmt": "PDF",
+    "snap_enabled": True,
+    "zoom_sensitivity": 1.1,
+    "export_dpi": 300,
+    "export_bleed_mm": 0.0,
+    "export_quality": 95,
+    "export_jpeg_progressive": False,
+    "export_jpeg_optimize": False,
+    "export_png_level": 6, # 0 (無圧縮・速い) 〜 9 (最小・遅い)
+    "export_crop_marks": False,
+    "export_workers": 0, # 0 = auto (CPU cores)
+    "export_cache_mb": 512,
+    "export_pdf_direct": False,
+    "export_page_cache": True, # 変更のないページは前回の描画結果を再利用する
+    "export_page_cache_mb": 2048,
+    "preview_quality": "medium",
+    "preview_prefetch_spreads": 2, # 編集画面で前後何見開きぶんの写真を先読みするか (0=しない)
+    "viewer_decode_workers": 0, # 0 = auto (CPU cores)
+    "viewer_decode_processes": False, # True: デコードをプロセスで行う（既定はスレッド）
+    "proxy_cache": True, # 表示用の縮小画像をディスクに保存し、次回から元画像を開かずに使う
+    "proxy_cache_mb": 2048,
+    "default_image_folder": "",
+    "default_margin_top": 15.0,
+    "default_margin_bottom": 15.0,
+    "default_margin_inner": 15.0,
+    "default_margin_outer": 15.0
+}
+
+def load_config(path=CONFIG_FILE):
+    """既定値に設定ファイルの内容を上書きした設定を返す（読めなければ既定値のまま）"""
+    config = DEFAULT_CONFIG.copy()
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f: config.update(json.load(f))
+        except: pass
+    return config
+
+def get_user_cache_dir(*parts, create=True):
+    """OSごとのユーザーキャッシュディレクトリ（create ならなければ作る）"""
+    if sys.platform == "win32":
+        base = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local"), APP_NAME, "Cache")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~/Library/Caches"), APP_NAME)
+    else:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), APP_NAME)
+    path = os.path.join(base, *parts)
+    if create: os.makedirs(path, exist_ok=True)
+    return path
+
+# --- Font Helpers ---
+# load_font が返すフォントはスレッド間で共有される。FreeType のフォントはスレッドセーフでないので、
+# 寸法の取得や描画など、フォントを使う処理はすべて FONT_LOCK を取ってから行う
+FONT_LOCK = threading.RLock()
+
+@functools.lru_cache(maxsize=64)
+def load_font(family, size):
+    """フォントを読み込む（同じファミリー・サイズはディスクから読み直さない）。使うときは FONT_LOCK を取ること"""
+    try: return ImageFont.truetype(family, size)
+    except: return ImageFont.load_default()
+
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("RGBA", (1,1)))
+
+@functools.lru_cache(maxsize=2048)
+def measure_text(text, family, size):
+    """テキストの外接矩形 (left, top, right, bottom)。描画位置の計算と当たり判定に使う"""
+    with FONT_LOCK: return _MEASURE_DRAW.textbbox((0,0), text, font=load_font(family, size))
+
+# --- Data Models ---
+@dataclass
+class CropInfo:
+    left: float = 0.0; top: float = 0.0; right: float = 1.0; bottom: float = 1.0
+
+@dataclass
+class PhotoItem:
+    path: str; slot_index: int = 0; rotation: int = 0; crop: CropInfo = field(default_factory=CropInfo)
+
+@dataclass
+class TextItem:
+    text: str; x_rel: float = 0.5; y_rel: float = 0.5; font_size: int = 40
+    color: str = "#000000"; font_family: str = "Arial"; rotation: int = 0; uuid: str = ""
+    def __post_init__(self):
+        if not self.uuid: import uuid; self.uuid = str(uuid.uuid4())
+
+@dataclass
+class Page:
+    layout_name: str = "1枚 (全面)"; spacing_mm: float = 0.0; background_color: str = "#FFFFFF"
+    photos: List[PhotoItem] = field(default_factory=list); texts: List[TextItem] = field(default_factory=list)
+    custom_margins: Optional[Dict[str, float]] = None 
+
+@dataclass
+class Project:
+    paper_size: str = "A4"; orientation: str = "Portrait"
+    margin_top: float = 15.0; margin_bottom: float = 15.0; margin_inner: float = 15.0; margin_outer: float = 15.0
+    pages: List[Page] = field(default_factory=list); current_spread_index: int = 0
+
+class LayoutManager:
+    LAYOUTS = {
+        "1枚 (全面)": [(0.0, 0.0, 1.0, 1.0)], "1枚 (中央)": [(0.1, 0.1, 0.8, 0.8)],
+        "2枚 (縦並び)": [(0.0, 0.0, 1.0, 0.5), (0.0, 0.5, 1.0, 0.5)], "2枚 (横並び)": [(0.0, 0.0, 0.5, 1.0), (0.5, 0.0, 0.5, 1.0)],
+        "3枚 (分割)": [(0.0, 0.0, 1.0, 0.5), (0.0, 0.5, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)],
+        "4枚 (グリッド)": [(0.0, 0.0, 0.5, 0.5), (0.5, 0.0, 0.5, 0.5), (0.0, 0.5, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)],
+        "6枚 (グリッド)": [(0.0, 0.0, 0.5, 0.333), (0.5, 0.0, 0.5, 0.333), (0.0, 0.333, 0.5, 0.333), (0.5, 0.333, 0.5, 0.333), (0.0, 0.666, 0.5, 0.333), (0.5, 0.666, 0.5, 0.333)],
+    }
+    @staticmethod
+    def get_layout_rects(name): return LayoutManager.LAYOUTS.get(name, [(0,0,1,1)])
+
+# --- Project I/O ---
+def load_project_file(path) -> Project:
+    """.hbs ファイル(JSON)からプロジェクトを読み込む"""
+    with open(path, "r", encoding="utf-8") as f: data = json.load(f)
+    project = Project(**data)
+    raw_pages = data.get("pages", [])
+    project.pages = []
+    for p in raw_pages:
+        pg = Page(layout_name=p.get("layout_name", "1枚 (全面)"), spacing_mm=p.get("spacing_mm", 0.0), custom_margins=p.get("custom_margins"), background_color=p.get("background_color", "#FFFFFF"))
+        for ph in p.get("photos", []):
+            try: crop = CropInfo(**ph["crop"]) if ph.get("crop") else CropInfo()
+            except TypeError: crop = CropInfo()
+            pg.photos.append(PhotoItem(path=ph["path"], slot_index=ph.get("slot_index",0), rotation=ph.get("rotation",0), crop=crop))
+        for txt in p.get("texts", []):
+            pg.texts.append(TextItem(text=txt["text"], x_rel=txt["x_rel"], y_rel=txt["y_rel"], font_size=txt.get("font_size",40), color=txt.get("color","black"),
+                                     font_family=txt.get("font_family","Arial"), rotation=txt.get("rotation",0), uuid=txt.get("uuid","")))
+        project.pages.append(pg)
+    return project
+
+# --- Undo History ---
+HISTORY_FIELDS = ("paper_size", "orientation", "margin_top", "margin_bottom", "margin_inner", "margin_outer")
+
+@dataclass
+class HistoryEntry:
+    """1操作分の差分。pages_* はページ構成が変わらなければ {位置: ページ}、増減・並べ替えがあれば全ページのタプル"""
+    fields_before: Dict[str, Any]; fields_after: Dict[str, Any]
+    pages_before: Any; pages_after: Any; cost: int = 0
+
+class ProjectHistory:
+    """
+    元に戻す/やり直しの履歴。操作ごとに、変わった設定とページだけを記録する。
+    記録は次の操作を始める直前（または元に戻す直前）に、前回の記録時の状態と比べて行う。
+    記録した状態のページは書き換えない約束で、変わっていないページは前の履歴とそのまま共有する。
+    同じ group の操作が group_sec 以内に続けば（スライダーのドラッグなど）1つの履歴にまとめる。
+    """
+    def __init__(self, project, max_steps=1000, max_pages=10000, group_sec=1.0):
+        self.max_steps = max_steps; self.max_pages = max_pages; self.group_sec = group_sec
+        self.reset(project)
+
+    def reset(self, project):
+        self.project = project
+        self.undo_stack = collections.deque(); self.redo_stack = []
+        self.stored_pages = 0 # 履歴が持つページのコピー数（メモリ上限の目安）
+        self.group = None; self.group_time = 0.0
+        self.fields = {k: getattr(project, k) for k in HISTORY_FIELDS}
+        self.pages = [(p, copy.deepcopy(p)) for p in project.pages] # (編集中のページ, 記録した状態)
+
+    def checkpoint(self, group=None):
+        """操作を始める前に呼ぶ。直前の操作の変更を履歴に積む"""
+        now = time.monotonic()
+        if group is not None and group == self.group and now - self.group_time < self.group_sec:
+            self.group_time = now
+            return
+        self.commit()
+        self.group = group; self.group_time = now
+
+    def commit(self):
+        entry = self._diff()
+        if entry is None: return False
+        self.undo_stack.append(entry); self.stored_pages += entry.cost
+        self.redo_stack.clear()
+        while len(self.undo_stack) > 1 and (len(self.undo_stack) > self.max_steps or self.stored_pages > self.max_pages):
+            self.stored_pages -= self.undo_stack.popleft().cost
+        return True
+
+    def _diff(self):
+        fields = {k: getattr(self.project, k) for k in HISTORY_FIELDS}
+        recorded = {id(p): saved for p, saved in self.pages}
+        pages = []; cost = 0
+        for p in self.project.pages:
+            saved = recorded.get(id(p))
+            if saved is None or saved != p: saved = copy.deepcopy(p); cost += 1
+            pages.append((p, saved))
+        f_before = {k: v for k, v in self.fields.items() if fields[k] != v}
+        f_after = {k: fields[k] for k in f_before}
+        if len(pages) == len(self.pages) and all(p is q for (p, _), (q, _) in zip(pages, self.pages)):
+            if not cost and not f_before: return None
+            changed = [i for i, ((_, a), (_, b)) in enumerate(zip(self.pages, pages)) if a is not b]
+            p_before = {i: self.pages[i][1] for i in changed}; p_after = {i: pages[i][1] for i in changed}
+        else:
+            p_before = tuple(saved for _, saved in self.pages); p_after = tuple(saved for _, saved in pages)
+        self.fields = fields; self.pages = pages
+        return HistoryEntry(f_before, f_after, p_before, p_after, cost + 1)
+
+    def undo(self):
+        """1つ前の状態に戻す。戻したら HistoryEntry、戻せなければ None"""
+        self.commit()
+        if not self.undo_stack: return None
+        entry = self.undo_stack.pop(); self.stored_pages -= entry.cost
+        self._apply(entry.fields_before, entry.pages_before)
+        self.redo_stack.append(entry)
+        return entry
+
+    def redo(self):
+        self.commit()
+        if not self.redo_stack: return None
+        entry = self.redo_stack.pop(); self.stored_pages += entry.cost
+        self._apply(entry.fields_after, entry.pages_after)
+        self.undo_stack.append(entry)
+        return entry
+
+    def _apply(self, fields, pages):
+        """記録した状態を編集中のプロジェクトに戻す。コピーするのは戻すページだけ"""
+        for k, v in fields.items(): setattr(self.project, k, v)
+        self.fields.update(fields)
+        if isinstance(pages, dict):
+            for i, saved in pages.items():
+                live = copy.deepcopy(saved)
+                self.project.pages[i] = live; self.pages[i] = (live, saved)
+        else:
+            live_of = {id(saved): p for p, saved in self.pages}
+            self.pages = [(live_of[id(saved)] if id(saved) in live_of else copy.deepcopy(saved), saved) for saved in pages]
+            self.project.pages[:] = [p for p, _ in self.pages]
+        self.group = None
+
+# --- Telemetry ---
+class StageTimer:
+    """ステージ名ごとの所要時間（秒）と、デコードした元画像の画素数を積算する"""
+    def __init__(self):
+        self.seconds = {}
+        self.source_px = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - t0
+
+    def add_source(self, w, h):
+        self.source_px += w * h
+
+class _NullTimer(StageTimer):
+    def stage(self, name): return contextlib.nullcontext()
+    def add_source(self, w, h): pass
+
+NULL_TIMER = _NullTimer()
+
+def peak_rss_mb():
+    """このプロセスの最大常駐メモリ(MB)。取得できないOS(Windows)では None"""
+    try: import resource
+    except ImportError: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024  # macOS はバイト、Linux はKB
+
+class ExportTelemetry:
+    """
+    書き出し1回分の計測。ページごと・ステージごとの所要時間、処理した元画像の画素数、
+    最大メモリ使用量、処理速度と残り時間を集め、JSONのレポートにまとめる。
+    ワーカーで計測したステージ時間は全ワーカーの合計なので、並列時は経過時間より大きくなる。
+    """
+    def __init__(self, total, opts=None):
+        self.total = total
+        self.opts = opts
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.timer = StageTimer()
+        self.stages = self.timer.seconds
+        self.pages = []
+        self.source_px = 0
+        self.worker_rss_mb = None
+        self.stats = None
+        self.status = "running"
+        self.duration = None
+
+    def stage(self, name):
+        """呼び出し元のスレッドでのステージ計測（書き込み等）"""
+        return self.timer.stage(name)
+
+    def add_page(self, index, seconds, source_px=0, reused=False, rss_mb=None):
+        for name, sec in seconds.items(): self.stages[name] = self.stages.get(name, 0.0) + sec
+        self.source_px += source_px
+        if rss_mb is not None: self.worker_rss_mb = max(self.worker_rss_mb or 0.0, rss_mb)
+        self.pages.append({"index": index, "reused": reused, "seconds": {k: round(v, 4) for k, v in seconds.items()},
+                           "source_megapixels": round(source_px / 1e6, 3)})
+
+    @property
+    def elapsed(self):
+        return self.duration if self.duration is not None else time.perf_counter() - self.t0
+
+    @property
+    def pages_per_sec(self):
+        return len(self.pages) / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """残り時間（秒）。まだ1ページも終わっていなければ None"""
+        pps = self.pages_per_sec
+        return (self.total - len(self.pages)) / pps if pps > 0 else None
+
+    def status_text(self):
+        text = f"書き出し中 {len(self.pages)}/{self.total}  {self.pages_per_sec:.1f}ページ/秒"
+        if self.eta is not None: text += f"  残り {int(self.eta) // 60}:{int(self.eta) % 60:02d}"
+        return text
+
+    def finish(self, status):
+        self.status = status
+        self.duration = time.perf_counter() - self.t0
+
+    def report(self):
+        main_rss = peak_rss_mb()
+        return {
+            "status": self.status,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration": round(self.elapsed, 3),
+            "options": asdict(self.opts) if self.opts is not None else None,
+            "pages_total": self.total,
+            "pages_done": len(self.pages),
+            "pages_per_sec": round(self.pages_per_sec, 3),
+            "source_megapixels": round(self.source_px / 1e6, 3),
+            "peak_rss_mb": {"main": round(main_rss, 1) if main_rss is not None else None,
+                            "workers": round(self.worker_rss_mb, 1) if self.worker_rss_mb is not None else None},
+            "stages": {k: round(v, 4) for k, v in sorted(self.stages.items(), key=lambda kv: -kv[1])},
+            "stats": self.stats,
+            "pages": self.pages,
+        }
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf-8") as f: json.dump(self.report(), f, indent=2, ensure_ascii=False)
+
+# --- Image Decoding ---
+def rotated_size(w, h, rotation):
+    """rotation 度回転した (w, h) の矩形の外接矩形サイズ"""
+    if not rotation % 360: return w, h
+    rad = math.radians(rotation)
+    c, s = abs(math.cos(rad)), abs(math.sin(rad))
+    return w * c + h * s, w * s + h * c
+
+def crop_region(crop: Optional[CropInfo], w, h):
+    """
+    CropInfo（回転前の元画像に対する0〜1の割合）を (left, top, right, bottom) のピクセル座標にする。
+    指定なし・全体・不正な範囲なら None
+    """
+    if crop is None: return None
+    l, t, r, b = (min(1.0, max(0.0, float(v))) for v in (crop.left, crop.top, crop.right, crop.bottom))
+    if r <= l or b <= t or (l, t, r, b) == (0.0, 0.0, 1.0, 1.0): return None
+    return (l * w, t * h, r * w, b * h)
+
+def crop_key(crop: Optional[CropInfo]):
+    """キャッシュキーに使うクロップの値（全体なら None）"""
+    return None if crop_region(crop, 1, 1) is None else (crop.left, crop.top, crop.right, crop.bottom)
+
+def page_signature(page: Page):
+    """ページの見た目を決める値をまとめたもの（比較・ハッシュ可能）。描き直しが必要かの判定に使う"""
+    return (page.layout_name, page.spacing_mm, page.background_color,
+            tuple(sorted(page.custom_margins.items())) if page.custom_margins else None,
+            tuple((p.path, p.slot_index, p.rotation, crop_key(p.crop)) for p in page.photos),
+            tuple((t.text, t.x_rel, t.y_rel, t.font_size, t.color, t.font_family, t.rotation) for t in page.texts))
+
+_TRANSPOSE = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
+
+def rotate_photo(im, rotation, resample=Image.BICUBIC):
+    """時計回りに rotation 度回転する。90°の倍数は画質の劣化しない transpose で行う"""
+    r = rotation % 360
+    if not r: return im
+    if r in _TRANSPOSE: return im.transpose(_TRANSPOSE[r])
+    return im.rotate(-rotation, expand=True, resample=resample)
+
+def export_photo_mode(im):
+    """書き出し用に RGB か（透過があれば）RGBA にそろえる。透過部分はページの背景色の上に合成する"""
+    if im.mode in ("RGB", "RGBA"): return im
+    return im.convert("RGBA" if "A" in im.getbands() else "RGB")
+
+def decode_reduced(path, box, rotation=0, cover=False, reducing_gap=1.0, crop: Optional[CropInfo] = None,
+                   timer: StageTimer = NULL_TIMER) -> Tuple[Image.Image, Tuple[float, float, float, float]]:
+    """
+    box (w, h) への縮小表示に必要な最小解像度で画像をデコードし、(画像, クロップ範囲) を返す。
+    クロップ範囲はデコードした画像上の座標で、最終的なリサンプルは呼び出し側で行うこと。
+    JPEGはDCTスケーリング(draft)で、それ以外は reduce() で縮小する（クロップ外は縮小しない）。
+    cover=True は ImageOps.fit のように box を覆うサイズを基準にする。
+    """
+    with timer.stage("decode"):
+        im = Image.open(path)
+        timer.add_source(*im.size)
+        return _decode_reduced(im, box, rotation, cover, reducing_gap, crop)
+
+def _decode_reduced(im, box, rotation, cover, reducing_gap, crop):
+    src_w, src_h = im.size
+    region = crop_region(crop, src_w, src_h) or (0, 0, src_w, src_h)
+    # 回転後のクロップ範囲の外接矩形が box に収まる倍率を求める
+    rot_w, rot_h = rotated_size(region[2] - region[0], region[3] - region[1], rotation)
+    box_w, box_h = max(1, box[0]), max(1, box[1])
+    ratio = max(box_w / rot_w, box_h / rot_h) if cover else min(box_w / rot_w, box_h / rot_h)
+    ratio = ratio * max(1.0, reducing_gap)
+    if ratio >= 1.0:
+        im.load()
+        return im, region
+
+    need_w = max(1, int(math.ceil(src_w * ratio)))
+    need_h = max(1, int(math.ceil(src_h * ratio)))
+    if im.format == "JPEG":
+        im.draft(None, (need_w, need_h))
+        sx, sy = im.width / src_w, im.height / src_h
+        region = (region[0] * sx, region[1] * sy, region[2] * sx, region[3] * sy)
+    factor = min(im.width // need_w, im.height // need_h)
+    if factor < 2:
+        im.load()
+        return im, region
+    # クロップ範囲を factor の倍数に広げた部分だけを縮小する
+    x0 = int(region[0] // factor) * factor; y0 = int(region[1] // factor) * factor
+    x1 = min(im.width, int(math.ceil(region[2] / factor)) * factor); y1 = min(im.height, int(math.ceil(region[3] / factor)) * factor)
+    im = im.reduce(factor, box=(x0, y0, x1, y1))
+    region = ((region[0] - x0) / factor, (region[1] - y0) / factor, (region[2] - x0) / factor, (region[3] - y0) / factor)
+    return im, region
+
+def decode_thumbnail(path, box, rotation=0, resample=Image.BICUBIC, reducing_gap=1.0, mode=None, crop: Optional[CropInfo] = None,
+                     cover=False, timer: StageTimer = NULL_TIMER) -> Image.Image:
+    """
+    写真の変換をまとめて行う: クロップ → 縮小デコード → 1回のリサンプル → 回転。
+    既定では box に収まるサイズ（拡大はしない）、cover=True では box を覆うように拡大縮小して box の大きさに切り抜く。
+    """
+    im, region = decode_reduced(path, box, rotation, cover, reducing_gap, crop, timer)
+    return _finish_thumbnail(im, region, box, rotation, resample, mode, cover, timer)
+
+def _finish_thumbnail(im, region, box, rotation, resample, mode, cover, timer=NULL_TIMER):
+    """decode_reduced の結果をリサンプル・回転して box の大きさに仕上げる"""
+    with timer.stage("resize"):
+        if mode and im.mode != mode: im = im.convert(mode)
+        elif im.mode in ("P", "1"): im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+        reg_w, reg_h = region[2] - region[0], region[3] - region[1]
+        rot_w, rot_h = rotated_size(reg_w, reg_h, rotation)
+        box_w, box_h = max(1, int(box[0])), max(1, int(box[1]))
+        scale = max(box_w / rot_w, box_h / rot_h) if cover else min(box_w / rot_w, box_h / rot_h, 1.0)
+        out_w, out_h = max(1, int(round(reg_w * scale))), max(1, int(round(reg_h * scale)))
+        if not cover and rotation % 90 == 0:
+            # 丸め誤差で box をはみ出さないようにする（90°/270°は縦横が入れ替わる）
+            lim_w, lim_h = (box_h, box_w) if rotation % 180 else (box_w, box_h)
+            out_w, out_h = min(out_w, lim_w), min(out_h, lim_h)
+        if (out_w, out_h) != im.size or region != (0, 0, im.width, im.height):
+            im = im.resize((out_w, out_h), resample, box=region)
+    with timer.stage("rotate"):
+        im = rotate_photo(im, rotation)
+    # cover では box の大きさに、それ以外でも任意角の回転で外接矩形が丸めで広がった分は中央で切り抜く
+    crop_w, crop_h = (box_w, box_h) if cover else (min(im.width, box_w), min(im.height, box_h))
+    if im.size != (crop_w, crop_h):
+        left, top = (im.width - crop_w) // 2, (im.height - crop_h) // 2
+        im = im.crop((left, top, left + crop_w, top + crop_h))
+    return im
+
+class DecodeCache:
+    """
+    書き出し1回分の縮小済み画像キャッシュ（LRU・バイト数上限つき）。
+    パス・更新日時・回転・クロップ・目標サイズをキーにするので、同じ写真を何度使っても
+    デコードとリサンプルは1回で済む。
+    """
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self.used = 0
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _nbytes(im):
+        return im.width * im.height * len(im.getbands())
+
+    def get(self, path, rotation, box, loader, crop: Optional[CropInfo] = None):
+        key = (path, os.path.getmtime(path), rotation, crop_key(crop), box)
+        im = self.items.get(key)
+        if im is not None:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return im
+        self.misses += 1
+        im = loader()
+        size = self._nbytes(im)
+        if size <= self.budget:
+            self.items[key] = im
+            self.used += size
+            while self.used > self.budget:
+                _, old = self.items.popitem(last=False)
+                self.used -= self._nbytes(old)
+        return im
+
+# --- Proxy Cache ---
+PROXY_LEVELS = (320, 1280) # プロキシの長辺の画素数。表示に足りる一番小さいものを使う
+PROXY_RAW_MAX = 512        # この長辺以下のプロキシは無圧縮の画素列で持つ（mmap でそのまま読む）。大きいものは JPEG
+
+class ProxyStore:
+    """
+    画面表示用の縮小画像（プロキシ）のディスクキャッシュ。
+    ファイル名は元画像のパス・サイズ・更新日時とレベルから作るハッシュなので、写真を差し替えれば自然に作り直される。
+    ファイルはヘッダー（形式・モード・大きさ・元画像の大きさ）＋画素列または JPEG。
+    表示に必要な解像度を満たすプロキシがあれば元画像は開かない。合計サイズが上限を超えたら、長く使っていないものから消す。
+    """
+    VERSION = 1
+    HEADER = struct.Struct("<4sB7s4I")  # magic, 形式 (0=画素列, 1=JPEG), モード, 幅, 高さ, 元の幅, 元の高さ
+    MAGIC = b"HBPX"
+    PRUNE_EVERY = 64  # この数だけ書き込むごとに上限を確認する
+
+    def __init__(self, directory, max_bytes=0, levels=PROXY_LEVELS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.levels = tuple(sorted(levels))
+        self.lock = threading.Lock(); self.puts = 0
+        self.hits = 0; self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, st, level):
+        payload = f"{self.VERSION}|{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{level}"
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".px")
+
+    def _open(self, path):
+        """(ヘッダーの値, mmap) か None。画素はまだ読まない。mmap は呼び出し側が閉じる"""
+        try:
+            with open(path, "rb") as f: buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): return None
+        try:
+            head = self.HEADER.unpack_from(buf)
+            if head[0] == self.MAGIC: return head, buf
+        except struct.error: pass
+        buf.close()
+        return None
+
+    def _image(self, head, buf):
+        """画素を mmap から画像にコピーする（返した画像は mmap を閉じても使える）"""
+        _, fmt, mode, w, h, _, _ = head
+        with memoryview(buf) as view, view[self.HEADER.size:] as data:
+            if fmt == 1: return Image.open(io.BytesIO(data))
+            mode = mode.rstrip(b"\0").decode("ascii")
+            return Image.frombytes(mode, (w, h), data, "raw", mode, 0, 1)
+
+    @staticmethod
+    def enough(proxy_size, src_size, box, rotation=0, crop: Optional[CropInfo] = None, cover=False):
+        """proxy_size のプロキシから、元画像から作るのと同じ大きさで box の表示ができるか"""
+        pw, ph = proxy_size
+        if pw >= src_size[0] and ph >= src_size[1]: return True  # 元画像と同じ大きさ
+        region = crop_region(crop, pw, ph) or (0, 0, pw, ph)
+        rot_w, rot_h = rotated_size(region[2] - region[0], region[3] - region[1], rotation)
+        box_w, box_h = max(1, box[0]), max(1, box[1])
+        ratio = max(box_w / rot_w, box_h / rot_h) if cover else min(box_w / rot_w, box_h / rot_h)
+        return ratio <= 1.0 + 1e-6
+
+    def decode(self, path, box, rotation=0, resample=Image.BICUBIC, crop: Optional[CropInfo] = None, cover=False, mode=None) -> Image.Image:
+        """decode_thumbnail と同じ結果を、足りるプロキシがあればそこから作る。なければ作って保存する"""
+        st = os.stat(path)
+        src_size = None
+        for level in self.levels:
+            fpath = self._path(self.key(path, st, level))
+            found = self._open(fpath)
+            if found is None: continue
+            head, buf = found
+            # 使い終わったらすぐ閉じる（Windows では開いたままのファイルを prune で消せない）
+            with buf:
+                src_size = (head[5], head[6])
+                if not self.enough((head[3], head[4]), src_size, box, rotation, crop, cover): continue
+                try: os.utime(fpath)  # 最近使ったものとして残す
+                except OSError: pass
+                self.hits += 1
+                im = self._image(head, buf)
+            return self._from_proxy(im, box, rotation, resample, crop, cover, mode)
+
+        self.misses += 1
+        if src_size is None:
+            with Image.open(path) as im: src_size = im.size  # ヘッダーだけ読む
+        for level in self.levels:
+            s = min(1.0, level / max(src_size))
+            size = (max(1, int(round(src_size[0] * s))), max(1, int(round(src_size[1] * s))))
+            if self.enough(size, src_size, box, rotation, crop, cover):
+                return self._from_proxy(self._create(path, st, level, src_size), box, rotation, resample, crop, cover, mode)
+        # どのプロキシよりも大きく表示するときは元画像から
+        return decode_thumbnail(path, box, rotation, resample, mode=mode, crop=crop, cover=cover)
+
+    @staticmethod
+    def _from_proxy(im, box, rotation, resample, crop, cover, mode):
+        im, region = _decode_reduced(im, box, rotation, cover, 1.0, crop)
+        return _finish_thumbnail(im, region, box, rotation, resample, mode, cover)
+
+    def _create(self, path, st, level, src_size):
+        im = decode_thumbnail(path, (level, level))
+        if im.mode not in ("L", "RGB", "RGBA"): im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        if level <= PROXY_RAW_MAX or im.mode == "RGBA": fmt, payload = 0, im.tobytes()
+        else:
+            out = io.BytesIO(); im.save(out, "JPEG", quality=90)
+            fmt, payload = 1, out.getvalue()
+        head = self.HEADER.pack(self.MAGIC, fmt, im.mode.encode("ascii"), im.width, im.height, src_size[0], src_size[1])
+        # 一時ファイルに書いてから置き換え、読み込み中の他のスレッドが壊れたファイルを見ないようにする
+        fpath = self._path(self.key(path, st, level))
+        tmp = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f: f.write(head); f.write(payload)
+            os.replace(tmp, fpath)
+        except OSError:
+            try: os.remove(tmp)
+            except OSError: pass
+        with self.lock:
+            self.puts += 1
+            check = self.puts % self.PRUNE_EVERY == 0
+        if check: self.prune()
+        return im
+
+    def clear(self):
+        for e in os.scandir(self.directory):
+            try: os.remove(e.path)
+            except OSError: pass
+
+    def prune(self):
+        """合計サイズが上限を超えていたら、長く使っていないものから消す"""
+        if self.max_bytes <= 0: return
+        entries = []
+        for e in os.scandir(self.directory):
+            try: st = e.stat(); entries.append((st.st_mtime, st.st_size, e.path))
+            except OSError: pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try: os.remove(path); total -= size
+            except OSError: pass
+
+_proxy_store: Optional[ProxyStore] = None
+_proxy_lock = threading.Lock()
+
+def get_proxy_store(max_mb=None) -> ProxyStore:
+    """プロセスで共有するプロキシストア（初回に作る）。max_mb を渡すと上限を変える"""
+    global _proxy_store
+    with _proxy_lock:
+        if _proxy_store is None:
+            _proxy_store = ProxyStore(get_user_cache_dir("proxies"), DEFAULT_CONFIG["proxy_cache_mb"] * 1024 * 1024)
+    if max_mb is not None: _proxy_store.max_bytes = max_mb * 1024 * 1024
+    return _proxy_store
+
+def clear_proxy_cache():
+    """プロキシキャッシュのファイルを消す。プロキシを使っていなければストアもフォルダも作らない"""
+    with _proxy_lock: store = _proxy_store
+    if store is not None: store.clear()
+    elif os.path.isdir(get_user_cache_dir("proxies", create=False)):
+        ProxyStore(get_user_cache_dir("proxies")).clear()
+
+def decode_proxy(path, box, rotation=0, resample=Image.BICUBIC, crop: Optional[CropInfo] = None, cover=False, use_cache=True) -> Image.Image:
+    """画面表示用の decode_thumbnail。use_cache ならプロキシキャッシュを通す（プロセスプールからも呼べる）"""
+    if not use_cache: return decode_thumbnail(path, box, rotation, resample, crop=crop, cover=cover)
+    return get_proxy_store().decode(path, box, rotation, resample, crop, cover)
+
+# --- Folder Scanning ---
+class FolderScanner:
+    """
+    写真フォルダの走査（サブフォルダも含む）。scan() は見つけたファイルを batch 件ずつのリストで返すジェネレーター。
+    読んだフォルダの更新日時と中身を覚えておき、poll() では更新日時が変わったフォルダだけを読み直して、
+    追加・削除されたファイルを返す（フォルダの更新日時は直下のファイルやフォルダが増減したときに変わる）。
+    """
+    def __init__(self, root, exts=IMG_EXTS, batch=200):
+        self.root = os.path.normpath(root)
+        self.exts = exts
+        self.batch = batch
+        self.dirs = {}  # フォルダ -> (更新日時, 直下の対象ファイルの集合, 直下のサブフォルダの集合)
+
+    @staticmethod
+    def order_key(path):
+        """scan() が返す順（フォルダごとに名前順、フォルダ内のファイルはサブフォルダより先）に並べるためのキー"""
+        return (tuple(os.path.dirname(path).split(os.sep)), os.path.basename(path))
+
+    def _read_dir(self, path):
+        # 更新日時は中身より先に取る（読んでいる途中で変わっても、次の poll() で読み直される）
+        try:
+            st = os.stat(path)
+            files, subdirs = [], []
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False): subdirs.append(e.path)
+                        elif e.name.lower().endswith(self.exts) and e.is_file(): files.append(e.path)
+                    except OSError: pass
+        except OSError: return None
+        files.sort(); subdirs.sort()
+        self.dirs[path] = (st.st_mtime_ns, set(files), set(subdirs))
+        return files, subdirs
+
+    def scan(self, is_cancelled=lambda: False):
+        """全体を走査する（前回の結果は捨てる）"""
+        self.dirs = {}
+        yield from self._walk([self.root], is_cancelled)
+
+    def _walk(self, roots, is_cancelled=lambda: False):
+        batch = []
+        stack = list(reversed(roots))
+        while stack:
+            if is_cancelled(): return
+            read = self._read_dir(stack.pop())
+            if read is None: continue
+            files, subdirs = read
+            stack.extend(reversed(subdirs))
+            for f in files:
+                batch.append(f)
+                if len(batch) >= self.batch:
+                    yield batch
+                    batch = []
+        if batch: yield batch
+
+    def poll(self):
+        """前回から変わったフォルダだけを読み直し、(追加されたファイル, 削除されたファイル) を返す"""
+        added, removed = [], []
+        for path in list(self.dirs):
+            if path not in self.dirs: continue  # 親フォルダと一緒に消えた
+            mtime, old_files, old_subdirs = self.dirs[path]
+            # 一時的に読めないフォルダ（権限・ネットワークの切断など）は前回の内容のままにして、次の poll() で読み直す
+            try: st = os.stat(path)
+            except FileNotFoundError:
+                removed += self._forget(path)
+                continue
+            except OSError: continue
+            if st.st_mtime_ns == mtime: continue
+            read = self._read_dir(path)
+            if read is None: continue
+            files, subdirs = read
+            added += [f for f in files if f not in old_files]
+            removed += list(old_files - set(files))
+            for d in old_subdirs - set(subdirs): removed += self._forget(d)
+            for batch in self._walk([d for d in subdirs if d not in old_subdirs]): added += batch
+        return added, removed
+
+    def _forget(self, path):
+        """path とその下のフォルダを忘れ、そこにあったファイルを返す"""
+        prefix = os.path.join(path, "")
+        gone = []
+        for d in [d for d in self.dirs if d == path or d.startswith(prefix)]:
+            gone += self.dirs.pop(d)[1]
+        return gone
+
+# --- Display Image Loading ---
+class ImageLoadQueue:
+    """
+    画面表示用の画像読み込み待ち行列（スレッドセーフ）。
+    - 同じキーの要求は1つにまとめ、デコードは1回だけ行って待っている表示先すべてに渡す（デコード中に来た要求も合流する）。
+    - 優先度は小さいほど先。同じキーがより高い優先度で要求されたり reprioritize されたりすると繰り上がる。
+    - 取り出すときに is_live で表示先を確かめ、生きている表示先が残っていない要求はデコードせずに捨てる。
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []  # (優先度, 通し番号, キー)。繰り上げ前の古い項目は取り出し時に読み飛ばす
+        self.entries = {}  # キー -> [優先度, 読み込み引数, 表示先リスト]
+        self.in_flight = {}  # デコード中のキー -> 表示先リスト
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, key, args, target, priority=0):
+        with self.cond:
+            if key in self.in_flight:
+                self.in_flight[key].append(target)
+                return
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [priority, args, [target]]
+            else:
+                entry[2].append(target)
+                if priority >= entry[0]: return
+                entry[0] = priority
+            heapq.heappush(self.heap, (priority, next(self.seq), key))
+            self.cond.notify()
+
+    def reprioritize(self, priority_of):
+        """待っている要求の優先度を、表示先ごとの priority_of(target) の最小値に付け直す"""
+        with self.cond:
+            for key, entry in self.entries.items():
+                priority = min(priority_of(t) for t in entry[2])
+                if priority != entry[0]:
+                    entry[0] = priority
+                    heapq.heappush(self.heap, (priority, next(self.seq), key))
+
+    def get(self, timeout=None, is_live=lambda target: True):
+        """最も優先度の高い要求を (キー, 読み込み引数) で返す。timeout までに無ければ None"""
+        with self.cond:
+            while True:
+                while self.heap:
+                    priority, _, key = heapq.heappop(self.heap)
+                    entry = self.entries.get(key)
+                    if entry is None or entry[0] != priority: continue
+                    del self.entries[key]
+                    targets = [t for t in entry[2] if is_live(t)]
+                    if not targets: continue
+                    self.in_flight[key] = targets
+                    return key, entry[1]
+                if not self.cond.wait(timeout): return None
+
+    def done(self, key):
+        """デコードが終わった要求の表示先（デコード中に合流したものを含む）を返す"""
+        with self.cond:
+            return self.in_flight.pop(key, [])
+
+    def clear(self):
+        with self.cond:
+            self.heap = []
+            self.entries = {}
+
+# --- PDF Fonts ---
+class SfntFont:
+    """
+    PDFへ埋め込むための TrueType フォント（.ttf / .ttc の1書体）。
+    文字→グリフID、グリフ送り幅、フォント記述子用のメトリクスを読み出す。
+    CFFアウトライン(OTF)や埋め込み禁止フォントは embeddable=False になる。
+    """
+    _loaded = {}
+
+    def __init__(self, path, index=0):
+        with open(path, "rb") as f: raw = f.read()
+        base = 0
+        if raw[:4] == b"ttcf":
+            base = struct.unpack(">I", raw[12 + 4 * index:16 + 4 * index])[0]
+        self.version = raw[base:base + 4]
+        num_tables = struct.unpack(">H", raw[base + 4:base + 6])[0]
+        self.records = []
+        self.tables = {}
+        for i in range(num_tables):
+            tag, checksum, offset, length = struct.unpack(">4sIII", raw[base + 12 + 16 * i:base + 28 + 16 * i])
+            self.records.append((tag, checksum))
+            self.tables[tag] = raw[offset:offset + length]
+        self.is_ttc = (base != 0 or raw[:4] == b"ttcf")
+        self._raw = raw
+        self.name = "".join(c for c in os.path.splitext(os.path.basename(path))[0] if c.isalnum()) or "Font"
+        if self.is_ttc: self.name += f"-{index}"
+
+        head = self.tables[b"head"]
+        self.units_per_em = struct.unpack(">H", head[18:20])[0]
+        self.bbox = struct.unpack(">hhhh", head[36:44])
+        hhea = self.tables[b"hhea"]
+        self.ascent, self.descent = struct.unpack(">hh", hhea[4:8])
+        num_hmetrics = struct.unpack(">H", hhea[34:36])[0]
+        hmtx = self.tables[b"hmtx"]
+        self.advances = [struct.unpack(">H", hmtx[4 * i:4 * i + 2])[0] for i in range(num_hmetrics)]
+        os2 = self.tables.get(b"OS/2", b"")
+        fs_type = struct.unpack(">H", os2[8:10])[0] if len(os2) >= 10 else 0
+        self.cap_height = struct.unpack(">h", os2[88:90])[0] if len(os2) >= 90 else self.ascent
+        self.embeddable = b"glyf" in self.tables and not (fs_type & 0x0002)
+        self.cmap = self._parse_cmap(self.tables.get(b"cmap", b""))
+
+    @classmethod
+    def load(cls, path, index=0):
+        key = (path, index)
+        if key not in cls._loaded:
+            try: cls._loaded[key] = cls(path, index)
+            except Exception: cls._loaded[key] = None
+        return cls._loaded[key]
+
+    @staticmethod
+    def _parse_cmap(data):
+        if not data: return {}
+        count = struct.unpack(">H", data[2:4])[0]
+        subtables = {}
+        for i in range(count):
+            pid, eid, offset = struct.unpack(">HHI", data[4 + 8 * i:12 + 8 * i])
+            subtables[(pid, eid)] = offset
+        mapping = {}
+        for key in ((3, 10), (0, 4), (3, 1), (0, 3)):
+            if key not in subtables: continue
+            off = subtables[key]
+            fmt = struct.unpack(">H", data[off:off + 2])[0]
+            if fmt == 12:
+                n_groups = struct.unpack(">I", data[off + 12:off + 16])[0]
+                for g in range(n_groups):
+                    start, end, gid = struct.unpack(">III", data[off + 16 + 12 * g:off + 28 + 12 * g])
+                    for cp in range(start, end + 1): mapping[cp] = gid + cp - start
+                return mapping
+            if fmt == 4:
+                seg_x2 = struct.unpack(">H", data[off + 6:off + 8])[0]
+                ends = off + 14; starts = ends + seg_x2 + 2; deltas = starts + seg_x2; ranges = deltas + seg_x2
+                for s in range(seg_x2 // 2):
+                    end = struct.unpack(">H", data[ends + 2 * s:ends + 2 * s + 2])[0]
+                    start = struct.unpack(">H", data[starts + 2 * s:starts + 2 * s + 2])[0]
+                    delta = struct.unpack(">h", data[deltas + 2 * s:deltas + 2 * s + 2])[0]
+                    range_off = struct.unpack(">H", data[ranges + 2 * s:ranges + 2 * s + 2])[0]
+                    for cp in range(start, min(end, 0xFFFE) + 1):
+                        if range_off == 0:
+                            gid = (cp + delta) & 0xFFFF
+                        else:
+                            pos = ranges + 2 * s + range_off + 2 * (cp - start)
+                            gid = struct.unpack(">H", data[pos:pos + 2])[0]
+                            if gid: gid = (gid + delta) & 0xFFFF
+                        if gid: mapping[cp] = gid
+                return mapping
+        return mapping
+
+    def glyph_id(self, ch):
+        return self.cmap.get(ord(ch), 0)
+
+    def advance(self, gid):
+        """グリフ送り幅（1000ユニット単位）"""
+        if not self.advances: return 1000
+        return self.advances[min(gid, len(self.advances) - 1)] * 1000.0 / self.units_per_em
+
+    def font_program(self):
+        """埋め込み用のフォントデータ。TTCの場合は該当書体だけを単体のTrueTypeとして組み直す"""
+        if not self.is_ttc: return self._raw
+        num = len(self.records)
+        entry_sel = max(0, num.bit_length() - 1)
+        search_range = (1 << entry_sel) * 16
+        header = struct.pack(">4sHHHH", self.version, num, search_range, entry_sel, num * 16 - search_range)
+        offset = 12 + 16 * num
+        directory, body = [], []
+        for tag, checksum in self.records:
+            data = self.tables[tag]
+            directory.append(struct.pack(">4sIII", tag, checksum, offset, len(data)))
+            padded = data + b"\0" * (-len(data) % 4)
+            body.append(padded)
+            offset += len(padded)
+        return header + b"".join(directory) + b"".join(body)
+
+def resolve_font_file(family, size):
+    """Pillowで読み込んだフォントの実ファイルと書体番号を返す。ファイルが無い場合は None"""
+    fnt = load_font(family, size)
+    path = getattr(fnt, "path", None)
+    if isinstance(path, str) and os.path.exists(path): return fnt, path, getattr(fnt, "index", 0)
+    return fnt, None, 0
+
+# --- Export Writers ---
+# 出力形式ごとのページ画像のコーデック（PDFはJPEGをDCTストリームとして埋め込む）と拡張子
+PAGE_CODECS = {"PDF": "JPEG", "JPG": "JPEG", "PNG": "PNG", "TIFF": "TIFF"}
+CODEC_EXTS = {"JPEG": ".jpg", "PNG": ".png", "TIFF": ".tif"}
+EXPORT_FORMATS = list(PAGE_CODECS)
+
+@dataclass
+class EncodeSettings:
+    """ページ画像のエンコード設定"""
+    codec: str = "JPEG"  # JPEG / PNG / TIFF
+    quality: int = 95; progressive: bool = False; optimize: bool = False  # JPEG
+    png_level: int = 6  # PNGの圧縮レベル
+    dpi: Optional[int] = None  # ファイルに記録する解像度
+
+@dataclass
+class EncodedPage:
+    """エンコード済みのページ（ワーカーからの受け渡しとページキャッシュに使う）"""
+    data: bytes; size: Tuple[int, int]; mode: str = "RGB"
+    codec: str = "JPEG"; rotation: int = 0  # rotation はエンコード前に適用済みの回転
+
+    @classmethod
+    def from_bytes(cls, data, rotation=0):
+        with Image.open(io.BytesIO(data)) as im:  # ヘッダーだけ読む
+            return cls(data, im.size, im.mode, im.format, rotation)
+
+    def to_image(self) -> Image.Image:
+        im = Image.open(io.BytesIO(self.data))
+        im.load()
+        return im
+
+def encode_page(im, settings: Optional[EncodeSettings] = None, rotation=0) -> EncodedPage:
+    """ページ画像を rotation 度回転してからエンコードする"""
+    if settings is None: settings = EncodeSettings()
+    if im.mode not in ("RGB", "L"): im = im.convert("RGB")
+    if rotation: im = rotate_photo(im, rotation)
+    params = {"dpi": (settings.dpi, settings.dpi)} if settings.dpi else {}
+    if settings.codec == "PNG": params.update(compress_level=settings.png_level)
+    elif settings.codec == "TIFF": params.update(compression="tiff_adobe_deflate")
+    else: params.update(quality=settings.quality, progressive=settings.progressive, optimize=settings.optimize)
+    buf = io.BytesIO()
+    im.save(buf, settings.codec, **params)
+    return EncodedPage(buf.getvalue(), im.size, im.mode, settings.codec, rotation)
+
+def _timed_encode(im, settings, rotation=0):
+    t0 = time.perf_counter()
+    enc = encode_page(im, settings, rotation)
+    return enc, time.perf_counter() - t0
+
+def iter_encoded(jobs, max_workers=0):
+    """
+    jobs の (tag, 画像, EncodeSettings, 回転) を順番どおりに (tag, EncodedPage, エンコード秒数) にして返すジェネレーター。
+    エンコードはスレッドプールで並列に行う（Pillowはエンコード中GILを解放する）。
+    先行してエンコードするページ数はスレッド数までに抑える。エンコード済みの EncodedPage はそのまま返す。
+    """
+    workers = resolve_worker_count(max_workers, os.cpu_count() or 1)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for tag, im, settings, rotation in jobs:
+            pending.append((tag, im if isinstance(im, EncodedPage) else pool.submit(_timed_encode, im, settings, rotation)))
+            while len(pending) > workers:
+                tag, job = pending.popleft()
+                yield (tag, job, 0.0) if isinstance(job, EncodedPage) else (tag, *job.result())
+        while pending:
+            tag, job = pending.popleft()
+            yield (tag, job, 0.0) if isinstance(job, EncodedPage) else (tag, *job.result())
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+class PdfStreamWriter:
+    """
+    1ページずつPDFへ書き込むライター。
+    受け取ったページはその場でJPEG(DCTDecode)ストリームとして書き出すため、
+    ページ数に関係なくメモリには常に1ページ分しか残らない。
+    """
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, path, resolution=72.0, quality=95):
+        self.path = path
+        self.resolution = float(resolution)
+        self.quality = quality
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3
+        self.fp = open(path, "wb")
+        self.fp.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _new_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def _write_obj(self, obj_id, body):
+        self.offsets[obj_id] = self.fp.tell()
+        self.fp.write(f"{obj_id} 0 obj\n".encode("ascii") + body + b"\nendobj\n")
+
+    def _write_stream(self, obj_id, dict_body, data):
+        head = f"<< {dict_body} /Length {len(data)} >>\nstream\n".encode("ascii")
+        self._write_obj(obj_id, head + data + b"\nendstream")
+
+    def add_page(self, im, rotate=0):
+        """im は PIL画像またはエンコード済みの EncodedPage（JPEGなら再エンコードせずそのまま埋め込む）"""
+        if not isinstance(im, EncodedPage): enc = encode_page(im, EncodeSettings(quality=self.quality))
+        elif im.codec != "JPEG": enc = replace(encode_page(im.to_image(), EncodeSettings(quality=self.quality)), rotation=im.rotation)
+        else: enc = im
+        rotate -= enc.rotation  # エンコード前に回してあるぶんは /Rotate から差し引く
+        color_space = "/DeviceGray" if enc.mode == "L" else "/DeviceRGB"
+        iw, ih = enc.size
+
+        img_id = self._new_id()
+        self._write_stream(img_id, f"/Type /XObject /Subtype /Image /Width {iw} /Height {ih} "
+                                   f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode", enc.data)
+        enc = None
+
+        pt_w = iw * 72.0 / self.resolution
+        pt_h = ih * 72.0 / self.resolution
+        content = f"q {pt_w:.4f} 0 0 {pt_h:.4f} 0 0 cm /Im0 Do Q".encode("ascii")
+        self._add_page_obj(pt_w, pt_h, content, f"/XObject << /Im0 {img_id} 0 R >>", rotate)
+
+    def _add_page_obj(self, pt_w, pt_h, content, resources, rotate=0):
+        content_id = self._new_id()
+        self._write_stream(content_id, "", content)
+
+        page_id = self._new_id()
+        rot = f" /Rotate {rotate % 360}" if rotate % 360 else ""
+        self._write_obj(page_id, (f"<< /Type /Page /Parent {self.PAGES_ID} 0 R /MediaBox [0 0 {pt_w:.4f} {pt_h:.4f}]"
+                                  f" /Resources << {resources} >> /Contents {content_id} 0 R{rot} >>").encode("ascii"))
+        self.page_ids.append(page_id)
+
+    def close(self, reverse=False):
+        """ページツリーと相互参照表を書いてファイルを閉じる。reverse=True でページ順を反転する"""
+        kids = list(reversed(self.page_ids)) if reverse else self.page_ids
+        kids_ref = " ".join(f"{k} 0 R" for k in kids)
+        self._write_obj(self.PAGES_ID, f"<< /Type /Pages /Kids [{kids_ref}] /Count {len(kids)} >>".encode("ascii"))
+        self._write_obj(self.CATALOG_ID, f"<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>".encode("ascii"))
+
+        xref_pos = self.fp.tell()
+        lines = [f"xref\n0 {self.next_id}\n", "0000000000 65535 f \n"]
+        for obj_id in range(1, self.next_id):
+            lines.append(f"{self.offsets[obj_id]:010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {self.next_id} /Root {self.CATALOG_ID} 0 R >>\nstartxref\n{xref_pos}\n%%EOF\n")
+        self.fp.write("".join(lines).encode("ascii"))
+        self.fp.close()
+
+    def abort(self):
+        """書きかけのファイルを閉じて削除する"""
+        try: self.fp.close()
+        except: pass
+        try: os.remove(self.path)
+        except OSError: pass
+
+class PdfDirectWriter(PdfStreamWriter):
+    """
+    ページをラスタライズせずに組み立てるPDFライター。
+    写真はスロット位置に画像XObjectとして配置し、JPEGは元ファイルのDCTストリームをデコードせずに埋め込む。
+    テキストは埋め込みフォントのPDFテキストとして書き、埋め込めないフォントの場合だけ画像にする。
+    """
+    def __init__(self, path, resolution=72.0, quality=95):
+        super().__init__(path, resolution, quality)
+        self.image_ids = {}
+        self.fonts = {}
+
+    def add_spec_page(self, spec: "PageRenderSpec", rotate=0):
+        f = 72.0 / spec.dpi
+        pt_w, pt_h = spec.px_w * f, spec.px_h * f
+        xobjects, fonts = {}, {}
+        r, g, b = ImageColor.getrgb(spec.page.background_color)[:3]
+        ops = [f"{r/255:.4f} {g/255:.4f} {b/255:.4f} rg 0 0 {pt_w:.4f} {pt_h:.4f} re f"]
+
+        for r_idx, slot_x, slot_y, slot_w, slot_h, photo in iter_slot_rects(spec):
+            if not photo or slot_w <= 0 or slot_h <= 0: continue
+            try: img_id, draw_w, draw_h, frame = self._photo_xobject(photo, slot_w, slot_h, spec.page.background_color)
+            except Exception: continue
+            name = f"Im{img_id}"
+            xobjects[name] = img_id
+            # スロット中心へ移動 → 回転(時計回り) → 表示サイズへ拡大、の順に変換する
+            cx, cy = (slot_x + slot_w / 2) * f, pt_h - (slot_y + slot_h / 2) * f
+            rad = math.radians(-photo.rotation)
+            c, s = math.cos(rad), math.sin(rad)
+            dw, dh = draw_w * f, draw_h * f
+            # クロップは画像全体を置いてからクロップ範囲でクリップする
+            ox, oy, fw, fh = (v * f for v in frame)
+            clip = f"{-dw/2:.4f} {-dh/2:.4f} {dw:.4f} {dh:.4f} re W n " if (fw, fh) != (dw, dh) else ""
+            ops.append(f"q 1 0 0 1 {cx:.4f} {cy:.4f} cm {c:.6f} {s:.6f} {-s:.6f} {c:.6f} 0 0 cm {clip}"
+                       f"{fw:.4f} 0 0 {fh:.4f} {-dw/2 + ox:.4f} {dh/2 - oy - fh:.4f} cm /{name} Do Q")
+
+        for txt in spec.page.texts:
+            fnt_size_px = int(txt.font_size * (spec.dpi / 72))
+            fnt, font_path, font_index = resolve_font_file(txt.font_family, fnt_size_px)
+            sfnt = SfntFont.load(font_path, font_index) if font_path else None
+            # フォントにない文字が1つでもあれば .notdef と誤った文字コードになるので、画像として埋め込む
+            if sfnt and sfnt.embeddable and txt.text and "\n" not in txt.text and all(sfnt.glyph_id(ch) for ch in txt.text):
+                font = self._font_entry(font_path, font_index, sfnt)
+                fonts[font["name"]] = font["id"]
+                ops.append(self._text_ops(txt, fnt, fnt_size_px, font, spec, f, pt_h))
+            else:
+                sprite = TEXT_SPRITES.get(txt, fnt_size_px)
+                img_id = self._write_image(sprite)
+                name = f"Im{img_id}"
+                xobjects[name] = img_id
+                x = (int(txt.x_rel * spec.px_w) - sprite.width // 2) * f
+                y = pt_h - (int(txt.y_rel * spec.px_h) - sprite.height // 2 + sprite.height) * f
+                ops.append(f"q {sprite.width * f:.4f} 0 0 {sprite.height * f:.4f} {x:.4f} {y:.4f} cm /{name} Do Q")
+
+        resources = []
+        if xobjects: resources.append("/XObject << " + " ".join(f"/{n} {i} 0 R" for n, i in xobjects.items()) + " >>")
+        if fonts: resources.append("/Font << " + " ".join(f"/{n} {i} 0 R" for n, i in fonts.items()) + " >>")
+        self._add_page_obj(pt_w, pt_h, "\n".join(ops).encode("ascii"), " ".join(resources), rotate)
+
+    def _photo_xobject(self, photo, slot_w, slot_h, background="#FFFFFF"):
+        """
+        写真の画像XObjectを（未出力なら書き出して）返す。透過のある写真はラスター書き出しと同じく background の上に合成する。
+        戻り値は (オブジェクト番号, クロップ範囲の表示幅, 表示高さ, 画像の配置)。配置はクロップ範囲の左上を原点とした
+        画像全体の (x, y, 幅, 高さ) で、単位はいずれも書き出し解像度のピクセル。
+        """
+        with Image.open(photo.path) as im:
+            src_w, src_h = im.size
+            passthrough = (im.format == "JPEG" and im.mode in ("RGB", "L"))
+            mode = im.mode
+            has_alpha = "A" in im.getbands() or "transparency" in im.info
+        l, t, r, b = crop_region(photo.crop, src_w, src_h) or (0, 0, src_w, src_h)
+        rot_w, rot_h = rotated_size(r - l, b - t, photo.rotation)
+        # ラスター書き出しと同じく、拡大はしない
+        ratio = min(slot_w / rot_w, slot_h / rot_h, 1.0)
+        draw_w, draw_h = (r - l) * ratio, (b - t) * ratio
+
+        key = (photo.path, os.path.getmtime(photo.path))
+        if passthrough:
+            # JPEGはそのまま埋め込み、クロップはクリップで表現する
+            frame = (-l * ratio, -t * ratio, src_w * ratio, src_h * ratio)
+        else:
+            need = (max(1, int(round(draw_w))), max(1, int(round(draw_h))))
+            key += (crop_key(photo.crop),) + need + ((background,) if has_alpha else ())
+            frame = (0, 0, draw_w, draw_h)
+        if key not in self.image_ids:
+            if passthrough:
+                with open(photo.path, "rb") as fp: data = fp.read()
+                color_space = "/DeviceGray" if mode == "L" else "/DeviceRGB"
+                img_id = self._new_id()
+                self._write_stream(img_id, f"/Type /XObject /Subtype /Image /Width {src_w} /Height {src_h} "
+                                           f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode", data)
+            else:
+                im = export_photo_mode(decode_thumbnail(photo.path, need, resample=Image.LANCZOS, reducing_gap=2.0, crop=photo.crop))
+                if im.size != need: im = im.resize(need, Image.LANCZOS)
+                if im.mode == "RGBA":
+                    flat = Image.new("RGB", im.size, background)
+                    flat.paste(im, (0, 0), im)
+                    im = flat
+                img_id = self._write_image(im)
+            self.image_ids[key] = img_id
+        return self.image_ids[key], draw_w, draw_h, frame
+
+    def _write_image(self, im):
+        """RGB/RGBA画像を可逆圧縮(Flate)の画像XObjectとして書き出す。アルファはSMaskにする"""
+        smask = ""
+        if im.mode == "RGBA":
+            alpha_id = self._new_id()
+            self._write_stream(alpha_id, f"/Type /XObject /Subtype /Image /Width {im.width} /Height {im.height} "
+                                         f"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode",
+                               zlib.compress(im.getchannel("A").tobytes()))
+            smask = f" /SMask {alpha_id} 0 R"
+            im = im.convert("RGB")
+        img_id = self._new_id()
+        self._write_stream(img_id, f"/Type /XObject /Subtype /Image /Width {im.width} /Height {im.height} "
+                                   f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode{smask}",
+                           zlib.compress(im.tobytes()))
+        return img_id
+
+    def _font_entry(self, path, index, sfnt):
+        key = (path, index)
+        if key not in self.fonts:
+            self.fonts[key] = {"name": f"F{len(self.fonts) + 1}", "id": self._new_id(), "font": sfnt, "used": {}}
+        return self.fonts[key]
+
+    def _text_ops(self, txt, fnt, fnt_size_px, font, spec, f, pt_h):
+        # ラスター版と同じく、文字の外接矩形のサイズ分だけ中心からずらした位置を左上(アセンダー)とする
+        with FONT_LOCK:
+            b0, b1, b2, b3 = fnt.getbbox(txt.text)
+            ascent = fnt.getmetrics()[0]
+        cx, cy = txt.x_rel * spec.px_w * f, pt_h - txt.y_rel * spec.px_h * f
+        dx, dy = -(b2 - b0) / 2 * f, -(ascent - (b3 - b1) / 2) * f
+        rad = math.radians(txt.rotation)
+        c, s = math.cos(rad), math.sin(rad)
+        r, g, b = ImageColor.getrgb(txt.color)[:3]
+
+        codes = []
+        for ch in txt.text:
+            gid = font["font"].glyph_id(ch)
+            font["used"].setdefault(gid, ch)
+            codes.append(f"{gid:04X}")
+        return (f"q {c:.6f} {s:.6f} {-s:.6f} {c:.6f} {cx:.4f} {cy:.4f} cm BT /{font['name']} {fnt_size_px * f:.4f} Tf "
+                f"{r/255:.4f} {g/255:.4f} {b/255:.4f} rg {dx:.4f} {dy:.4f} Td <{''.join(codes)}> Tj ET Q")
+
+    def _write_fonts(self):
+        for entry in self.fonts.values():
+            sfnt = entry["font"]
+            k = 1000.0 / sfnt.units_per_em
+            program = sfnt.font_program()
+            file_id = self._new_id()
+            self._write_stream(file_id, f"/Filter /FlateDecode /Length1 {len(program)}", zlib.compress(program))
+
+            desc_id = self._new_id()
+            bbox = " ".join(str(int(v * k)) for v in sfnt.bbox)
+            self._write_obj(desc_id, (f"<< /Type /FontDescriptor /FontName /{sfnt.name} /Flags 32 /FontBBox [{bbox}] /ItalicAngle 0 "
+                                      f"/Ascent {int(sfnt.ascent * k)} /Descent {int(sfnt.descent * k)} /CapHeight {int(sfnt.cap_height * k)} "
+                                      f"/StemV 80 /FontFile2 {file_id} 0 R >>").encode("ascii"))
+
+            used = sorted(entry["used"].items())
+            widths = " ".join(f"{gid} [{sfnt.advance(gid):.0f}]" for gid, _ in used)
+            cid_id = self._new_id()
+            self._write_obj(cid_id, (f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{sfnt.name} "
+                                     f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+                                     f"/FontDescriptor {desc_id} 0 R /CIDToGIDMap /Identity /W [{widths}] >>").encode("ascii"))
+
+            cmap = ["/CIDInit /ProcSet findresource begin", "12 dict begin", "begincmap",
+                    "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+                    "/CMapName /Adobe-Identity-UCS def", "/CMapType 2 def",
+                    "1 begincodespacerange", "<0000> <FFFF>", "endcodespacerange"]
+            for i in range(0, len(used), 100):
+                chunk = used[i:i + 100]
+                cmap.append(f"{len(chunk)} beginbfchar")
+                cmap.extend(f"<{gid:04X}> <{ch.encode('utf-16-be').hex().upper()}>" for gid, ch in chunk)
+                cmap.append("endbfchar")
+            cmap += ["endcmap", "CMapName currentdict /CMap defineresource pop", "end", "end"]
+            unicode_id = self._new_id()
+            self._write_stream(unicode_id, "", "\n".join(cmap).encode("ascii"))
+
+            self._write_obj(entry["id"], (f"<< /Type /Font /Subtype /Type0 /BaseFont /{sfnt.name} /Encoding /Identity-H "
+                                          f"/DescendantFonts [{cid_id} 0 R] /ToUnicode {unicode_id} 0 R >>").encode("ascii"))
+        self.fonts = {}
+
+    def close(self, reverse=False):
+        self._write_fonts()
+        super().close(reverse)
+
+class TiffStreamWriter:
+    """
+    1ページずつマルチページTIFFへ追記するライター。
+    逆順にするときはエンコード済みのページを一時ファイルに溜めておき、close 時に後ろから書き込む。
+    """
+    def __init__(self, path, reverse=False):
+        self.path = path
+        self.fp = open(path, "w+b")
+        self.tiff = TiffImagePlugin.AppendingTiffWriter(self.fp, new=True)
+        self.spool = tempfile.TemporaryFile() if reverse else None
+        self.frames = []
+
+    def add_page(self, enc: EncodedPage):
+        if self.spool is None: return self._append(enc.data)
+        self.frames.append((self.spool.tell(), len(enc.data)))
+        self.spool.write(enc.data)
+
+    def _append(self, data):
+        self.tiff.write(data)
+        self.tiff.newFrame()
+
+    def close(self):
+        if self.spool is not None:
+            for offset, length in reversed(self.frames):
+                self.spool.seek(offset)
+                self._append(self.spool.read(length))
+            self.spool.close()
+        self.tiff.close()
+        self.fp.close()
+
+    def abort(self):
+        """書きかけのファイルを閉じて削除する"""
+        for fp in (self.spool, self.fp):
+            try: fp.close()
+            except: pass
+        try: os.remove(self.path)
+        except OSError: pass
+
+class ExportWriter:
+    """
+    書き出しページを表面(偶数index)/裏面(奇数index)に振り分け、受け取った順に保存する。
+    PDF/TIFFはページごとに追記し、JPG/PNGはページごとに1ファイルずつ書き出す。
+    """
+    def __init__(self, out_dir, fmt, total, reverse_back=False, rotate_back=False, resolution=72.0,
+                 encoding: Optional[EncodeSettings] = None, direct=False):
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.direct = direct
+        self.total = total
+        self.reverse_back = reverse_back
+        self.rotate_back = rotate_back
+        self.resolution = resolution
+        self.encoding = encoding or EncodeSettings(codec=PAGE_CODECS.get(fmt, "JPEG"))
+        self.stream_writers = {}
+        self.written_files = []
+
+    def _stream_writer(self, side):
+        # 対象ページが1枚もない側のファイルは作らない
+        if side not in self.stream_writers:
+            if self.fmt == "TIFF":
+                path = os.path.join(self.out_dir, f"export_{side}.tif")
+                self.stream_writers[side] = TiffStreamWriter(path, reverse=(side == "back" and self.reverse_back))
+            else:
+                path = os.path.join(self.out_dir, f"export_{side}.pdf")
+                writer_cls = PdfDirectWriter if self.direct else PdfStreamWriter
+                self.stream_writers[side] = writer_cls(path, resolution=self.resolution, quality=self.encoding.quality)
+        return self.stream_writers[side]
+
+    def page_rotation(self, index):
+        """index のページをエンコード前に回しておく角度（PDFは /Rotate で回すので0）"""
+        return 180 if (index % 2 == 1 and self.rotate_back and self.fmt != "PDF") else 0
+
+    @property
+    def wants_specs(self):
+        """ページ画像ではなく描画スペックをそのまま受け取るか（PDF直接埋め込みモード）"""
+        return self.direct and self.fmt == "PDF"
+
+    def add_spec(self, spec: "PageRenderSpec"):
+        is_back = (spec.index % 2 == 1)
+        side = "back" if is_back else "front"
+        self._stream_writer(side).add_spec_page(spec, rotate=180 if (is_back and self.rotate_back) else 0)
+
+    def add_page(self, index, im):
+        """im は PIL画像またはエンコード済みの EncodedPage（形式と回転が合っていればそのまま書き込む）"""
+        is_back = (index % 2 == 1)
+        side = "back" if is_back else "front"
+        if self.fmt == "PDF":
+            # 裏面の逆順はclose時にページツリーの並びで、180°回転は /Rotate で表現する
+            self._stream_writer(side).add_page(im, rotate=180 if (is_back and self.rotate_back) else 0)
+            return
+        rotation = self.page_rotation(index)
+        if not isinstance(im, EncodedPage): im = encode_page(im, self.encoding, rotation)
+        elif im.codec != self.encoding.codec or im.rotation != rotation:
+            im = replace(encode_page(im.to_image(), self.encoding, (rotation - im.rotation) % 360), rotation=rotation)
+        if self.fmt == "TIFF":
+            # 裏面の逆順は TiffStreamWriter が close 時に並べ替える
+            self._stream_writer(side).add_page(im)
+            return
+        num = index // 2 + 1
+        if is_back and self.reverse_back: num = self.total // 2 - index // 2
+        path = os.path.join(self.out_dir, f"{side}_{num:02d}{CODEC_EXTS[self.encoding.codec]}")
+        with open(path, "wb") as f: f.write(im.data)
+        self.written_files.append(path)
+
+    def close(self):
+        for side, writer in self.stream_writers.items():
+            if isinstance(writer, TiffStreamWriter): writer.close()
+            else: writer.close(reverse=(side == "back" and self.reverse_back))
+        self.stream_writers = {}
+
+    def abort(self):
+        for writer in self.stream_writers.values(): writer.abort()
+        self.stream_writers = {}
+        for path in self.written_files:
+            try: os.remove(path)
+            except OSError: pass
+        self.written_files = []
+
+# --- Page Rendering (Export) ---
+@dataclass
+class PageRenderSpec:
+    """1ページ分の描画に必要な情報のスナップショット（ワーカープロセスへ渡すため pickle 可能）"""
+    index: int; page: Page; px_w: int; px_h: int; dpi: int
+    margins: Tuple[float, float, float, float]  # (top, bottom, left, right) mm
+    encoding: EncodeSettings = field(default_factory=EncodeSettings)
+    rotation: int = 0  # エンコード前に回す角度（ラスター出力で裏面を180°回転するとき）
+
+def get_page_pixel_size(project: Project, dpi) -> Tuple[int, int]:
+    size_key = project.paper_size if project.paper_size in PAPER_SIZES else "A4"
+    pw_mm, ph_mm = PAPER_SIZES[size_key]
+    if project.orientation == "Landscape": pw_mm, ph_mm = ph_mm, pw_mm
+    return int(math.ceil(pw_mm * MM_TO_INCH * dpi)), int(math.ceil(ph_mm * MM_TO_INCH * dpi))
+
+def get_page_margins(project: Project, page: Page):
+    if page.custom_margins:
+        return page.custom_margins["top"], page.custom_margins["bottom"], page.custom_margins["inner"], page.custom_margins["outer"]
+    return project.margin_top, project.margin_bottom, project.margin_inner, project.margin_outer
+
+def build_render_specs(project: Project, total, dpi, is_cover_mode=False, encoding: Optional[EncodeSettings] = None,
+                       rotation_of=lambda index: 0) -> List[PageRenderSpec]:
+    """書き出し開始時点のプロジェクトからページごとの描画スペックを作る（編集中の変更の影響を受けない）"""
+    px_w, px_h = get_page_pixel_size(project, dpi)
+    specs = []
+    for i in range(total):
+        page = copy.deepcopy(project.pages[i]) if i < len(project.pages) else Page()
+        mt, mb, mi, mo = get_page_margins(project, page)
+
+        is_left_page = (i % 2 == 0)
+        if is_cover_mode:
+            is_left_page = (i % 2 != 0)
+        ml, mr = (mo, mi) if is_left_page else (mi, mo)
+
+        specs.append(PageRenderSpec(index=i, page=page, px_w=px_w, px_h=px_h, dpi=dpi, margins=(mt, mb, ml, mr),
+                                    encoding=encoding or EncodeSettings(), rotation=rotation_of(i)))
+    return specs
+
+def iter_slot_rects(spec: PageRenderSpec):
+    """各スロットの (スロット番号, x, y, w, h, 配置された写真) を書き出し解像度のピクセル単位で返す"""
+    page = spec.page
+    scale = spec.dpi / 25.4
+    mt, mb, ml, mr = spec.margins
+
+    safe_x_px = ml * scale; safe_y_px = mt * scale
+    safe_w_px = spec.px_w - (ml+mr) * scale; safe_h_px = spec.px_h - (mt+mb) * scale
+
+    rects = LayoutManager.get_layout_rects(page.layout_name)
+    sp_px = page.spacing_mm * scale
+    for r_idx, (rx, ry, rw, rh) in enumerate(rects):
+        slot_x = safe_x_px + rx * safe_w_px + sp_px/2
+        slot_y = safe_y_px + ry * safe_h_px + sp_px/2
+        slot_w = rw * safe_w_px - sp_px
+        slot_h = rh * safe_h_px - sp_px
+        photo = next((p for p in page.photos if p.slot_index == r_idx), None)
+        yield r_idx, slot_x, slot_y, slot_w, slot_h, photo
+
+def render_text_sprite(txt: TextItem, fnt, pad=50) -> Image.Image:
+    """テキストを余白つきのRGBA画像に描画し、回転を適用して返す"""
+    with FONT_LOCK:
+        bbox = _MEASURE_DRAW.textbbox((0,0), txt.text, font=fnt)
+        txt_img = Image.new("RGBA", (bbox[2]-bbox[0]+pad*2, bbox[3]-bbox[1]+pad*2), (0,0,0,0))
+        d = ImageDraw.Draw(txt_img)
+        d.text((pad,pad), txt.text, font=fnt, fill=txt.color)
+    if txt.rotation: txt_img = txt_img.rotate(txt.rotation, expand=True, resample=Image.BICUBIC)
+    return txt_img
+
+class TextSpriteCache:
+    """
+    描画済みテキストスプライトのLRUキャッシュ（バイト数上限つき）。
+    テキスト・フォント・ピクセルサイズ・色・回転・余白が同じなら描画し直さないので、
+    キャプションを1つ動かしても他のキャプションはラスタライズされない。
+    プレビューと書き出しスレッドの両方から使う。キャッシュの出し入れは self.lock で、描画は render_text_sprite が取る FONT_LOCK で直列化する。
+    返すスプライトは共有されるので、呼び出し側で書き換えないこと。
+    """
+    def __init__(self, budget_bytes=64 * 1024 * 1024):
+        self.budget = budget_bytes
+        self.used = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(txt: TextItem, size_px, pad=50):
+        return (txt.text, txt.font_family, size_px, txt.color, txt.rotation, pad)
+
+    def get(self, txt: TextItem, size_px, pad=50) -> Image.Image:
+        key = self.key(txt, size_px, pad)
+        with self.lock:
+            im = self.items.get(key)
+            if im is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return im
+            self.misses += 1
+            im = render_text_sprite(txt, load_font(txt.font_family, size_px), pad)
+            size = im.width * im.height * 4
+            if size <= self.budget:
+                self.items[key] = im
+                self.used += size
+                while self.used > self.budget:
+                    _, old = self.items.popitem(last=False)
+                    self.used -= old.width * old.height * 4
+            return im
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.used = 0
+
+# プロセス内で共有するスプライトキャッシュ（書き出しワーカーではプロセスごとに1つ）
+TEXT_SPRITES = TextSpriteCache()
+
+def render_export_page(spec: PageRenderSpec, cache: Optional[DecodeCache] = None, timer: StageTimer = NULL_TIMER) -> Image.Image:
+    """1ページを書き出し解像度のRGB画像として描画する"""
+    page = spec.page
+    px_w, px_h, dpi = spec.px_w, spec.px_h, spec.dpi
+    with timer.stage("compose"):
+        canvas = Image.new("RGB", (px_w, px_h), page.background_color)
+
+    for r_idx, slot_x, slot_y, slot_w, slot_h, photo in iter_slot_rects(spec):
+        if photo and slot_w > 0 and slot_h > 0:
+            try:
+                box = (int(slot_w), int(slot_h))
+                load = lambda: export_photo_mode(decode_thumbnail(photo.path, box, photo.rotation, resample=Image.LANCZOS, reducing_gap=2.0,
+                                                                  crop=photo.crop, timer=timer))
+                im = cache.get(photo.path, photo.rotation, box, load, photo.crop) if cache is not None else load()
+
+                iw, ih = im.size
+                paste_x = int(slot_x + (slot_w - iw) / 2)
+                paste_y = int(slot_y + (slot_h - ih) / 2)
+
+                with timer.stage("compose"): canvas.paste(im, (paste_x, paste_y), im if im.mode == "RGBA" else None)
+            except: pass
+
+    with timer.stage("text"):
+        for txt in page.texts:
+            fnt_size_px = int(txt.font_size * (dpi / 72))
+            txt_img = TEXT_SPRITES.get(txt, fnt_size_px)
+            paste_x = int(txt.x_rel * px_w) - txt_img.width // 2
+            paste_y = int(txt.y_rel * px_h) - txt_img.height // 2
+            canvas.paste(txt_img, (paste_x, paste_y), txt_img)
+    return canvas
+
+class PageRenderCache:
+    """
+    描画・エンコード済みページのディスクキャッシュ。
+    キーはページ内容・余白・解像度・エンコード設定・元画像の更新日時から作るハッシュで、
+    どれかが変わったページだけが描画し直される。書き出しが途中で止まっても、
+    それまでに描画したページは残るので、次回はその続きから描画される。
+    """
+    VERSION = 3  # 描画結果が変わる修正をしたら上げる
+
+    def __init__(self, directory, max_bytes=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, spec: PageRenderSpec):
+        page = asdict(spec.page)
+        for t in page["texts"]: t.pop("uuid", None)  # uuid は読み込みのたびに変わるので除く
+        sources = []
+        for p in spec.page.photos:
+            try: st = os.stat(p.path); sources.append([p.path, st.st_mtime_ns, st.st_size])
+            except OSError: sources.append([p.path, None, None])
+        payload = {"v": self.VERSION, "page": page, "size": [spec.px_w, spec.px_h], "dpi": spec.dpi,
+                   "margins": list(spec.margins), "encoding": asdict(spec.encoding), "rotation": spec.rotation, "sources": sources}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".page")
+
+    def has(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key, rotation=0) -> Optional[EncodedPage]:
+        """rotation はキーを作ったスペックの回転（キャッシュしたページには適用済み）"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f: enc = EncodedPage.from_bytes(f.read(), rotation)
+            os.utime(path)  # 最近使ったものとして残す
+            return enc
+        except: return None
+
+    def put(self, key, enc: EncodedPage):
+        # 一時ファイルに書いてから置き換え、中断されても壊れたページが残らないようにする
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f: f.write(enc.data)
+            os.replace(tmp, path)
+        except OSError:
+            try: os.remove(tmp)
+            except OSError: pass
+
+    def clear(self):
+        for e in os.scandir(self.directory):
+            try: os.remove(e.path)
+            except OSError: pass
+
+    def prune(self):
+        """合計サイズが上限を超えていたら古いものから消す"""
+        if self.max_bytes <= 0: return
+        entries = []
+        for e in os.scandir(self.directory):
+            try: st = e.stat(); entries.append((st.st_mtime, st.st_size, e.path))
+            except OSError: pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try: os.remove(path); total -= size
+            except OSError: pass
+
+def resolve_worker_count(requested, n_jobs):
+    """0以下は自動（CPUコア数）。ジョブ数より多いワーカーは起動しない"""
+    workers = requested if requested and requested > 0 else (os.cpu_count() or 1)
+    return max(1, min(workers, n_jobs))
+
+# ワーカープロセスごとのデコードキャッシュ（プール生成時に初期化される）
+_worker_cache: Optional[DecodeCache] = None
+
+def _init_render_worker(cache_bytes):
+    global _worker_cache
+    _worker_cache = DecodeCache(cache_bytes)
+
+def _render_only(spec, cache):
+    """1ページを描画し、(画像, 計測値) を返す"""
+    hits, misses = cache.hits, cache.misses
+    timer = StageTimer()
+    im = render_export_page(spec, cache, timer)
+    info = {"cache_hits": cache.hits - hits, "cache_misses": cache.misses - misses,
+            "seconds": timer.seconds, "source_px": timer.source_px, "rss_mb": peak_rss_mb()}
+    return im, info
+
+def _render_with_cache(spec, cache):
+    """1ページを描画・エンコードし、(EncodedPage, 計測値) を返す"""
+    im, info = _render_only(spec, cache)
+    enc, seconds = _timed_encode(im, spec.encoding, spec.rotation)
+    info["seconds"]["encode"] = seconds
+    return enc, info
+
+def _render_page_task(spec):
+    return _render_with_cache(spec, _worker_cache)
+
+def iter_rendered_pages(specs, max_workers=0, is_cancelled=lambda: False, cache_bytes=0, stats=None,
+                        page_cache: Optional[PageRenderCache] = None, telemetry: Optional[ExportTelemetry] = None):
+    """
+    specs の順番どおりに (spec, エンコード済みページ EncodedPage) を返すジェネレーター。
+    ワーカーが2つ以上ならプロセスプールでページ単位に並列描画する。1つのときはこのスレッドで描画し、エンコードだけスレッドで並行させる。
+    先行して投入するページ数はワーカー数の2倍までに抑え、メモリ使用量を一定に保つ。
+    cache_bytes はデコードキャッシュの上限（全ワーカー合計）。stats を渡すとキャッシュのヒット/ミス数を加算する。
+    page_cache を渡すと、前回の書き出しから変わっていないページは描画せずにキャッシュから返す。
+    telemetry を渡すと、ページごとの計測値（待ち時間を含む）を記録する。
+    """
+    if stats is None: stats = {}
+    for k in ("cache_hits", "cache_misses", "pages_reused", "pages_rendered"): stats.setdefault(k, 0)
+
+    def finish(spec, key, enc, info, wait=0.0):
+        stats["cache_hits"] += info["cache_hits"]; stats["cache_misses"] += info["cache_misses"]
+        stats["pages_rendered"] += 1
+        if page_cache is not None: page_cache.put(key, enc)
+        if telemetry is not None:
+            seconds = dict(info["seconds"])
+            if wait: seconds["wait"] = wait
+            telemetry.add_page(spec.index, seconds, info["source_px"], rss_mb=info["rss_mb"])
+
+    def from_cache(spec, key):
+        # 読めなかったとき（外部から消された等）はこの場で描画する
+        t0 = time.perf_counter()
+        enc = page_cache.get(key, spec.rotation)
+        if enc is not None:
+            stats["pages_reused"] += 1
+            if telemetry is not None: telemetry.add_page(spec.index, {"cache_read": time.perf_counter() - t0}, reused=True)
+            return enc
+        enc, info = _render_with_cache(spec, DecodeCache(0))
+        finish(spec, key, enc, info)
+        return enc
+
+    # 描画が必要なページ数でワーカー数を決める（全ページがキャッシュにあればプールを立ち上げない）
+    jobs = []
+    for spec in specs:
+        key = page_cache.key(spec) if page_cache is not None else None
+        jobs.append((spec, key, key is not None and page_cache.has(key)))
+    workers = resolve_worker_count(max_workers, sum(1 for *_, cached in jobs if not cached))
+    if workers <= 1:
+        cache = DecodeCache(cache_bytes)
+        def rendered():
+            for spec, key, cached in jobs:
+                if is_cancelled(): return
+                if cached: yield (spec, key, None), from_cache(spec, key), spec.encoding, spec.rotation
+                else:
+                    im, info = _render_only(spec, cache)
+                    yield (spec, key, info), im, spec.encoding, spec.rotation
+        # 次のページを描画しているあいだに前のページをエンコードする
+        encoded = iter_encoded(rendered(), max_workers=2)
+        try:
+            for (spec, key, info), enc, seconds in encoded:
+                if info is not None:
+                    info["seconds"]["encode"] = seconds
+                    finish(spec, key, enc, info)
+                yield spec, enc
+        finally:
+            encoded.close()
+        return
+
+    # GUI から呼ぶときは Tk や読み込みスレッドが動いているので、ロックを抱えたまま fork しないよう spawn で起動する
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_render_worker, initargs=(cache_bytes // workers,))
+    pending = collections.deque()
+    job_iter = iter(jobs)
+    in_flight = 0
+
+    def submit_next():
+        # キャッシュ済みのページは投入せずに順番だけ確保し、描画中のページ数を制限する
+        nonlocal in_flight
+        while in_flight < workers * 2:
+            job = next(job_iter, None)
+            if job is None: return
+            spec, key, cached = job
+            if cached: pending.append((spec, key, None))
+            else:
+                pending.append((spec, key, pool.submit(_render_page_task, spec)))
+                in_flight += 1
+
+    try:
+        submit_next()
+        while pending:
+            spec, key, future = pending.popleft()
+            if is_cancelled(): return
+            if future is None: enc = from_cache(spec, key)
+            else:
+                t0 = time.perf_counter()
+                while True:
+                    if is_cancelled(): return
+                    try:
+                        enc, info = future.result(timeout=0.1)
+                        break
+                    except FuturesTimeout:
+                        continue
+                in_flight -= 1
+                finish(spec, key, enc, info, wait=time.perf_counter() - t0)
+            submit_next()
+            yield spec, enc
+    finally:
+        for *_, future in pending:
+            if future is not None: future.cancel()
+        # 最後まで描画し終えたときはワーカーの終了を待つ（待たないと終了時にプールの後始末が失敗する）
+        pool.shutdown(wait=not pending, cancel_futures=True)
+
+# --- Export Pipeline ---
+@dataclass
+class ExportOptions:
+    """書き出し設定（GUIの出力オプションとコマンドライン引数の両方から作る）"""
+    fmt: str = "PDF"; dpi: int = 300; quality: int = 95
+    progressive: bool = False; optimize: bool = False; png_level: int = 6
+    reverse_back: bool = False; rotate_back: bool = False; keep_original: bool = False
+    cover_mode: bool = False; direct_pdf: bool = False
+    workers: int = 0; cache_mb: int = 512; page_cache: bool = True; page_cache_mb: int = 2048
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        opts = cls(fmt=config.get("startup_export_fmt", "PDF"), dpi=config["export_dpi"], quality=config.get("export_quality", 95),
+                   progressive=config.get("export_jpeg_progressive", False), optimize=config.get("export_jpeg_optimize", False),
+                   png_level=config.get("export_png_level", 6),
+                   cover_mode=config.get("startup_cover_mode", False), direct_pdf=config.get("export_pdf_direct", False),
+                   workers=config.get("export_workers", 0), cache_mb=config.get("export_cache_mb", 512),
+                   page_cache=config.get("export_page_cache", True), page_cache_mb=config.get("export_page_cache_mb", 2048))
+        for k, v in overrides.items(): setattr(opts, k, v)
+        return opts
+
+    def encode_settings(self, dpi=None) -> EncodeSettings:
+        # PDFに埋め込むJPEGはプログレッシブにしない（扱えないプリンターやRIPがある）
+        return EncodeSettings(codec=PAGE_CODECS.get(self.fmt, "JPEG"), quality=self.quality,
+                              progressive=self.progressive and self.fmt != "PDF", optimize=self.optimize,
+                              png_level=self.png_level, dpi=dpi)
+
+def open_page_cache(max_mb=2048) -> PageRenderCache:
+    return PageRenderCache(get_user_cache_dir("pages"), max_mb * 1024 * 1024)
+
+def export_page_count(project: Project):
+    """表裏で対になるように偶数ページに切り上げる"""
+    total = len(project.pages)
+    return total + total % 2
+
+def open_export_writer(out_dir, opts: ExportOptions, total, resolution=72.0, direct=False):
+    # 元の解像度のまま書き出すときはファイルに解像度を記録しない
+    encoding = opts.encode_settings(None if opts.keep_original else int(resolution))
+    return ExportWriter(out_dir, opts.fmt, total, reverse_back=opts.reverse_back, rotate_back=opts.rotate_back,
+                        resolution=resolution, encoding=encoding, direct=direct)
+
+def write_encoded(writer: ExportWriter, images, max_workers=0, is_cancelled=lambda: False):
+    """
+    (index, 画像) をスレッドプールでエンコードしながら、ページ順に writer へ書き込むジェネレーター。
+    書き込んだページごとに (index, エンコード秒数, 書き込み秒数) を返す。
+    """
+    jobs = ((i, im, writer.encoding, writer.page_rotation(i)) for i, im in images)
+    encoded = iter_encoded(jobs, max_workers)
+    try:
+        for i, enc, seconds in encoded:
+            if is_cancelled(): return
+            t0 = time.perf_counter()
+            writer.add_page(i, enc)
+            yield i, seconds, time.perf_counter() - t0
+    finally:
+        encoded.close()
+
+def export_original(project: Project, out_dir, opts: ExportOptions, progress_cb=lambda v: None, is_cancelled=lambda: False,
+                    telemetry: Optional[ExportTelemetry] = None):
+    """各ページの1枚目の写真を元の解像度のまま書き出す"""
+    total = export_page_count(project)
+    if telemetry is None: telemetry = ExportTelemetry(total, opts)
+    writer = open_export_writer(out_dir, opts, total)
+    timers = {}
+    def source_images():
+        for i in range(total):
+            if is_cancelled(): return
+            timer = timers[i] = StageTimer()
+            with timer.stage("decode"):
+                if i < len(project.pages) and project.pages[i].photos:
+                    p_item = project.pages[i].photos[0]
+                    try:
+                        im = Image.open(p_item.path)
+                        timer.add_source(*im.size)
+                        region = crop_region(p_item.crop, *im.size)
+                        if region: im = im.crop(tuple(int(round(v)) for v in region))
+                        im = rotate_photo(im, p_item.rotation)
+                    except: im = Image.new("RGB", (100,100), "white")
+                else: im = Image.new("RGB", (100,100), "white")
+            yield i, im
+    # 読み込みはこのスレッドで順に行い、エンコードはスレッドプールで並列に行う
+    pages = write_encoded(writer, source_images(), opts.workers, is_cancelled)
+    try:
+        for i, encode_sec, write_sec in pages:
+            timer = timers.pop(i)
+            timer.seconds["encode"] = encode_sec; timer.seconds["write"] = write_sec
+            telemetry.add_page(i, timer.seconds, timer.source_px)
+            progress_cb((i + 1) / total)
+        if is_cancelled():
+            writer.abort()
+            return
+        with telemetry.stage("finalize"): writer.close()
+    except:
+        pages.close()
+        writer.abort()
+        raise
+
+def export_canvas(project: Project, out_dir, opts: ExportOptions, progress_cb=lambda v: None, is_cancelled=lambda: False,
+                  telemetry: Optional[ExportTelemetry] = None):
+    """レイアウトどおりにページを描画して書き出す。描画の統計情報を返す（直接埋め込みPDFでは None）"""
+    total = export_page_count(project)
+    if telemetry is None: telemetry = ExportTelemetry(total, opts)
+    writer = open_export_writer(out_dir, opts, total, resolution=opts.dpi, direct=opts.direct_pdf)
+    specs = build_render_specs(project, total, opts.dpi, opts.cover_mode, writer.encoding, writer.page_rotation)
+    if writer.wants_specs: return _export_specs_direct(writer, specs, total, progress_cb, is_cancelled, telemetry)
+    stats = {}
+    page_cache = open_page_cache(opts.page_cache_mb) if opts.page_cache else None
+    # ページ描画はプロセスプールで並列に行い、書き込みはページ順に呼び出し元のスレッドで行う
+    pages = iter_rendered_pages(specs, opts.workers, is_cancelled, cache_bytes=opts.cache_mb * 1024 * 1024,
+                                stats=stats, page_cache=page_cache, telemetry=telemetry)
+    try:
+        for n, (spec, enc) in enumerate(pages):
+            with telemetry.stage("write"): writer.add_page(spec.index, enc)
+            progress_cb((n + 1) / total)
+        pages.close()
+        if is_cancelled(): writer.abort()
+        else:
+            with telemetry.stage("finalize"): writer.close()
+    except:
+        pages.close()
+        writer.abort()
+        raise
+    finally:
+        if page_cache: page_cache.prune()
+    return stats
+
+def _export_specs_direct(writer, specs, total, progress_cb, is_cancelled, telemetry):
+    # 直接埋め込みモードではページをラスタライズしないので、プロセスプールは使わない
+    try:
+        for n, spec in enumerate(specs):
+            if is_cancelled():
+                writer.abort()
+                return None
+            t0 = time.perf_counter()
+            writer.add_spec(spec)
+            telemetry.add_page(spec.index, {"pdf": time.perf_counter() - t0})
+            progress_cb((n + 1) / total)
+        with telemetry.stage("finalize"): writer.close()
+    except:
+        writer.abort()
+        raise
+    return None
+
+REPORT_FILE = "export_report.json"
+
+def export_project(project: Project, out_dir, opts: ExportOptions, progress_cb=lambda v: None, is_cancelled=lambda: False,
+                   telemetry: Optional[ExportTelemetry] = None):
+    """
+    設定に応じて書き出し、描画の統計情報を返す。
+    書き出し先には計測レポート(export_report.json)を残す（キャンセルしたときは残さない）。
+    """
+    if telemetry is None: telemetry = ExportTelemetry(export_page_count(project), opts)
+    try:
+        if opts.keep_original: stats = export_original(project, out_dir, opts, progress_cb, is_cancelled, telemetry)
+        else: stats = export_canvas(project, out_dir, opts, progress_cb, is_cancelled, telemetry)
+    except:
+        telemetry.finish("failed")
+        _write_export_report(telemetry, out_dir)
+        raise
+    if is_cancelled():
+        telemetry.finish("cancelled")
+        return stats
+    telemetry.finish("ok")
+    telemetry.stats = stats
+    _write_export_report(telemetry, out_dir)
+    return stats
+
+def _write_export_report(telemetry, out_dir):
+    try: telemetry.write_report(os.path.join(out_dir, REPORT_FILE))
+    except OSError: pass